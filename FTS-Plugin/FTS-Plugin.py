@@ -8,14 +8,29 @@ import re as _re
 import time
 import random
 import math
+import bisect
+import heapq
+import itertools
+import codecs
+import asyncio
 import shutil
 import threading
+import atexit
 import html as _html, base64 as _b64
-from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from telebot.types import InlineKeyboardMarkup as K, InlineKeyboardButton as B
 from telebot.apihelper import ApiTelegramException
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from bs4 import BeautifulSoup
+try:
+    import sqlite3
+except Exception:
+    sqlite3 = None
+try:
+    import aiohttp
+except Exception:
+    aiohttp = None
 import tg_bot.CBT as CBT
 logger = logging.getLogger('FTS-Plugin')
 LOG_TAG = '[FTS-Plugin]'
@@ -127,20 +142,178 @@ if not logger.handlers:
 logger.setLevel(logging.INFO)
 _STATE_LOCK = threading.RLock()
 _SEND_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('FTS_SEND_WORKERS', '2')), thread_name_prefix='FTS-SEND')
+FTS_SEND_CONCURRENCY_MAX = max(1, int(os.getenv('FTS_SEND_CONCURRENCY_MAX', '4')))
+FTS_SEND_CONCURRENCY_START = max(1, min(FTS_SEND_CONCURRENCY_MAX, int(os.getenv('FTS_SEND_CONCURRENCY_START', '2'))))
+FTS_SEND_LATENCY_TARGET_SEC = float(os.getenv('FTS_SEND_LATENCY_TARGET_SEC', '25'))
+FTS_SEND_GATE_RETRY_SEC = float(os.getenv('FTS_SEND_GATE_RETRY_SEC', '2'))
+FTS_SEND_GATE_WAIT_SEC = float(os.getenv('FTS_SEND_GATE_WAIT_SEC', '900'))
+_ORDER_SEND_EXECUTOR = ThreadPoolExecutor(max_workers=FTS_SEND_CONCURRENCY_MAX * 2, thread_name_prefix='FTS-ORDER-SEND')
+_SEND_RESULT_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='FTS-SEND-RESULT')
+_SEND_GATE = {'limit': float(FTS_SEND_CONCURRENCY_START), 'active': 0, 'chats': set(), 'deferred': {}, 'stalled': {}, 'seq': 0, 'inflight': {}, 'lat': None}
+_SEND_GATE_COND = threading.Condition()
 _ACTIVE_JOBS = {}
 _ACTIVE_JOBS_LOCK = threading.Lock()
-def _schedule_job(key, fn, *args, **kwargs):
+FTS_TIMER_SAFETY_SEC = float(os.getenv('FTS_TIMER_SAFETY_SEC', '300'))
+_TIMER_COND = threading.Condition(threading.RLock())
+_TIMER_HEAP = []
+_TIMER_DUE = {}
+_TIMER_JOBS = {}
+_TIMER_SEQ = [0]
+_TIMERS_STARTED = False
+def _timer_schedule(key, due_ts, fn, *args, earliest=False):
+    with _TIMER_COND:
+        cur = _TIMER_DUE.get(key)
+        if earliest and cur is not None and cur <= due_ts: return False
+        _TIMER_SEQ[0] += 1
+        _TIMER_DUE[key] = due_ts
+        _TIMER_JOBS[key] = (fn, args)
+        heapq.heappush(_TIMER_HEAP, (due_ts, _TIMER_SEQ[0], key))
+        _TIMER_COND.notify()
+        return True
+def _timer_kick(key, delay=0.0):
+    with _TIMER_COND:
+        job = _TIMER_JOBS.get(key)
+        if job is None: return False
+        return _timer_schedule(key, time.time() + delay, job[0], *job[1], earliest=True)
+def _timer_loop():
+    while True:
+        with _TIMER_COND:
+            while True:
+                while _TIMER_HEAP and _TIMER_DUE.get(_TIMER_HEAP[0][2]) != _TIMER_HEAP[0][0]:
+                    heapq.heappop(_TIMER_HEAP)
+                if not _TIMER_HEAP:
+                    _TIMER_COND.wait()
+                    continue
+                due, _, key = _TIMER_HEAP[0]
+                delay = due - time.time()
+                if delay <= 0: break
+                _TIMER_COND.wait(delay)
+            heapq.heappop(_TIMER_HEAP)
+            _TIMER_DUE.pop(key, None)
+            fn, args = _TIMER_JOBS.pop(key)
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.debug(f'timer {key} failed: {e}')
+def _start_timers():
+    global _TIMERS_STARTED
+    with _TIMER_COND:
+        if _TIMERS_STARTED: return
+        _TIMERS_STARTED = True
+    threading.Thread(target=_timer_loop, daemon=True, name='FTS-TIMERS').start()
+def _submit_job(executor, key, fn, args, kwargs):
     with _ACTIVE_JOBS_LOCK:
         old = _ACTIVE_JOBS.get(key)
         if old is not None and (not old.done()): return False
-        fut = _SEND_EXECUTOR.submit(fn, *args, **kwargs)
+        fut = executor.submit(fn, *args, **kwargs)
         _ACTIVE_JOBS[key] = fut
-        def _cleanup(_f):
-            with _ACTIVE_JOBS_LOCK:
-                cur = _ACTIVE_JOBS.get(key)
-                if cur is _f: _ACTIVE_JOBS.pop(key, None)
-        fut.add_done_callback(_cleanup)
-        return True
+    fut.add_done_callback(lambda f: _job_done(key, f))
+    return True
+def _job_done(key, fut):
+    with _ACTIVE_JOBS_LOCK:
+        if _ACTIVE_JOBS.get(key) is fut: _ACTIVE_JOBS.pop(key, None)
+def _schedule_job(key, fn, *args, **kwargs):
+    return _submit_job(_SEND_EXECUTOR, key, fn, args, kwargs)
+def _send_budget_stars(chat_id):
+    try:
+        cfg = _get_cfg_for_orders(chat_id)
+        cur = _normalize_stars_currency(cfg.get('stars_currency'))
+        bal_ton, bal_usdt = _wallet_effective_balances(chat_id, cfg, holds=False)
+        bal = bal_usdt if cur == FTS_CURRENCY_USDT_TON else bal_ton
+        if not isinstance(bal, (int, float)): return 0
+        unit = _wallet_unit(_wallet_owner(chat_id), cfg, cur)
+        if not unit: return 0
+        return int(float(bal) * max(0.0, min(1.0, float(FTS_BALANCE_LOT_RESERVE_RATIO))) / float(unit))
+    except Exception as e:
+        logger.debug(f'[SEND] budget lookup failed: {e}')
+        return 0
+def _send_gate_has_slot():
+    with _SEND_GATE_COND:
+        return _SEND_GATE['active'] < max(1, int(_SEND_GATE['limit']))
+def _send_gate_try(chat_id, qty):
+    cid = str(chat_id)
+    with _SEND_GATE_COND:
+        if cid in _SEND_GATE['chats'] or _SEND_GATE['active'] >= max(1, int(_SEND_GATE['limit'])): return None
+        need_budget = _SEND_GATE['active'] > 0
+    budget = _send_budget_stars(chat_id) if need_budget else None
+    with _SEND_GATE_COND:
+        active = _SEND_GATE['active']
+        if cid in _SEND_GATE['chats'] or active >= max(1, int(_SEND_GATE['limit'])): return None
+        if active and (budget is None or sum(_SEND_GATE['inflight'].values()) + int(qty) > budget): return None
+        _SEND_GATE['seq'] += 1
+        ticket = _SEND_GATE['seq']
+        _SEND_GATE['active'] += 1
+        _SEND_GATE['chats'].add(cid)
+        _SEND_GATE['inflight'][ticket] = int(qty)
+        return ticket
+def _send_gate_release(chat_id, ticket):
+    with _SEND_GATE_COND:
+        if _SEND_GATE['inflight'].pop(ticket, None) is None: return
+        _SEND_GATE['active'] = max(0, _SEND_GATE['active'] - 1)
+        _SEND_GATE['chats'].discard(str(chat_id))
+        deferred = list(_SEND_GATE['deferred'])
+    for key in deferred:
+        _timer_kick(key)
+def _send_gate_defer(cardinal, chat_id, oid):
+    key = f'send_gate:{chat_id}:{oid or "cur"}'
+    now = time.time()
+    with _SEND_GATE_COND:
+        first = _SEND_GATE['deferred'].setdefault(key, now)
+        if now - first > FTS_SEND_GATE_WAIT_SEC:
+            _SEND_GATE['deferred'].pop(key, None)
+            _SEND_GATE['stalled'][key] = (chat_id, oid)
+            first = None
+    if first is None:
+        logger.warning(f'[SEND] no send slot for {int(FTS_SEND_GATE_WAIT_SEC)}s, leaving order #{oid or "—"} (chat {chat_id}) for the queue tick')
+        return False
+    _timer_schedule(key, now + FTS_SEND_GATE_RETRY_SEC, _schedule_confirm_send, cardinal, chat_id, oid, earliest=True)
+    return True
+def _send_gate_undefer(chat_id, oid):
+    key = f'send_gate:{chat_id}:{oid or "cur"}'
+    with _SEND_GATE_COND:
+        _SEND_GATE['deferred'].pop(key, None)
+        _SEND_GATE['stalled'].pop(key, None)
+def _send_gate_redrive(cardinal):
+    if not _send_gate_has_slot(): return
+    with _SEND_GATE_COND:
+        stalled = list(_SEND_GATE['stalled'].values())
+        _SEND_GATE['stalled'].clear()
+    for chat_id, oid in stalled:
+        _schedule_confirm_send(cardinal, chat_id, oid)
+def _send_gate_observe(latency, resp):
+    resp = resp or {}
+    status = int(resp.get('status') or 0)
+    failed = bool(resp.get('uncertain') or resp.get('network_error')) or status == 429 or status >= 500
+    with _SEND_GATE_COND:
+        lat = _SEND_GATE['lat']
+        _SEND_GATE['lat'] = latency if lat is None else lat * 0.7 + latency * 0.3
+        limit = _SEND_GATE['limit']
+        if failed:
+            limit = limit / 2.0
+        elif _SEND_GATE['lat'] > FTS_SEND_LATENCY_TARGET_SEC:
+            limit = limit * 0.75
+        else:
+            limit = limit + 1.0 / max(1.0, limit)
+        _SEND_GATE['limit'] = max(1.0, min(float(FTS_SEND_CONCURRENCY_MAX), limit))
+    logger.debug(f"[SEND] latency={latency:.1f}s ewma={_SEND_GATE['lat']:.1f}s limit={_SEND_GATE['limit']:.2f}")
+def _send_window_allows(chat_id, item):
+    if not FTS_GLOBAL_QUEUE or _queue_mode(chat_id) not in (1, 3): return True
+    if item is _current(chat_id): return True
+    if FTS_SEND_CONCURRENCY_MAX <= 1: return False
+    pos = _q(chat_id).position(item)
+    if pos is None or pos > int(_SEND_GATE['limit']): return False
+    return _find_item_by_chat(item.get('chat_id')) is item
+def _kick_send_window(cardinal, chat_id):
+    if not FTS_GLOBAL_QUEUE or FTS_SEND_CONCURRENCY_MAX <= 1: return
+    try:
+        for it in list(_q(chat_id)[:int(_SEND_GATE['limit'])]):
+            cid, oid = it.get('chat_id'), it.get('order_id')
+            if not cid or not oid or it.get('finalized') or it.get('stage') != 'await_confirm' or not it.get('candidate'): continue
+            if not (it.get('preconfirmed') or _auto_send_without_plus(cid)): continue
+            if _send_window_allows(cid, it):
+                _schedule_confirm_send(cardinal, cid, str(oid))
+    except Exception as e:
+        logger.debug(f'[SEND] window kick failed: {e}')
 def _schedule_confirm_send(cardinal, chat_id, oid=None, *, notify_busy=True):
     requested_oid = oid
     try:
@@ -149,17 +322,26 @@ def _schedule_confirm_send(cardinal, chat_id, oid=None, *, notify_busy=True):
     except Exception:
         requested_oid = oid
     job_key = f"send_oid:{requested_oid}" if requested_oid else f"send:{chat_id}:cur"
+    if not _send_gate_has_slot():
+        _send_gate_defer(cardinal, chat_id, oid)
+        return False
     def _run():
         _set_sending(chat_id, True)
+        cont = None
         try:
-            if oid: _do_confirm_send_for_oid(cardinal, chat_id, oid)
+            if oid: cont = _do_confirm_send_for_oid(cardinal, chat_id, oid)
             else:
-                _do_confirm_send(cardinal, chat_id)
+                cont = _do_confirm_send(cardinal, chat_id)
         except Exception as e:
             logger.exception(f'background send failed: {e}')
-        finally:
-            _set_sending(chat_id, False)
-    scheduled = _schedule_job(job_key, _run)
+        if isinstance(cont, Future):
+            with _ACTIVE_JOBS_LOCK:
+                _ACTIVE_JOBS[job_key] = cont
+            cont.add_done_callback(lambda f: (_job_done(job_key, f), _kick_send_window(cardinal, chat_id)))
+            return
+        _set_sending(chat_id, False)
+        _kick_send_window(cardinal, chat_id)
+    scheduled = _submit_job(_ORDER_SEND_EXECUTOR, job_key, _run, (), {})
     if not scheduled: _order_log('debug', 'send_job_busy', oid=requested_oid or 'noid', chat_id=chat_id)
     return scheduled
 def _log(level, msg):
@@ -259,6 +441,11 @@ SETTINGS_FILE = os.path.join(PLUGIN_FOLDER, 'settings.json')
 SETTINGS_BAK = SETTINGS_FILE + '.bak'
 ORDERS_FILE = os.path.join(PLUGIN_FOLDER, 'orders.json')
 ORDERS_BAK = ORDERS_FILE + '.bak'
+ORDERS_JOURNAL = os.path.join(PLUGIN_FOLDER, 'orders.journal.jsonl')
+FTS_ORDERS_COMPACT_EVERY = int(os.getenv('FTS_ORDERS_COMPACT_EVERY', '200'))
+ORDERS_SQLITE_FILE = os.path.join(PLUGIN_FOLDER, 'orders.sqlite3')
+FTS_ORDERS_BACKEND = os.getenv('FTS_ORDERS_BACKEND', 'json').strip().lower()
+FTS_ORDERS_RETENTION_DAYS = int(os.getenv('FTS_ORDERS_RETENTION_DAYS', '180'))
 TEMP_LOTS_FILE = os.path.join(PLUGIN_FOLDER, 'temporary_lots.json')
 TEMP_LOTS_BAK = TEMP_LOTS_FILE + '.bak'
 SETTINGS_SCHEMA_VERSION = 8
@@ -275,7 +462,15 @@ _TEMP_LOT_DIALOG_LOCK = threading.RLock()
 _TEMP_LOT_DIALOGS = {}
 _LOT_UI_PAGE = {}
 _REMINDER_LOCK = threading.RLock()
+_ORDERS_CACHE = {'db': None, 'sig': None, 'journal_lines': 0}
+_ORDERS_SQL = {'conn': None, 'failed': False}
 _RUNTIME_PROFILE_KEYS = {'__orders__', '__global_orders__'}
+FTS_SETTINGS_FLUSH_DELAY = float(os.getenv('FTS_SETTINGS_FLUSH_DELAY', '1.0'))
+FTS_SETTINGS_STAT_SEC = float(os.getenv('FTS_SETTINGS_STAT_SEC', '2'))
+_SETTINGS_CACHE = {'data': None, 'sig': None, 'dirty': False, 'dirty_ts': 0.0, 'gen': 0, 'stat_ts': 0.0}
+_CFG_SNAPSHOTS = {}
+_SETTINGS_FLUSH_EVENT = threading.Event()
+_SETTINGS_FLUSHER_STARTED = False
 def _atomic_write_json(path, data):
     os.makedirs(os.path.dirname(path), exist_ok=True)
     tmp = path + '.tmp'
@@ -301,7 +496,7 @@ def _try_parse_settings_text(txt):
     except Exception:
         return None
     return None
-def _load_settings():
+def _read_settings_file():
     with _SETTINGS_IO_LOCK:
         loaded_from = None
         for path, label in ((SETTINGS_FILE, 'settings.json'), (SETTINGS_BAK, 'settings.json.bak')):
@@ -336,19 +531,103 @@ def _load_settings():
         except Exception:
             pass
         return {}
+def _settings_file_sig():
+    try:
+        st = os.stat(SETTINGS_FILE)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except Exception:
+        return None
+def _settings_read_only(*args, **kwargs):
+    raise TypeError('settings view is read-only; take _settings_copy() before changing it')
+class _FrozenDict(dict):
+    __setitem__ = __delitem__ = __ior__ = update = pop = popitem = setdefault = clear = _settings_read_only
+    def __deepcopy__(self, memo):
+        return _settings_copy(self)
+class _FrozenList(list):
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = remove = pop = clear = sort = reverse = _settings_read_only
+    def __deepcopy__(self, memo):
+        return _settings_copy(self)
+def _freeze(x):
+    if isinstance(x, (_FrozenDict, _FrozenList)): return x
+    if isinstance(x, dict): return _FrozenDict((k, _freeze(v)) for k, v in x.items())
+    if isinstance(x, list): return _FrozenList(_freeze(v) for v in x)
+    return x
+def _settings_copy(data):
+    if isinstance(data, dict): return {k: _settings_copy(v) for k, v in data.items()}
+    if isinstance(data, list): return [_settings_copy(v) for v in data]
+    return data
+def _settings_stale(c):
+    if c['data'] is None: return True
+    if c['dirty']: return False
+    now = time.monotonic()
+    if now - c['stat_ts'] < FTS_SETTINGS_STAT_SEC: return False
+    c['stat_ts'] = now
+    if c['sig'] == _settings_file_sig(): return False
+    c['data'] = None
+    return True
+def _load_settings():
+    with _SETTINGS_IO_LOCK:
+        c = _SETTINGS_CACHE
+        if not _settings_stale(c): return c['data']
+        data = _read_settings_file()
+        c.update(data=_freeze(data), sig=_settings_file_sig(), dirty=False, gen=c['gen'] + 1, stat_ts=time.monotonic())
+        return c['data']
+def _settings_peek():
+    data = _load_settings()
+    return data if isinstance(data, dict) else {}
 def _save_settings(data):
     if not isinstance(data, dict): return
     with _SETTINGS_IO_LOCK:
         try:
             data, _, _ = _migrate_settings_data(data)
-            json.dumps(data, ensure_ascii=False)
+            snap = _freeze(json.loads(json.dumps(data, ensure_ascii=False)))
+        except Exception as e:
+            logger.error(f'Save settings error: {e}')
+            return
+        _SETTINGS_CACHE.update(data=snap, dirty=True, dirty_ts=time.time(), gen=_SETTINGS_CACHE['gen'] + 1)
+    _timer_kick('maint', 2.0)
+    _timer_kick('queue')
+    if FTS_SETTINGS_FLUSH_DELAY <= 0:
+        _flush_settings()
+        return
+    _start_settings_flusher()
+    _SETTINGS_FLUSH_EVENT.set()
+def _flush_settings():
+    with _SETTINGS_IO_LOCK:
+        c = _SETTINGS_CACHE
+        if not c['dirty'] or c['data'] is None: return False
+        try:
             try:
                 if os.path.exists(SETTINGS_FILE): shutil.copy2(SETTINGS_FILE, SETTINGS_BAK)
             except Exception:
                 pass
-            _atomic_write_json(SETTINGS_FILE, data)
+            _atomic_write_json(SETTINGS_FILE, c['data'])
+            c.update(sig=_settings_file_sig(), dirty=False)
+            return True
         except Exception as e:
             logger.error(f'Save settings error: {e}')
+            return False
+def _settings_cache_drop():
+    with _SETTINGS_IO_LOCK:
+        _SETTINGS_CACHE.update(data=None, sig=None, dirty=False, gen=_SETTINGS_CACHE['gen'] + 1)
+        _CFG_SNAPSHOTS.clear()
+def _settings_flush_worker():
+    while True:
+        _SETTINGS_FLUSH_EVENT.wait()
+        time.sleep(FTS_SETTINGS_FLUSH_DELAY)
+        _SETTINGS_FLUSH_EVENT.clear()
+        try:
+            _flush_settings()
+        except Exception as e:
+            logger.debug(f'settings flush failed: {e}')
+def _start_settings_flusher():
+    global _SETTINGS_FLUSHER_STARTED
+    if _SETTINGS_FLUSHER_STARTED: return
+    with _SETTINGS_IO_LOCK:
+        if _SETTINGS_FLUSHER_STARTED: return
+        _SETTINGS_FLUSHER_STARTED = True
+    threading.Thread(target=_settings_flush_worker, daemon=True, name='FTS-SETTINGS-FLUSH').start()
+atexit.register(_flush_settings)
 os.makedirs(PLUGIN_FOLDER, exist_ok=True)
 if not os.path.exists(SETTINGS_FILE):
     try:
@@ -504,23 +783,164 @@ def _normalize_orders_db(data):
     result['__meta__'].update(meta)
     result['__meta__'].update({         'schema': ORDERS_SCHEMA_VERSION,         'plugin': NAME,         'updated_at': int(time.time())     })
     return result
-def _load_orders_db():
+def _orders_sql_enabled():
+    return FTS_ORDERS_BACKEND == 'sqlite' and sqlite3 is not None and not _ORDERS_SQL['failed']
+def _orders_sql_row(oid, rec):
+    sent = _as_int(rec.get('sent_ts') or rec.get('finalized_ts'), 0, 0)
+    return (str(oid), str(rec.get('chat_id') or ''), str(rec.get('status') or '').lower(), sent, _as_int(rec.get('updated_ts'), 0, 0), json.dumps(rec, ensure_ascii=False))
+def _orders_sql():
+    with _ORDERS_IO_LOCK:
+        if _ORDERS_SQL['conn'] is not None: return _ORDERS_SQL['conn']
+        try:
+            os.makedirs(PLUGIN_FOLDER, exist_ok=True)
+            conn = sqlite3.connect(ORDERS_SQLITE_FILE, timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS orders (oid TEXT PRIMARY KEY, chat_id TEXT, status TEXT, sent_ts INTEGER, updated_ts INTEGER, data TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS orders_status ON orders(status)')
+            conn.execute('CREATE INDEX IF NOT EXISTS orders_chat_id ON orders(chat_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS orders_sent_ts ON orders(sent_ts)')
+            empty = conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0] == 0
+            if empty and (os.path.exists(ORDERS_FILE) or os.path.exists(ORDERS_JOURNAL)):
+                db = _read_orders_file()
+                _replay_orders_journal(db)
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO orders VALUES (?,?,?,?,?,?)', [_orders_sql_row(k, v) for k, v in db['records'].items()])
+                logger.info(f"[DB] orders imported into sqlite: {len(db['records'])}")
+            if FTS_ORDERS_RETENTION_DAYS > 0:
+                with conn:
+                    conn.execute('DELETE FROM orders WHERE updated_ts > 0 AND updated_ts < ?', (int(time.time()) - FTS_ORDERS_RETENTION_DAYS * 86400,))
+            _ORDERS_SQL['conn'] = conn
+            return conn
+        except Exception as e:
+            _ORDERS_SQL['failed'] = True
+            logger.error(f'[DB] sqlite orders backend unavailable, using orders.json: {e}')
+            return None
+def _orders_sql_select(where='', args=()):
+    conn = _orders_sql()
+    if conn is None: return None
+    q = 'SELECT oid, data FROM orders' + (f' WHERE {where}' if where else '') + ' ORDER BY updated_ts'
+    out = {}
     with _ORDERS_IO_LOCK:
-        for path, label in ((ORDERS_FILE, 'orders.json'), (ORDERS_BAK, 'orders.json.bak')):
+        for oid, data in conn.execute(q, args).fetchall():
             try:
-                if not os.path.exists(path): continue
-                with open(path, 'r', encoding='utf-8') as f:
-                    obj = _try_parse_settings_text(f.read())
-                if isinstance(obj, dict):
-                    data = _normalize_orders_db(obj)
-                    if label != 'orders.json':
-                        logger.warning('Orders database restored from .bak')
-                        _atomic_write_json(ORDERS_FILE, data)
-                    return data
-            except Exception as e:
-                logger.warning(f'Load {label} error: {e}')
-        return _orders_db_default()
+                rec = json.loads(data)
+            except Exception:
+                continue
+            if isinstance(rec, dict): out[str(oid)] = rec
+    return out
+def _orders_sql_upsert(items, replace=False):
+    conn = _orders_sql()
+    if conn is None: return False
+    with _ORDERS_IO_LOCK:
+        with conn:
+            if replace:
+                stale = [(oid,) for (oid,) in conn.execute('SELECT oid FROM orders').fetchall() if oid not in items]
+                if stale: conn.executemany('DELETE FROM orders WHERE oid = ?', stale)
+            conn.executemany('INSERT OR REPLACE INTO orders VALUES (?,?,?,?,?,?)', [_orders_sql_row(k, v) for k, v in items.items()])
+    return True
+def _query_order_records(statuses=None, chat_id=None, sent_before=None):
+    if _orders_sql_enabled():
+        where, args = [], []
+        if statuses:
+            where.append('status IN (%s)' % ','.join('?' * len(statuses)))
+            args.extend(sorted(str(x).lower() for x in statuses))
+        if chat_id is not None:
+            where.append('chat_id = ?')
+            args.append(str(chat_id))
+        if sent_before is not None:
+            where.append('sent_ts > 0 AND sent_ts <= ?')
+            args.append(int(sent_before))
+        rows = _orders_sql_select(' AND '.join(where), tuple(args))
+        if rows is not None: return rows
+    out = {}
+    sts = {str(x).lower() for x in statuses} if statuses else None
+    with _ORDERS_IO_LOCK:
+        for oid, rec in _orders_db_ref()['records'].items():
+            if sts is not None and str(rec.get('status') or '').lower() not in sts: continue
+            if chat_id is not None and str(rec.get('chat_id') or '') != str(chat_id): continue
+            if sent_before is not None:
+                ts = _as_int(rec.get('sent_ts') or rec.get('finalized_ts'), 0, 0)
+                if not ts or ts > sent_before: continue
+            out[oid] = dict(rec)
+    return out
+def _orders_store_exists():
+    if _orders_sql_enabled() and _orders_sql() is not None: return True
+    return os.path.exists(ORDERS_FILE)
+def _orders_file_sig():
+    try:
+        st = os.stat(ORDERS_FILE)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except Exception:
+        return None
+def _orders_db_copy(db):
+    return {'__meta__': dict(db.get('__meta__') or {}), 'records': {k: dict(v) for k, v in (db.get('records') or {}).items()}}
+def _read_orders_file():
+    for path, label in ((ORDERS_FILE, 'orders.json'), (ORDERS_BAK, 'orders.json.bak')):
+        try:
+            if not os.path.exists(path): continue
+            with open(path, 'r', encoding='utf-8') as f:
+                obj = _try_parse_settings_text(f.read())
+            if isinstance(obj, dict):
+                data = _normalize_orders_db(obj)
+                if label != 'orders.json':
+                    logger.warning('Orders database restored from .bak')
+                    _atomic_write_json(ORDERS_FILE, data)
+                return data
+        except Exception as e:
+            logger.warning(f'Load {label} error: {e}')
+    return _orders_db_default()
+def _replay_orders_journal(db):
+    applied = 0
+    try:
+        if not os.path.exists(ORDERS_JOURNAL): return 0
+        recs = db['records']
+        with open(ORDERS_JOURNAL, 'r', encoding='utf-8') as f:
+            for ln in f:
+                try:
+                    ent = json.loads(ln)
+                except Exception:
+                    continue
+                if not isinstance(ent, dict) or not ent.get('oid') or not isinstance(ent.get('rec'), dict): continue
+                recs.pop(str(ent['oid']), None)
+                recs[str(ent['oid'])] = ent['rec']
+                applied += 1
+        if applied: db['records'] = _merge_order_records({}, recs)
+    except Exception as e:
+        logger.warning(f'[DB] orders journal replay failed: {e}')
+    return applied
+def _orders_db_ref():
+    with _ORDERS_IO_LOCK:
+        c = _ORDERS_CACHE
+        if c['db'] is None or c['sig'] != _orders_file_sig():
+            db = _read_orders_file()
+            applied = _replay_orders_journal(db)
+            c.update(db=db, sig=_orders_file_sig(), journal_lines=applied)
+            if applied >= FTS_ORDERS_COMPACT_EVERY: _save_orders_db(db)
+        return c['db']
+def _load_orders_db():
+    if _orders_sql_enabled():
+        rows = _orders_sql_select()
+        if rows is not None:
+            db = _orders_db_default()
+            db['records'] = rows
+            return db
+    with _ORDERS_IO_LOCK:
+        return _orders_db_copy(_orders_db_ref())
 def _save_orders_db(data):
+    if _orders_sql_enabled():
+        try:
+            db = data if isinstance(data, dict) else {}
+            raw = db.get('records') if isinstance(db.get('records'), dict) else {k: v for k, v in db.items() if k != '__meta__' and isinstance(v, dict)}
+            items = {}
+            for oid, rec in raw.items():
+                items.update(_sanitize_order_records({oid: rec}))
+            if _orders_sql_upsert(items, replace=True):
+                result = _orders_db_default()
+                result['records'] = items
+                return result
+        except Exception as e:
+            logger.error(f'[DB] sqlite orders save error: {e}')
     with _ORDERS_IO_LOCK:
         try:
             normalized = _normalize_orders_db(data)
@@ -529,10 +949,30 @@ def _save_orders_db(data):
             except Exception:
                 pass
             _atomic_write_json(ORDERS_FILE, normalized)
+            try:
+                if os.path.exists(ORDERS_JOURNAL): os.remove(ORDERS_JOURNAL)
+            except Exception as e:
+                logger.warning(f'[DB] orders journal reset failed: {e}')
+            _ORDERS_CACHE.update(db=_orders_db_copy(normalized), sig=_orders_file_sig(), journal_lines=0)
             return normalized
         except Exception as e:
             logger.error(f'Save orders database error: {e}')
             return _normalize_orders_db(data)
+def _append_orders_journal(oid, rec):
+    with _ORDERS_IO_LOCK:
+        line = json.dumps({'oid': str(oid), 'rec': rec}, ensure_ascii=False)
+        with open(ORDERS_JOURNAL, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        c = _ORDERS_CACHE
+        recs = _orders_db_ref()['records']
+        recs.pop(str(oid), None)
+        recs[str(oid)] = dict(rec)
+        if len(recs) > ORDER_RECORDS_LIMIT: c['db']['records'] = _merge_order_records({}, recs)
+        c['journal_lines'] += 1
+        if c['journal_lines'] >= FTS_ORDERS_COMPACT_EVERY:
+            _save_orders_db(c['db'])
 def _temporary_lots_db_default():
     return {
         '__meta__': {
@@ -608,6 +1048,7 @@ def _temporary_lot_record_save(record):
     records[str(row['lot_id'])] = row
     db['records'] = records
     _save_temporary_lots_db(db)
+    _timer_kick('maint', 1.0)
     return row
 
 def _temporary_lot_record_delete(lot_id):
@@ -635,7 +1076,11 @@ def _get_order_records():
     return dict((_load_orders_db().get('records') or {}))
 def _get_order_record(oid):
     if not oid: return {}
-    return dict(_get_order_records().get(str(oid)) or {})
+    if _orders_sql_enabled():
+        rows = _orders_sql_select('oid = ?', (str(oid),))
+        if rows is not None: return dict(rows.get(str(oid)) or {})
+    with _ORDERS_IO_LOCK:
+        return dict(_orders_db_ref()['records'].get(str(oid)) or {})
 def _profile_is_runtime_default(raw):
     if not isinstance(raw, dict) or raw.get('fragment_jwt'): return False
     probe = dict(raw)
@@ -646,6 +1091,7 @@ def _profile_is_runtime_default(raw):
         if key not in default or value != default.get(key): return False
     return True
 def _read_raw_settings_for_migration():
+    _flush_settings()
     for path in (SETTINGS_FILE, SETTINGS_BAK):
         try:
             if not os.path.exists(path): continue
@@ -678,7 +1124,7 @@ def _migrate_orders_storage():
         else:
             cleaned[key] = profile
     db['records'] = records
-    if moved or not os.path.exists(ORDERS_FILE): _save_orders_db(db)
+    if moved or not _orders_store_exists(): _save_orders_db(db)
     normalized, _, _ = _migrate_settings_data(cleaned)
     if normalized != raw: _save_settings(normalized)
     return (moved, removed_profiles)
@@ -863,6 +1309,7 @@ def _repair_settings_file(chat_id=None):
     }
     chat_key = str(chat_id) if chat_id is not None else None
     with _SETTINGS_IO_LOCK:
+        _flush_settings()
         ts = time.strftime('%Y%m%d-%H%M%S')
         if os.path.exists(SETTINGS_FILE):
             backup_path = SETTINGS_FILE + f'.fix_fts.{ts}.bak'
@@ -969,11 +1416,12 @@ def _repair_settings_file(chat_id=None):
         fixed[SETTINGS_META_KEY] = meta
 
         db['records'] = records
-        if report['orders_moved'] or not os.path.exists(ORDERS_FILE):
+        if report['orders_moved'] or not _orders_store_exists():
             _save_orders_db(db)
 
         json.dumps(fixed, ensure_ascii=False, allow_nan=False)
         _atomic_write_json(SETTINGS_FILE, fixed)
+        _settings_cache_drop()
         try:
             _atomic_write_json(SETTINGS_BAK, fixed)
         except Exception as e:
@@ -1082,15 +1530,32 @@ def _tpl(chat_id, key, **kw):
     default = _default_templates().get(key, '')
     raw = tpls.get(key, default)
     return _fmt_tpl(raw, **kw)
+def _cfg_snapshot(kind, key):
+    with _SETTINGS_IO_LOCK:
+        c = _SETTINGS_CACHE
+        if _settings_stale(c): return None
+        ent = _CFG_SNAPSHOTS.get((kind, key))
+        if ent is None or ent[0] != c['gen']: return None
+        return ent[1]
+def _cfg_snapshot_put(kind, key, cfg):
+    with _SETTINGS_IO_LOCK:
+        if len(_CFG_SNAPSHOTS) > 256: _CFG_SNAPSHOTS.clear()
+        snap = _freeze(cfg)
+        _CFG_SNAPSHOTS[(kind, key)] = (_SETTINGS_CACHE['gen'], snap)
+        return snap
 def _get_cfg(chat_id):
-    data = _load_settings()
     key = str(chat_id)
-    raw_cfg, attached = _attach_legacy_cfg_if_needed(data, key, data.get(key))
-    cfg = _sanitize_cfg(raw_cfg, chat_id=key)
-    changed = attached or data.get(key) != cfg
-    data[key] = cfg
-    if changed: _save_settings(data)
-    return cfg
+    snap = _cfg_snapshot('cfg', key)
+    if snap is not None: return snap
+    with _SETTINGS_IO_LOCK:
+        data = _load_settings()
+        raw_cfg, attached = _attach_legacy_cfg_if_needed(data, key, data.get(key))
+        cfg = _sanitize_cfg(raw_cfg, chat_id=key)
+        if attached or data.get(key) != cfg:
+            data = _settings_copy(data)
+            data[key] = cfg
+            _save_settings(data)
+        return _cfg_snapshot_put('cfg', key, cfg)
 def _owner_cfg_entry(data, chat_id=None):
     data = data if isinstance(data, dict) else {}
     key = str(chat_id) if chat_id is not None else None
@@ -1104,14 +1569,20 @@ def _owner_cfg_entry(data, chat_id=None):
     return (LEGACY_SETTINGS_KEY, legacy) if isinstance(legacy, dict) and legacy.get('fragment_jwt') else (None, None)
 def _cfg_key_for_orders(chat_id):
     try:
-        return _owner_cfg_entry(_load_settings(), chat_id)[0]
+        with _SETTINGS_IO_LOCK:
+            return _owner_cfg_entry(_settings_peek(), chat_id)[0]
     except Exception as e:
         logger.warning(f'_cfg_key_for_orders failed: {e}')
         return None
 def _get_cfg_for_orders(chat_id):
+    skey = str(chat_id)
+    snap = _cfg_snapshot('orders', skey)
+    if snap is not None: return snap
     try:
-        _key, cfg = _owner_cfg_entry(_load_settings(), chat_id)
-        if isinstance(cfg, dict): return _sanitize_cfg(cfg, chat_id=_key)
+        with _SETTINGS_IO_LOCK:
+            _key, cfg = _owner_cfg_entry(_settings_peek(), chat_id)
+            cfg = _sanitize_cfg(cfg, chat_id=_key) if isinstance(cfg, dict) else _sanitize_cfg({})
+            return _cfg_snapshot_put('orders', skey, cfg)
     except Exception as e:
         logger.warning(f'_get_cfg_for_orders failed: {e}')
     return _sanitize_cfg({})
@@ -1127,7 +1598,8 @@ def _set_cfg_for_orders(chat_id, **updates):
 
 def _shared_order_flag_enabled(flag_key, default=False):
     try:
-        data = _load_settings()
+        with _SETTINGS_IO_LOCK:
+            data = dict(_settings_peek())
     except Exception as e:
         logger.warning(f'Unable to read shared order flag {flag_key}: {e}')
         return bool(default)
@@ -1146,7 +1618,7 @@ def _shared_order_flag_enabled(flag_key, default=False):
 def _set_shared_order_flag(chat_id, flag_key, enabled):
     enabled = bool(enabled)
     with _SETTINGS_IO_LOCK:
-        data = _load_settings()
+        data = _settings_copy(_load_settings())
         current_key = str(chat_id)
         target_keys = []
         for profile_key, raw in data.items():
@@ -1188,8 +1660,11 @@ def _set_cfg(chat_id, **updates):
         cfg = _sanitize_cfg(raw_cfg, chat_id=key)
         cfg.update(updates)
         cfg = _sanitize_cfg(cfg, chat_id=key)
-        data[key] = cfg
-        _save_settings(data)
+        if attached or data.get(key) != cfg:
+            data = _settings_copy(data)
+            data[key] = cfg
+            _save_settings(data)
+        _cfg_snapshot_put('cfg', key, cfg)
         return cfg
 
 _FRAGMENT_PROXY_PROTOCOLS = {
@@ -1664,44 +2139,117 @@ def _extract_username_from_any(x, depth=0):
         pass
     return None
 def _check_username_exists(username, jwt, chat_id=None):
+    return _lookup_username(username, jwt, chat_id) is True
+def _lookup_username(username, jwt, chat_id=None):
     if not username: return False
     uname = username.lstrip('@').strip()
-    urls = []
-    for base in FRAGMENT_USER_URLS:
-        base = (base or '').rstrip('/')
-        if base: urls.append(f'{base}/{uname}/')
-    urls.append(f'{FRAGMENT_BASE}/misc/user/{uname}/')
+    bases = [b for b in ((x or '').rstrip('/') for x in FRAGMENT_USER_URLS) if b]
+    bases.append(f'{FRAGMENT_BASE}/misc/user')
     headers_with_jwt = {'Accept': 'application/json'}
     if jwt: headers_with_jwt['Authorization'] = f'JWT {jwt}'
     proxy_cfg = _fragment_proxy_cfg(chat_id=chat_id, jwt=jwt)
-    proxy_kwargs = _fragment_proxy_kwargs(jwt=jwt, chat_id=chat_id, cfg=proxy_cfg)
-    for url in urls:
+    cands, learned = _endpoint_candidates('user', [(b, m) for b in bases for m in ('jwt', 'anon')])
+    answered = False
+    for i, (base, mode) in enumerate(cands):
+        url = f'{base}/{uname}/'
         try:
-            r = _HTTP.get(url, headers=headers_with_jwt, timeout=8, **proxy_kwargs)
+            r = _fragment_http('GET', url, headers=headers_with_jwt if mode == 'jwt' else {'Accept': 'application/json'}, timeout=8, jwt=jwt, proxy_cfg=proxy_cfg, endpoint='user')
+            data = None
             if r.status_code == 200:
                 try:
                     data = r.json()
-                    if isinstance(data, dict) and (data.get('username') or data.get('user') or data.get('id')): return True
                 except Exception:
-                    pass
-            r2 = _HTTP.get(url, headers={'Accept': 'application/json'}, timeout=8, **proxy_kwargs)
-            if r2.status_code == 200:
-                try:
-                    data = r2.json()
-                    if isinstance(data, dict) and (data.get('username') or data.get('user') or data.get('id')): return True
-                except Exception:
-                    pass
+                    data = None
+            if isinstance(data, dict) and (data.get('username') or data.get('user') or data.get('id')):
+                _endpoint_result('user', base, mode, learned and i == 0)
+                return True
+            if r.status_code == 404 or isinstance(data, dict):
+                answered = True
         except Exception as e:
             logger.debug(f'_check_username_exists {url} failed: {_fragment_proxy_redact_error(e, proxy_cfg)}')
-    return False
-def _check_username_exists_throttled(username, jwt, chat_id=None):
+    return False if answered else None
+USERNAME_CACHE_FILE = os.path.join(PLUGIN_FOLDER, 'username_cache.json')
+FTS_USERNAME_CACHE_SIZE = int(os.getenv('FTS_USERNAME_CACHE_SIZE', '2048'))
+FTS_USERNAME_CACHE_OK_SEC = float(os.getenv('FTS_USERNAME_CACHE_OK_SEC', '86400'))
+FTS_USERNAME_CACHE_MISS_SEC = float(os.getenv('FTS_USERNAME_CACHE_MISS_SEC', '600'))
+FTS_USERNAME_CACHE_SAVE_SEC = float(os.getenv('FTS_USERNAME_CACHE_SAVE_SEC', '30'))
+_USERNAME_CACHE = {'items': None, 'inflight': {}, 'dirty': False, 'saved_ts': 0.0}
+_USERNAME_CACHE_LOCK = threading.Lock()
+def _username_cache_items():
+    if _USERNAME_CACHE['items'] is None:
+        items = OrderedDict()
+        try:
+            if os.path.exists(USERNAME_CACHE_FILE):
+                with open(USERNAME_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    obj = json.load(f)
+                now = time.time()
+                for name, (exists, ts) in sorted((obj or {}).items(), key=lambda kv: kv[1][1]):
+                    if now - float(ts) < (FTS_USERNAME_CACHE_OK_SEC if exists else FTS_USERNAME_CACHE_MISS_SEC):
+                        items[str(name)] = (bool(exists), float(ts))
+        except Exception as e:
+            logger.debug(f'username cache load failed: {e}')
+        _USERNAME_CACHE['items'] = items
+    return _USERNAME_CACHE['items']
+def _username_cache_get(name):
+    with _USERNAME_CACHE_LOCK:
+        items = _username_cache_items()
+        ent = items.get(name)
+        if ent is None: return None
+        if time.time() - ent[1] >= (FTS_USERNAME_CACHE_OK_SEC if ent[0] else FTS_USERNAME_CACHE_MISS_SEC):
+            items.pop(name, None)
+            return None
+        items.move_to_end(name)
+        return ent[0]
+def _username_cache_put(name, exists):
+    with _USERNAME_CACHE_LOCK:
+        items = _username_cache_items()
+        items[name] = (bool(exists), time.time())
+        items.move_to_end(name)
+        while len(items) > FTS_USERNAME_CACHE_SIZE:
+            items.popitem(last=False)
+        _USERNAME_CACHE['dirty'] = True
+    if time.time() - _USERNAME_CACHE['saved_ts'] >= FTS_USERNAME_CACHE_SAVE_SEC:
+        _username_cache_save()
+def _username_cache_save():
+    with _USERNAME_CACHE_LOCK:
+        if not _USERNAME_CACHE['dirty'] or _USERNAME_CACHE['items'] is None: return
+        data = {k: [v[0], int(v[1])] for k, v in _USERNAME_CACHE['items'].items()}
+        _USERNAME_CACHE.update(dirty=False, saved_ts=time.time())
+    try:
+        _atomic_write_json(USERNAME_CACHE_FILE, data)
+    except Exception as e:
+        logger.debug(f'username cache save failed: {e}')
+atexit.register(_username_cache_save)
+def _check_username_exists_throttled(username, jwt, chat_id=None, fresh=False):
+    name = str(username or '').lstrip('@').strip().lower()
+    if not name: return False
+    if not fresh:
+        cached = _username_cache_get(name)
+        if cached is not None: return cached
+    with _USERNAME_CACHE_LOCK:
+        fut = _USERNAME_CACHE['inflight'].get(name)
+        leader = fut is None
+        if leader:
+            fut = _USERNAME_CACHE['inflight'][name] = Future()
+    if not leader:
+        return fut.result() is True
+    res = None
+    try:
+        res = _lookup_username_throttled(username, jwt, chat_id)
+        if res is not None: _username_cache_put(name, res)
+    finally:
+        with _USERNAME_CACHE_LOCK:
+            _USERNAME_CACHE['inflight'].pop(name, None)
+        fut.set_result(res)
+    return res is True
+def _lookup_username_throttled(username, jwt, chat_id=None):
     key = str(chat_id) if chat_id is not None else '__global__'
     now = time.time()
     last = _last_username_check_ts.get(key, 0.0)
     wait = last + _USERNAME_CHECK_GAP - now
     if wait > 0: time.sleep(min(wait + random.random() * _USERNAME_CHECK_JITTER, _USERNAME_CHECK_GAP + _USERNAME_CHECK_JITTER))
     _last_username_check_ts[key] = time.time()
-    return _check_username_exists(username, jwt, chat_id=chat_id)
+    return _lookup_username(username, jwt, chat_id=chat_id)
 def _as_balance_float(v):
     try:
         if isinstance(v, bool) or v is None: return None
@@ -1788,25 +2336,116 @@ def _fragment_error_detail(data, text=''):
 def _is_fragment_auth_error(status, data=None, text=''):
     detail = _fragment_error_detail(data, text).lower()
     return status in (401, 403) or any(marker in detail for marker in _FRAGMENT_AUTH_ERRORS)
-def _check_fragment_wallet(jwt, chat_id=None):
-    headers = {'Accept': 'application/json', 'Authorization': f'JWT {jwt}'}
+FRAGMENT_ENDPOINTS_FILE = os.path.join(PLUGIN_FOLDER, 'fragment_endpoints.json')
+FTS_ENDPOINT_REPROBE_SEC = float(os.getenv('FTS_ENDPOINT_REPROBE_SEC', '3600'))
+_ENDPOINTS = {'learned': None, 'hits': defaultdict(int), 'misses': defaultdict(int)}
+_ENDPOINTS_LOCK = threading.Lock()
+def _endpoints_learned():
+    if _ENDPOINTS['learned'] is None:
+        data = {}
+        try:
+            if os.path.exists(FRAGMENT_ENDPOINTS_FILE):
+                with open(FRAGMENT_ENDPOINTS_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+        except Exception as e:
+            logger.debug(f'[ENDPOINTS] load failed: {e}')
+        _ENDPOINTS['learned'] = data if isinstance(data, dict) else {}
+    return _ENDPOINTS['learned']
+def _endpoint_candidates(family, candidates):
+    cands = [tuple(c) for c in candidates]
+    with _ENDPOINTS_LOCK:
+        ent = _endpoints_learned().get(family)
+    if not isinstance(ent, dict): return (cands, False)
+    pair = (ent.get('url'), ent.get('mode'))
+    if pair not in cands or time.time() - float(ent.get('probe_ts') or 0) >= FTS_ENDPOINT_REPROBE_SEC:
+        return (cands, False)
+    cands.remove(pair)
+    cands.insert(0, pair)
+    return (cands, True)
+def _endpoint_result(family, url, mode, hit):
+    with _ENDPOINTS_LOCK:
+        _ENDPOINTS['hits' if hit else 'misses'][family] += 1
+        if hit: return
+        learned = _endpoints_learned()
+        learned[family] = {'url': url, 'mode': mode, 'probe_ts': int(time.time())}
+        data = json.loads(json.dumps(learned))
+    try:
+        _atomic_write_json(FRAGMENT_ENDPOINTS_FILE, data)
+    except Exception as e:
+        logger.debug(f'[ENDPOINTS] save failed: {e}')
+    logger.info(f'[ENDPOINTS] {family}: {url} ({mode})')
+def _endpoint_stats_text():
+    with _ENDPOINTS_LOCK:
+        hits = sum(_ENDPOINTS['hits'].values())
+        misses = sum(_ENDPOINTS['misses'].values())
+    return f'{hits}/{misses}'
+FTS_WALLET_CACHE_TTL_SEC = float(os.getenv('FTS_WALLET_CACHE_TTL_SEC', '30'))
+FTS_WALLET_FAIL_TTL_SEC = float(os.getenv('FTS_WALLET_FAIL_TTL_SEC', '10'))
+FTS_WALLET_REFRESH_SEC = float(os.getenv('FTS_WALLET_REFRESH_SEC', '120'))
+_WALLET_CACHE = {}
+_WALLET_CACHE_LOCK = threading.Lock()
+def _wallet_cache_key(jwt, proxy_cfg):
+    return (hashlib.sha256(str(jwt or '').encode('utf-8')).hexdigest()[:16], _fragment_proxy_url(proxy_cfg) or '')
+def _check_fragment_wallet(jwt, chat_id=None, max_age=None):
     proxy_cfg = _fragment_proxy_cfg(chat_id=chat_id, jwt=jwt)
-    proxy_kwargs = _fragment_proxy_kwargs(jwt=jwt, chat_id=chat_id, cfg=proxy_cfg)
+    key = _wallet_cache_key(jwt, proxy_cfg)
+    now = time.time()
+    with _WALLET_CACHE_LOCK:
+        ent = _WALLET_CACHE.setdefault(key, {'result': None, 'ts': 0.0, 'ok': False, 'fut': None, 'used_ts': now, 'jwt': jwt, 'chat_id': chat_id})
+        ent['used_ts'] = now
+        ttl = FTS_WALLET_CACHE_TTL_SEC if ent['ok'] else FTS_WALLET_FAIL_TTL_SEC
+        if max_age is not None: ttl = min(ttl, float(max_age))
+        fut = ent['fut']
+        if fut is None and ent['result'] is not None and now - ent['ts'] < ttl:
+            ver, bal_ton, bal_usdt, raw = ent['result']
+            return (ver, bal_ton, bal_usdt, dict(raw) if isinstance(raw, dict) else raw)
+        leader = fut is None
+        if leader:
+            fut = ent['fut'] = Future()
+    if not leader:
+        ver, bal_ton, bal_usdt, raw = fut.result()
+        return (ver, bal_ton, bal_usdt, dict(raw) if isinstance(raw, dict) else raw)
+    result = (None, None, None, None)
+    try:
+        result = _fetch_fragment_wallet(jwt, proxy_cfg, now)
+        with _WALLET_CACHE_LOCK:
+            ent.update(result=result, ts=now, ok=result[1] is not None or result[2] is not None)
+    finally:
+        with _WALLET_CACHE_LOCK:
+            ent['fut'] = None
+        fut.set_result(result)
+    ver, bal_ton, bal_usdt, raw = result
+    return (ver, bal_ton, bal_usdt, dict(raw) if isinstance(raw, dict) else raw)
+def _wallet_cache_refresh_tick():
+    now = time.time()
+    try:
+        with _WALLET_CACHE_LOCK:
+            for key in [k for k, e in _WALLET_CACHE.items() if now - e['used_ts'] > FTS_WALLET_REFRESH_SEC * 5 and e['fut'] is None]:
+                _WALLET_CACHE.pop(key, None)
+            hot = [(e['jwt'], e['chat_id']) for e in _WALLET_CACHE.values() if e['fut'] is None and now - e['ts'] >= FTS_WALLET_CACHE_TTL_SEC]
+        for jwt, chat_id in hot:
+            _schedule_maint_job(f'wallet_cache:{_wallet_cache_key(jwt, None)[0]}:{chat_id}', _check_fragment_wallet, jwt, chat_id, 0)
+    finally:
+        _timer_schedule('wallet_cache', time.time() + FTS_WALLET_REFRESH_SEC, _wallet_cache_refresh_tick)
+def _fetch_fragment_wallet(jwt, proxy_cfg, started_ts=None):
+    headers = {'Accept': 'application/json', 'Authorization': f'JWT {jwt}'}
     last_result = None
-    for url in FRAGMENT_WALLET_URLS:
+    cands, learned = _endpoint_candidates('wallet', [(u, 'jwt') for u in FRAGMENT_WALLET_URLS])
+    for i, (url, _mode) in enumerate(cands):
         try:
-            r = _HTTP.get(url, headers=headers, timeout=20, **proxy_kwargs)
+            r = _fragment_http('GET', url, headers=headers, timeout=20, jwt=jwt, proxy_cfg=proxy_cfg, endpoint='wallet')
             try:
                 data = r.json()
             except Exception:
                 data = None
             raw = dict(data) if isinstance(data, dict) else {'raw': data if data is not None else (r.text or '')[:500]}
-            raw.update({'_http_status': r.status_code, '_url': url})
+            raw.update({'_http_status': r.status_code, '_url': url, '_fetched_ts': int(started_ts or time.time())})
             if _is_fragment_auth_error(r.status_code, data, r.text):
                 raw['_auth_error'] = True
                 logger.warning(f'Fragment JWT rejected: HTTP {r.status_code}')
                 return (None, None, None, raw)
             if r.ok:
+                _endpoint_result('wallet', url, 'jwt', learned and i == 0)
                 ver, bal_ton, bal_usdt = _extract_wallet_info(data if isinstance(data, dict) else {})
                 return (ver, bal_ton, bal_usdt, raw)
             last_result = raw
@@ -1856,49 +2495,397 @@ def _is_balance_failure_resp(resp):
         return any((x in low for x in ('not enough', 'insufficient', 'balance', 'low ton balance', 'no jetton wallet', 'недостат', 'не хватает')))
     except Exception:
         return False
-def _order_stars_with_retry(jwt, username, quantity, show_sender=False, webhook_url=None, retry_enabled=False, currency=None, response_url=None, proxy_chat_id=None):
-    resp = _order_stars(jwt, username=username, quantity=quantity, show_sender=show_sender, webhook_url=webhook_url, currency=currency, response_url=response_url, proxy_chat_id=proxy_chat_id)
-    if resp.get('ok') or not retry_enabled: return resp
-    if resp.get('safe_to_retry'):
-        delay = random.uniform(LITESERVER_RETRY_SLEEP_MIN, LITESERVER_RETRY_SLEEP_MAX)
-        _log('warn', f'SEND retry: connection was not established, attempt=2, sleep={delay:.2f}s')
-        time.sleep(delay)
-        resp2 = _order_stars(jwt, username=username, quantity=quantity, show_sender=show_sender, webhook_url=webhook_url, currency=currency, response_url=response_url, proxy_chat_id=proxy_chat_id)
-        resp2['_retried'] = True
-        return resp2
-    if resp.get('uncertain'): return resp
-    if _is_liteserver_transient_failure(resp.get('text', ''), int(resp.get('status') or 0), resp.get('json')):
-        delay = random.uniform(LITESERVER_RETRY_SLEEP_MIN, LITESERVER_RETRY_SLEEP_MAX)
-        _log('warn', f'SEND retry: liteserver transient error, attempt=2, sleep={delay:.2f}s')
-        time.sleep(delay)
-        resp2 = _order_stars(jwt, username=username, quantity=quantity, show_sender=show_sender, webhook_url=webhook_url, currency=currency, response_url=response_url, proxy_chat_id=proxy_chat_id)
-        resp2['_retried'] = True
-        return resp2
+FTS_SEND_RETRY_MAX = int(os.getenv('FTS_SEND_RETRY_MAX', '2'))
+FTS_SEND_RETRY_BACKOFF_MAX = float(os.getenv('FTS_SEND_RETRY_BACKOFF_MAX', '15'))
+_SEND_RETRY_IDS = itertools.count(1)
+def _order_retry_reason(resp):
+    if resp.get('ok'): return None
+    if resp.get('network_error') == 'circuit_open': return None
+    if resp.get('safe_to_retry'): return 'connection was not established'
+    if resp.get('uncertain'): return None
+    if _is_liteserver_transient_failure(resp.get('text', ''), int(resp.get('status') or 0), resp.get('json')): return 'liteserver transient error'
+    return None
+def _order_retry_delay(attempt):
+    cap = min(FTS_SEND_RETRY_BACKOFF_MAX, LITESERVER_RETRY_SLEEP_MAX * (2 ** (attempt - 1)))
+    return random.uniform(min(LITESERVER_RETRY_SLEEP_MIN, cap), cap)
+def _order_stars_deferred(jwt, username, quantity, show_sender=False, webhook_url=None, retry_enabled=False, currency=None, response_url=None, proxy_chat_id=None):
+    fut = Future()
+    key = f'send_retry:{next(_SEND_RETRY_IDS)}'
+    def _attempt(n):
+        try:
+            _order_stars(jwt, username=username, quantity=quantity, show_sender=show_sender, webhook_url=webhook_url, currency=currency, response_url=response_url, proxy_chat_id=proxy_chat_id).add_done_callback(lambda f: _attempt_done(n, f))
+        except Exception as e:
+            fut.set_exception(e)
+    def _attempt_done(n, f):
+        try:
+            resp = f.result()
+            if int(resp.get('status') or 0):
+                _breaker_record('order', int(resp.get('status') or 0) < 500 and not _is_liteserver_transient_failure(resp.get('text', ''), int(resp.get('status') or 0), resp.get('json')))
+            reason = _order_retry_reason(resp) if retry_enabled else None
+            if reason and n <= FTS_SEND_RETRY_MAX and not _breaker_is_open('order'):
+                delay = _order_retry_delay(n)
+                _log('warn', f'SEND retry: {reason}, attempt={n + 1}, delay={delay:.2f}s')
+                _timer_schedule(key, time.time() + delay, _FRAGMENT_IO_EXECUTOR.submit, _attempt, n + 1)
+                return
+            if n > 1: resp['_retried'] = True
+            fut.set_result(resp)
+        except Exception as e:
+            fut.set_exception(e)
+    _start_timers()
+    _FRAGMENT_IO_EXECUTOR.submit(_attempt, 1)
+    return fut
+FTS_FRAGMENT_POOL_IDLE_SEC = float(os.getenv('FTS_FRAGMENT_POOL_IDLE_SEC', '45'))
+FTS_FRAGMENT_KEEPALIVE_SEC = float(os.getenv('FTS_FRAGMENT_KEEPALIVE_SEC', '15'))
+FTS_FRAGMENT_POOL_MAX = int(os.getenv('FTS_FRAGMENT_POOL_MAX', '8'))
+_FRAGMENT_SESSIONS = OrderedDict()
+_FRAGMENT_SESSIONS_LOCK = threading.Lock()
+def _fragment_session(jwt, proxy_cfg=None):
+    key = (hashlib.sha256(str(jwt or '').encode('utf-8')).hexdigest()[:16], _fragment_proxy_url(proxy_cfg) or '')
+    now = time.time()
+    stale = []
+    with _FRAGMENT_SESSIONS_LOCK:
+        ent = _FRAGMENT_SESSIONS.get(key)
+        if ent is not None and (now - ent['used_ts'] > FTS_FRAGMENT_POOL_IDLE_SEC or ent.get('broken')):
+            stale.append(_FRAGMENT_SESSIONS.pop(key)['session'])
+            ent = None
+        if ent is None:
+            sess = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(2, int(os.getenv('FTS_SEND_WORKERS', '2')) + 2), max_retries=0)
+            sess.mount('https://', adapter)
+            sess.mount('http://', adapter)
+            ent = _FRAGMENT_SESSIONS[key] = {'session': sess, 'used_ts': now, 'broken': False}
+        if now - ent['used_ts'] > FTS_FRAGMENT_KEEPALIVE_SEC:
+            stale.append(ent['session'])
+        ent['used_ts'] = now
+        _FRAGMENT_SESSIONS.move_to_end(key)
+        while len(_FRAGMENT_SESSIONS) > FTS_FRAGMENT_POOL_MAX:
+            stale.append(_FRAGMENT_SESSIONS.popitem(last=False)[1]['session'])
+    for old in stale:
+        try:
+            old.close()
+        except Exception:
+            pass
+    return ent
+
+FTS_FRAGMENT_ASYNC = bool(int(os.getenv('FTS_FRAGMENT_ASYNC', '1')))
+_FRAGMENT_LOOP = {'loop': None, 'sessions': {}}
+_FRAGMENT_LOOP_LOCK = threading.Lock()
+_FRAGMENT_IO_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('FTS_FRAGMENT_IO_WORKERS', '4')), thread_name_prefix='FTS-FRAGMENT-IO')
+
+class _FragmentResponse:
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = int(status_code)
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.content = content or b''
+        self.text = self.content.decode('utf-8', errors='replace')
+        self.url = url
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+def _fragment_loop():
+    with _FRAGMENT_LOOP_LOCK:
+        if _FRAGMENT_LOOP['loop'] is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True, name='FTS-FRAGMENT-LOOP').start()
+            _FRAGMENT_LOOP['loop'] = loop
+        return _FRAGMENT_LOOP['loop']
+
+def _fragment_aio_error(e):
+    conn_timeout = getattr(aiohttp, 'ConnectionTimeoutError', None)
+    if isinstance(e, (aiohttp.ServerTimeoutError, asyncio.TimeoutError)):
+        if (conn_timeout is not None and isinstance(e, conn_timeout)) or str(e).lower().startswith('connection timeout'):
+            return requests.exceptions.ConnectTimeout(str(e) or 'connect timeout')
+        return requests.exceptions.ReadTimeout(str(e) or 'read timeout')
+    if isinstance(e, aiohttp.ClientError):
+        return requests.exceptions.ConnectionError(str(e) or e.__class__.__name__)
+    return e
+
+async def _fragment_aio_request(method, url, headers, json_body, timeout, proxy_url):
+    sessions = _FRAGMENT_LOOP['sessions']
+    sess = sessions.get(proxy_url)
+    if sess is None or sess.closed:
+        sess = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=FTS_FRAGMENT_KEEPALIVE_SEC), trust_env=True)
+        sessions[proxy_url] = sess
+    tmo = aiohttp.ClientTimeout(total=None, sock_connect=timeout[0], sock_read=timeout[1])
+    try:
+        async with sess.request(method, url, headers=headers, json=json_body, timeout=tmo, proxy=proxy_url or None) as r:
+            content = await r.read()
+            return _FragmentResponse(r.status, dict(r.headers), content, str(r.url))
+    except Exception as e:
+        err = _fragment_aio_error(e)
+        if err is e: raise
+        raise err from e
+
+async def _fragment_aio_close():
+    sessions = _FRAGMENT_LOOP['sessions']
+    for sess in list(sessions.values()):
+        try:
+            await sess.close()
+        except Exception:
+            pass
+    sessions.clear()
+
+def _fragment_shutdown():
+    with _FRAGMENT_LOOP_LOCK:
+        loop = _FRAGMENT_LOOP['loop']
+        _FRAGMENT_LOOP['loop'] = None
+    if loop is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(_fragment_aio_close(), loop).result(5)
+        except Exception as e:
+            logger.debug(f'fragment loop shutdown failed: {e}')
+        loop.call_soon_threadsafe(loop.stop)
+    with _FRAGMENT_SESSIONS_LOCK:
+        pooled = [e['session'] for e in _FRAGMENT_SESSIONS.values()]
+        _FRAGMENT_SESSIONS.clear()
+    for sess in pooled:
+        try:
+            sess.close()
+        except Exception:
+            pass
+
+atexit.register(_fragment_shutdown)
+
+def _fragment_sync_request(method, url, headers, json_body, timeout, jwt, proxy_cfg):
+    pooled = _fragment_session(jwt, proxy_cfg)
+    proxy_url = _fragment_proxy_url(proxy_cfg)
+    try:
+        return pooled['session'].request(method, url, headers=headers, json=json_body, timeout=timeout, proxies={'http': proxy_url, 'https': proxy_url} if proxy_url else None)
+    except requests.exceptions.RequestException:
+        pooled['broken'] = True
+        raise
+
+def _fragment_async_usable(proxy_cfg):
+    if not FTS_FRAGMENT_ASYNC or aiohttp is None: return False
+    proxy_url = _fragment_proxy_url(proxy_cfg)
+    return not proxy_url or proxy_url.startswith('http://')
+
+FTS_FRAGMENT_RATE_LIMITS = os.getenv('FTS_FRAGMENT_RATE_LIMITS', 'global=5:10,order=2:4,wallet=1:3,prices=1:3,user=3:6')
+FTS_FRAGMENT_RATE_MAX_WAIT = float(os.getenv('FTS_FRAGMENT_RATE_MAX_WAIT', '60'))
+FTS_FRAGMENT_429_PENALTY_SEC = float(os.getenv('FTS_FRAGMENT_429_PENALTY_SEC', '5'))
+
+class _TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = max(0.01, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.ts = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now, reserve=0.0):
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        need = 1.0 + min(reserve, self.burst - 1.0)
+        return max(self.blocked_until - now, (need - self.tokens) / self.rate if self.tokens < need else 0.0)
+
+    def take(self):
+        self.tokens -= 1.0
+
+def _parse_rate_limits(spec):
+    out = {}
+    for part in str(spec or '').split(','):
+        try:
+            name, val = part.split('=', 1)
+            rate, burst = val.split(':', 1)
+            out[name.strip()] = _TokenBucket(float(rate), float(burst))
+        except Exception:
+            continue
+    out.setdefault('global', _TokenBucket(5, 10))
+    return out
+
+_RATE_BUCKETS = _parse_rate_limits(FTS_FRAGMENT_RATE_LIMITS)
+_RATE_COND = threading.Condition()
+_RATE_HIGH_WAITING = [0]
+
+def _fragment_high_priority(endpoint):
+    if endpoint == 'order': return True
+    return not threading.current_thread().name.startswith(('FTS-MAINT', 'FTS-TIMERS'))
+
+def _rate_limit_acquire(endpoint):
+    high = _fragment_high_priority(endpoint)
+    buckets = [_RATE_BUCKETS['global']] + ([_RATE_BUCKETS[endpoint]] if endpoint in _RATE_BUCKETS else [])
+    deadline = time.monotonic() + FTS_FRAGMENT_RATE_MAX_WAIT
+    with _RATE_COND:
+        if high: _RATE_HIGH_WAITING[0] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                wait = max(b.delay(now, 0.0 if high else 1.0) for b in buckets)
+                if not high and _RATE_HIGH_WAITING[0]: wait = max(wait, 0.05)
+                if wait <= 0 or now >= deadline:
+                    if wait > 0: logger.debug(f'[RATE] {endpoint}: waited {FTS_FRAGMENT_RATE_MAX_WAIT:g}s, sending anyway')
+                    for b in buckets: b.take()
+                    return
+                _RATE_COND.wait(min(wait, deadline - now, 1.0))
+        finally:
+            if high: _RATE_HIGH_WAITING[0] -= 1
+            _RATE_COND.notify_all()
+
+def _retry_after_sec(headers):
+    raw = str((headers or {}).get('Retry-After') or '').strip()
+    if not raw: return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(raw).timestamp() - time.time())
+    except Exception:
+        return None
+
+def _rate_limit_feedback(endpoint, resp):
+    status = getattr(resp, 'status_code', 0)
+    if status != 429 and status != 503: return
+    sec = _retry_after_sec(getattr(resp, 'headers', None))
+    if sec is None:
+        if status != 429: return
+        sec = FTS_FRAGMENT_429_PENALTY_SEC
+    sec = min(sec, 600.0)
+    with _RATE_COND:
+        until = time.monotonic() + sec
+        for name in ('global', endpoint) if status == 503 or endpoint not in _RATE_BUCKETS else (endpoint,):
+            b = _RATE_BUCKETS.get(name)
+            if b is not None:
+                b.blocked_until = max(b.blocked_until, until)
+                b.tokens = min(b.tokens, 0.0)
+    logger.warning(f'[RATE] {endpoint}: HTTP {status}, pausing for {sec:.0f}s')
+
+FTS_BREAKER_FAILS = int(os.getenv('FTS_BREAKER_FAILS', '5'))
+FTS_BREAKER_COOLDOWN_SEC = float(os.getenv('FTS_BREAKER_COOLDOWN_SEC', '30'))
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+class _FragmentCircuitOpen(requests.exceptions.ConnectTimeout):
+    pass
+
+def _breaker_allow(endpoint):
+    now = time.time()
+    with _BREAKERS_LOCK:
+        br = _BREAKERS.setdefault(endpoint, {'fails': 0, 'open_until': 0.0, 'probing': 0.0})
+        if br['fails'] < FTS_BREAKER_FAILS: return True
+        if now < br['open_until'] or now - br['probing'] < FTS_BREAKER_COOLDOWN_SEC: return False
+        br['probing'] = now
+        logger.info(f'[BREAKER] {endpoint}: half-open, sending probe')
+        return True
+
+def _breaker_is_open(endpoint):
+    with _BREAKERS_LOCK:
+        br = _BREAKERS.get(endpoint)
+        return bool(br) and br['fails'] >= FTS_BREAKER_FAILS and time.time() < br['open_until']
+
+def _breaker_record(endpoint, ok):
+    with _BREAKERS_LOCK:
+        br = _BREAKERS.setdefault(endpoint, {'fails': 0, 'open_until': 0.0, 'probing': 0.0})
+        was_open = br['fails'] >= FTS_BREAKER_FAILS
+        br['probing'] = 0.0
+        if ok:
+            br['fails'] = 0
+            state = 'closed' if was_open else None
+        else:
+            br['fails'] += 1
+            state = None
+            if br['fails'] >= FTS_BREAKER_FAILS:
+                br['open_until'] = time.time() + FTS_BREAKER_COOLDOWN_SEC
+                state = 'open'
+        open_until = br['open_until']
+    if state == 'closed':
+        logger.info(f'[BREAKER] {endpoint}: closed')
+    elif state == 'open':
+        logger.warning(f'[BREAKER] {endpoint}: open for {FTS_BREAKER_COOLDOWN_SEC:g}s')
+    if state and endpoint == 'order':
+        _order_breaker_transition(state, open_until, first=not was_open)
+
+def _breaker_observe(endpoint, resp=None, error=None):
+    if error is not None:
+        if isinstance(error, requests.exceptions.RequestException) and not isinstance(error, _FragmentCircuitOpen):
+            _breaker_record(endpoint, False)
+        return
+    if endpoint == 'order': return
+    _breaker_record(endpoint, getattr(resp, 'status_code', 0) < 500)
+
+def _fragment_dispatch(method, url, headers, json_body, timeout, jwt, proxy_cfg):
+    timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else (float(timeout), float(timeout))
+    if _fragment_async_usable(proxy_cfg):
+        coro = _fragment_aio_request(method, url, dict(headers or {}), json_body, timeout, _fragment_proxy_url(proxy_cfg) or '')
+        return asyncio.run_coroutine_threadsafe(coro, _fragment_loop())
+    return _FRAGMENT_IO_EXECUTOR.submit(_fragment_sync_request, method, url, headers, json_body, timeout, jwt, proxy_cfg)
+
+def _fragment_done(endpoint, fut):
+    err = fut.exception()
+    _breaker_observe(endpoint, None if err is not None else fut.result(), err)
+    if err is None: _rate_limit_feedback(endpoint, fut.result())
+
+def _fragment_submit(method, url, *, headers=None, json_body=None, timeout=20, jwt=None, proxy_cfg=None, endpoint='misc'):
+    if not _breaker_allow(endpoint):
+        fut = Future()
+        fut.set_exception(_FragmentCircuitOpen(f'circuit open for {endpoint}'))
+        return fut
+    _rate_limit_acquire(endpoint)
+    fut = _fragment_dispatch(method, url, headers, json_body, timeout, jwt, proxy_cfg)
+    fut.add_done_callback(lambda f: _fragment_done(endpoint, f))
+    return fut
+
+def _fragment_http(method, url, *, headers=None, json_body=None, timeout=20, jwt=None, proxy_cfg=None, endpoint='misc'):
+    if not _breaker_allow(endpoint):
+        raise _FragmentCircuitOpen(f'circuit open for {endpoint}')
+    _rate_limit_acquire(endpoint)
+    try:
+        if _fragment_async_usable(proxy_cfg):
+            resp = _fragment_dispatch(method, url, headers, json_body, timeout, jwt, proxy_cfg).result()
+        else:
+            timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else (float(timeout), float(timeout))
+            resp = _fragment_sync_request(method, url, headers, json_body, timeout, jwt, proxy_cfg)
+    except Exception as e:
+        _breaker_observe(endpoint, error=e)
+        raise
+    _breaker_observe(endpoint, resp)
+    _rate_limit_feedback(endpoint, resp)
     return resp
+
 def _order_stars(jwt, username, quantity, show_sender=False, webhook_url=None, currency=None, response_url=None, proxy_chat_id=None):
     u = username.lstrip('@').strip()
     cur = _normalize_stars_currency(currency)
     proxy_cfg = _fragment_proxy_cfg(chat_id=proxy_chat_id, jwt=jwt)
-    proxy_kwargs = _fragment_proxy_kwargs(jwt=jwt, chat_id=proxy_chat_id, cfg=proxy_cfg)
+    out = Future()
+    def _done(f):
+        try:
+            _FRAGMENT_IO_EXECUTOR.submit(lambda: out.set_result(_order_stars_result(f, cur, proxy_cfg)))
+        except RuntimeError:
+            out.set_result(_order_stars_result(f, cur, proxy_cfg))
     try:
         payload = {'username': u, 'quantity': quantity, 'show_sender': bool(show_sender)}
         if cur == FTS_CURRENCY_USDT_TON: payload['currency'] = FTS_CURRENCY_USDT_TON
         if response_url: payload['response_url'] = response_url
         elif webhook_url: payload['response_url'] = webhook_url
         _log('info', f'SEND start: {quantity}⭐ → @{u} currency={cur}')
-        with requests.Session() as send_session:
-            r = send_session.post(
-                FRAGMENT_ORDER_STARS,
-                json=payload,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Accept': 'application/json',
-                    'Authorization': f'JWT {jwt}',
-                    'Connection': 'close',
-                },
-                timeout=(FRAGMENT_CONNECT_TIMEOUT, FRAGMENT_READ_TIMEOUT),
-                **proxy_kwargs,
-            )
+        fut = _fragment_submit(
+            'POST',
+            FRAGMENT_ORDER_STARS,
+            json_body=payload,
+            headers={
+                'Content-Type': 'application/json',
+                'Accept': 'application/json',
+                'Authorization': f'JWT {jwt}',
+            },
+            timeout=(FRAGMENT_CONNECT_TIMEOUT, FRAGMENT_READ_TIMEOUT),
+            jwt=jwt,
+            proxy_cfg=proxy_cfg,
+            endpoint='order',
+        )
+    except Exception as e:
+        fut = Future()
+        fut.set_exception(e)
+    fut.add_done_callback(_done)
+    return out
+def _order_stars_result(f, cur, proxy_cfg):
+    try:
+        r = f.result()
         resp_json = None
         ct = (r.headers.get('Content-Type') or '').lower()
         if 'application/json' in ct:
@@ -1918,6 +2905,9 @@ def _order_stars(jwt, username, quantity, show_sender=False, webhook_url=None, c
         body_text = (r.text or '')[:400]
         _log('info' if ok else 'error', f"SEND result: ok={ok} status={r.status_code} currency={cur} order_status={status_val or '-'} flags={','.join(sorted(ok_flags)) or '-'} body={body_text}")
         return {             'ok': ok,             'status': r.status_code,             'text': r.text,             'json': resp_json,             'currency': cur,             'order_status': status_val.upper() if status_val else None,             'fragment_order_id': _fragment_order_id(resp_json)         }
+    except _FragmentCircuitOpen as e:
+        _log('warn', f'SEND skipped: {e}')
+        return {             'ok': False,             'status': 0,             'text': str(e),             'json': None,             'currency': cur,             'network_error': 'circuit_open',             'safe_to_retry': True,             'uncertain': False         }
     except requests.exceptions.ConnectTimeout as e:
         err = _fragment_proxy_redact_error(e, proxy_cfg)
         _log('error', f'SEND connect timeout: {err}')
@@ -1935,18 +2925,91 @@ def _order_stars(jwt, username, quantity, show_sender=False, webhook_url=None, c
         _log('error', f'SEND exception: {err}')
         return {             'ok': False,             'status': 0,             'text': err,             'json': None,             'currency': cur,             'network_error': 'unexpected_error',             'safe_to_retry': False,             'uncertain': False         }
 
-def _send_stars_with_currency_fallback(cardinal, chat_id, cfg, jwt, username, quantity, show_sender=False):
+def _send_stars_deferred(cardinal, chat_id, cfg, jwt, username, quantity, show_sender=False):
     cur = _normalize_stars_currency(cfg.get('stars_currency'))
-    resp = _order_stars_with_retry(jwt, username=username, quantity=quantity, show_sender=show_sender, retry_enabled=bool(cfg.get('retry_liteserver', LITESERVER_RETRY_DEFAULT)), currency=cur, proxy_chat_id=chat_id)
-    if cur == FTS_CURRENCY_USDT_TON and (not (resp or {}).get('ok')) and _cfg_bool(cfg, 'usdt_fallback_to_ton', False) and _is_balance_failure_resp(resp):
+    retry_enabled = bool(cfg.get('retry_liteserver', LITESERVER_RETRY_DEFAULT))
+    out = Future()
+    def _relay(f, fallback=None):
         try:
-            _set_cfg_for_orders(chat_id, stars_currency=FTS_CURRENCY_TON, last_usdt_fallback_reason='USDT balance is not enough for Fragment order', last_usdt_fallback_ts=int(time.time()))
-        except Exception:
-            pass
-        _safe_send(cardinal, chat_id, '⚠️ USDT не хватило для оплаты. Переключаю оплату звёзд на TON и пробую ещё раз…')
-        resp = _order_stars_with_retry(jwt, username=username, quantity=quantity, show_sender=show_sender, retry_enabled=bool(cfg.get('retry_liteserver', LITESERVER_RETRY_DEFAULT)), currency=FTS_CURRENCY_TON, proxy_chat_id=chat_id)
-        resp['_currency_fallback'] = 'usdt_ton->ton'
-    return resp
+            resp = f.result()
+        except Exception as e:
+            out.set_exception(e)
+            return
+        if fallback: resp['_currency_fallback'] = fallback
+        out.set_result(resp)
+    def _first(f):
+        try:
+            resp = f.result()
+        except Exception as e:
+            out.set_exception(e)
+            return
+        if cur == FTS_CURRENCY_USDT_TON and (not (resp or {}).get('ok')) and _cfg_bool(cfg, 'usdt_fallback_to_ton', False) and _is_balance_failure_resp(resp):
+            try:
+                _set_cfg_for_orders(chat_id, stars_currency=FTS_CURRENCY_TON, last_usdt_fallback_reason='USDT balance is not enough for Fragment order', last_usdt_fallback_ts=int(time.time()))
+            except Exception:
+                pass
+            _safe_send(cardinal, chat_id, '⚠️ USDT не хватило для оплаты. Переключаю оплату звёзд на TON и пробую ещё раз…')
+            nxt = _order_stars_deferred(jwt, username=username, quantity=quantity, show_sender=show_sender, retry_enabled=retry_enabled, currency=FTS_CURRENCY_TON, proxy_chat_id=chat_id)
+            nxt.add_done_callback(lambda f2: _relay(f2, 'usdt_ton->ton'))
+            return
+        out.set_result(resp)
+    _order_stars_deferred(jwt, username=username, quantity=quantity, show_sender=show_sender, retry_enabled=retry_enabled, currency=cur, proxy_chat_id=chat_id).add_done_callback(_first)
+    return out
+FTS_BREAKER_PAUSE_LOTS = bool(int(os.getenv('FTS_BREAKER_PAUSE_LOTS', '0')))
+_ORDER_BREAKER = {'owner': None, 'paused': False}
+def _order_breaker_transition(state, open_until, first=False):
+    if state == 'open':
+        _timer_schedule('order_breaker', open_until + 0.5, _order_breaker_probe)
+        if first and FTS_BREAKER_PAUSE_LOTS: _schedule_maint_job('order_breaker_lots', _order_breaker_lots, False)
+        return
+    if _ORDER_BREAKER['paused']: _schedule_maint_job('order_breaker_lots', _order_breaker_lots, True)
+    for it in _order_breaker_held():
+        it['breaker_held'] = False
+        if _CARDINAL_REF is not None and _send_window_allows(it.get('chat_id'), it):
+            _schedule_confirm_send(_CARDINAL_REF, it.get('chat_id'), str(it.get('order_id')) if it.get('order_id') else None)
+def _order_breaker_held():
+    out = []
+    for q in list(_pending_orders.values()):
+        out.extend(it for it in list(q) if it.get('breaker_held') and not it.get('finalized'))
+    return out
+def _order_breaker_probe():
+    held = _order_breaker_held()
+    if not held or _CARDINAL_REF is None: return
+    it = held[0]
+    _order_log('info', 'breaker_probe', oid=it.get('order_id') or 'noid', chat_id=it.get('chat_id'))
+    _schedule_confirm_send(_CARDINAL_REF, it.get('chat_id'), str(it.get('order_id')) if it.get('order_id') else None)
+def _order_breaker_hold(cardinal, chat_id, item):
+    item.update(preconfirmed=True, breaker_held=True)
+    _order_log('warn', 'breaker_hold', oid=item.get('order_id') or 'noid', chat_id=chat_id, qty=item.get('qty'))
+    with _BREAKERS_LOCK:
+        open_until = (_BREAKERS.get('order') or {}).get('open_until') or time.time()
+    _timer_schedule('order_breaker', max(time.time(), open_until) + 0.5, _order_breaker_probe, earliest=True)
+    if not item.get('breaker_notified'):
+        item['breaker_notified'] = True
+        _safe_send(cardinal, chat_id, '⏳ Fragment сейчас временно недоступен. Заказ остаётся в очереди — отправлю звёзды автоматически, как только сервис восстановится.')
+    try:
+        _ORDER_BREAKER['owner'] = _cfg_key_for_orders(chat_id) or _ORDER_BREAKER['owner']
+    except Exception:
+        pass
+def _order_breaker_lots(enabled):
+    owner = _ORDER_BREAKER['owner']
+    if owner is None or _CARDINAL_REF is None: return
+    cfg = _get_cfg(owner)
+    items = _settings_copy(cfg.get('star_lots') or [])
+    if enabled:
+        target = [it for it in items if it.get('breaker_paused')]
+    else:
+        target = [it for it in items if it.get('active')]
+    if not target: return
+    rep = _apply_star_lots_state(_CARDINAL_REF, target, enabled)
+    done = set(rep.get('ok') or [])
+    for it in target:
+        if int(it.get('lot_id') or 0) in done:
+            it['active'] = enabled
+            it['breaker_paused'] = not enabled
+    _ORDER_BREAKER['paused'] = not enabled
+    _set_cfg(owner, star_lots=items, lots_active=any(x.get('active') for x in items))
+    logger.warning(f"[BREAKER] star lots {'resumed' if enabled else 'paused'}: {sorted(done)}")
 def _send_order_result_message(cardinal, chat_id, qty, username, order_url, resp=None):
     st = str((resp or {}).get('order_status') or '').upper()
     cur = _stars_currency_label((resp or {}).get('currency'))
@@ -2588,7 +3651,7 @@ def _classify_send_failure(resp_text, status, username, jwt):
         return ('seller', 'Неверная версия кошелька у продавца или кошелёк не инициализирован.')
     if any((t in low for t in ('username', 'user not found', 'not found', 'invalid', 'does not exist'))):
         return ('username', 'Пользователь с таким @username не найден.')
-    if status == 400 and username and (not _check_username_exists_throttled(username, jwt)):
+    if status == 400 and username and (not _check_username_exists_throttled(username, jwt, fresh=True)):
         return ('username', 'Пользователь с таким @username не найден.')
     if any((t in low for t in ('balance', 'not enough', 'jetton', 'комисс'))):
         return ('seller', reason or 'Недостаточно средств на кошельке Fragment.')
@@ -2605,23 +3668,30 @@ def _auto_refund_order(cardinal, order_id, chat_id, reason):
         cardinal.account.refund(order_id)
         _safe_send(cardinal, chat_id, '✅ Средства успешно возвращены.')
         logger.warning(f'[REFUND] Заказ {order_id}: возврат выполнен. Причина: {reason}')
+        _stats_event('refund_ok', oid=order_id, reason=reason)
         return True
     except Exception as e:
         logger.error(f'[REFUND] Не удалось вернуть средства за заказ {order_id}: {e}')
+        _stats_event('refund_fail', oid=order_id, reason=reason)
         _safe_send(cardinal, chat_id, '❌ Не удалось оформить возврат автоматически. Свяжитесь с админом.')
         return False
-def _coin_unit_for_balance(cfg, cur):
+def _coin_price_model(cfg, cur):
     cur = _normalize_stars_currency(cur)
-    data, src = _fetch_fragment_prices(cfg.get('fragment_jwt'), cfg=cfg)
-    unit = _fragment_unit_price(data, cur) if data is not None else None
-    if unit:
-        return (float(unit), f'Fragment Prices: {unit:g} {_stars_currency_label(cur)} за 1⭐')
-    rates = _tonapi_rates_rub()
+    table, src = _fragment_prices_table(cfg.get('fragment_jwt'), cfg=cfg)
+    model = table['models'].get(cur) if table is not None else None
+    if model:
+        unit = _price_model_unit(model)
+        tiers = f', тарифов: {len(model[0])}' if len(model[0]) > 1 else ''
+        return (model, f'Fragment Prices: {unit:g} {_stars_currency_label(cur)} за 1⭐{tiers}')
+    rates = _rates_rub()
     rate = rates.get('usdt' if cur == FTS_CURRENCY_USDT_TON else 'ton')
     rub = _num(cfg.get('last_auto_price_base_unit') or cfg.get('unit_star_price'))
     if rub and rate:
-        return (float(rub) / float(rate), f'fallback: {rub:g} RUB / {rate:g} RUB')
+        return (_price_model([(1.0, float(rub) / float(rate))]), f'fallback: {rub:g} RUB / {rate:g} RUB')
     return (None, f'не удалось получить стоимость 1⭐ в {_stars_currency_label(cur)} ({src})')
+def _coin_unit_for_balance(cfg, cur):
+    model, info = _coin_price_model(cfg, cur)
+    return (_price_model_unit(model), info)
 def _balance_filter_msg(rows, cur, balance, unit):
     out = [f'<b>🧮 Фильтр лотов по балансу</b>\nБаланс: <code>{balance:g} {_stars_currency_label(cur)}</code>; 1⭐ ≈ <code>{unit:g} {_stars_currency_label(cur)}</code>']
     for r in rows[:60]:
@@ -2635,21 +3705,24 @@ def _apply_balance_lot_filter(cardinal, chat_id, cfg, bal_ton=None, bal_usdt=Non
     cur = _normalize_stars_currency(cfg.get('stars_currency'))
     bal = bal_usdt if cur == FTS_CURRENCY_USDT_TON else bal_ton
     if bal is None:
-        bal = cfg.get('balance_usdt' if cur == FTS_CURRENCY_USDT_TON else 'balance_ton')
+        bal = _wallet_effective_balances(chat_id, cfg, holds=True)[1 if cur == FTS_CURRENCY_USDT_TON else 0]
     if not isinstance(bal, (int, float)):
         return (False, 'Не удалось получить баланс кошелька.')
-    unit, info = _coin_unit_for_balance(cfg, cur)
-    if not unit:
+    model, info = _coin_price_model(cfg, cur)
+    if not model:
         return (False, 'Не удалось посчитать стоимость лотов: ' + info)
+    unit = _price_model_unit(model)
     avail = max(0.0, float(bal) * max(0.0, min(1.0, float(FTS_BALANCE_LOT_RESERVE_RATIO))))
-    items = cfg.get('star_lots') or []
+    items = _settings_copy(cfg.get('star_lots') or [])
+    needs = _price_model_costs(model, [_as_int(it.get('qty'), 0, 0, 10 ** 9) if isinstance(it, dict) else 0 for it in items])
     rows = []
     changed = False
-    for it in items:
+    for it, need in zip(items, needs):
         try:
             qty = int(it.get('qty'))
             lid = int(it.get('lot_id'))
-            need = float(qty) * float(unit)
+            if need is None:
+                continue
             ok = need <= avail + 1e-12
             was = bool(it.get('active'))
             filtered = bool(it.get('balance_filtered'))
@@ -2685,18 +3758,105 @@ def _apply_balance_lot_filter(cardinal, chat_id, cfg, bal_ton=None, bal_usdt=Non
         return (True, f'Фильтр применён: изменено {len(rows)} лот(ов). {info}')
     _set_cfg(chat_id, last_balance_filter_info=f'изменений нет; баланс {float(bal):g} {_stars_currency_label(cur)}, 1⭐≈{float(unit):g}', last_balance_filter_ts=int(time.time()))
     return (True, 'Фильтр проверил лоты: менять нечего. ' + info)
-def _maybe_auto_deactivate(cardinal, cfg, chat_id=None):
-    jwt = cfg.get('fragment_jwt')
-    ver, bal_ton, bal_usdt, _raw = _check_fragment_wallet(jwt, chat_id=chat_id) if jwt else (None, None, None, None)
-    if bal_ton is None and bal_usdt is None:
-        logger.warning('[BALANCE] Не удалось получить баланс Fragment.')
+FTS_WALLET_RECONCILE_SEC = float(os.getenv('FTS_WALLET_RECONCILE_SEC', '600'))
+FTS_WALLET_UNIT_TTL_SEC = float(os.getenv('FTS_WALLET_UNIT_TTL_SEC', '600'))
+FTS_WALLET_HOLD_TTL_SEC = float(os.getenv('FTS_WALLET_HOLD_TTL_SEC', '86400'))
+_WALLET_LEDGER = {'holds': {}, 'spent': {}, 'units': {}, 'read_ts': {}}
+_WALLET_LEDGER_LOCK = threading.RLock()
+def _wallet_owner(chat_id):
+    if chat_id is None: return '__orders__'
+    return str(_cfg_key_for_orders(chat_id) or chat_id)
+def _wallet_unit(owner, cfg, cur, fetch=True):
+    key = (owner, cur)
+    with _WALLET_LEDGER_LOCK:
+        ent = _WALLET_LEDGER['units'].get(key)
+    if ent and time.time() - ent[1] < FTS_WALLET_UNIT_TTL_SEC or not fetch:
+        return ent[0] if ent else None
+    unit, _info = _coin_unit_for_balance(cfg, cur)
+    if not unit: return ent[0] if ent else None
+    with _WALLET_LEDGER_LOCK:
+        _WALLET_LEDGER['units'][key] = (float(unit), time.time())
+    return float(unit)
+def _wallet_reserve(item):
+    oid = item.get('order_id')
+    if not oid or not item.get('chat_id'): return
+    try:
+        cur = _normalize_stars_currency(_get_cfg_for_orders(item['chat_id']).get('stars_currency'))
+        hold = {'owner': _wallet_owner(item['chat_id']), 'cur': cur, 'qty': int(item.get('qty') or 50), 'ts': time.time()}
+    except Exception as e:
+        logger.debug(f'[BALANCE] reserve #{oid} skipped: {e}')
         return
+    with _WALLET_LEDGER_LOCK:
+        _WALLET_LEDGER['holds'][str(oid)] = hold
+def _wallet_settle(oid, spent):
+    if not oid: return
+    with _WALLET_LEDGER_LOCK:
+        hold = _WALLET_LEDGER['holds'].pop(str(oid), None)
+        if hold is None or not spent: return
+        _WALLET_LEDGER['spent'].setdefault((hold['owner'], hold['cur']), []).append((time.time(), hold['qty']))
+    logger.debug(f"[BALANCE] committed #{oid}: {hold['qty']}⭐ {hold['cur']}")
+def _wallet_track(item):
+    if item.queue is None: return
+    stage = item.get('stage')
+    if stage == 'await_confirm' and not item.get('finalized'):
+        _wallet_reserve(item)
+    elif stage in ('await_username', 'await_paid'):
+        _wallet_settle(item.get('order_id'), False)
+def _wallet_reconciled(owner, read_ts):
+    with _WALLET_LEDGER_LOCK:
+        _WALLET_LEDGER['read_ts'][owner] = read_ts
+        for key in [k for k in _WALLET_LEDGER['spent'] if k[0] == owner]:
+            rest = [x for x in _WALLET_LEDGER['spent'][key] if x[0] > read_ts]
+            if rest: _WALLET_LEDGER['spent'][key] = rest
+            else: _WALLET_LEDGER['spent'].pop(key, None)
+def _wallet_effective_balances(chat_id, cfg, holds=True):
+    owner = _wallet_owner(chat_id)
+    out = []
+    for cur, field in ((FTS_CURRENCY_TON, 'balance_ton'), (FTS_CURRENCY_USDT_TON, 'balance_usdt')):
+        bal = cfg.get(field)
+        if not isinstance(bal, (int, float)):
+            out.append(None)
+            continue
+        with _WALLET_LEDGER_LOCK:
+            stars = sum(q for _ts, q in _WALLET_LEDGER['spent'].get((owner, cur), ()))
+            if holds:
+                stars += sum(h['qty'] for h in _WALLET_LEDGER['holds'].values() if h['owner'] == owner and h['cur'] == cur)
+        unit = _wallet_unit(owner, cfg, cur) if stars else None
+        out.append(max(0.0, float(bal) - stars * unit) if unit else float(bal))
+    return tuple(out)
+def _wallet_reconcile_tick(cardinal):
+    now = time.time()
+    try:
+        with _WALLET_LEDGER_LOCK:
+            for oid in [k for k, h in _WALLET_LEDGER['holds'].items() if now - h['ts'] > FTS_WALLET_HOLD_TTL_SEC]:
+                _WALLET_LEDGER['holds'].pop(oid, None)
+            owners = {k[0] for k in _WALLET_LEDGER['spent']} | {h['owner'] for h in _WALLET_LEDGER['holds'].values()}
+            owners = [o for o in owners if now - _WALLET_LEDGER['read_ts'].get(o, 0) >= FTS_WALLET_RECONCILE_SEC]
+        for owner in owners:
+            cfg = _get_cfg(owner)
+            if cfg.get('fragment_jwt'):
+                _schedule_maint_job(f'wallet_reconcile:{owner}', _maybe_auto_deactivate, cardinal, cfg, owner)
+    finally:
+        _timer_schedule('wallet', time.time() + max(30.0, FTS_WALLET_RECONCILE_SEC / 4), _wallet_reconcile_tick, cardinal)
+def _maybe_auto_deactivate(cardinal, cfg, chat_id=None, refresh=True):
+    jwt = cfg.get('fragment_jwt')
     owner_chat = _cfg_key_for_orders(chat_id) if chat_id is not None else '__orders__'
-    if jwt:
+    if not refresh:
+        bal_ton, bal_usdt = _wallet_effective_balances(chat_id, cfg)
+        refresh = bal_ton is None and bal_usdt is None
+    if refresh:
+        read_ts = time.time()
+        ver, bal_ton, bal_usdt, _raw = _check_fragment_wallet(jwt, chat_id=chat_id) if jwt else (None, None, None, None)
+        if bal_ton is None and bal_usdt is None:
+            logger.warning('[BALANCE] Не удалось получить баланс Fragment.')
+            return
+        _wallet_reconciled(_wallet_owner(chat_id), min(read_ts, float((_raw or {}).get('_fetched_ts') or read_ts)))
+    if refresh and jwt:
         try:
             _set_cfg(owner_chat, wallet_version=ver, balance_ton=round(bal_ton, 6) if isinstance(bal_ton, (int, float)) else None, balance_usdt=round(bal_usdt, 6) if isinstance(bal_usdt, (int, float)) else None, last_wallet_raw=_raw)
         except Exception:
             pass
+        bal_ton, bal_usdt = _wallet_effective_balances(chat_id, dict(cfg, balance_ton=bal_ton, balance_usdt=bal_usdt), holds=True)
     try:
         if cardinal is not None and chat_id is not None:
             _maybe_auto_price_update(cardinal, chat_id)
@@ -2717,7 +3877,7 @@ def _maybe_auto_deactivate(cardinal, cfg, chat_id=None):
             return
         if isinstance(bal_usdt, (int, float)) and bal_usdt < thr_usdt and cfg.get('auto_deactivate', False):
             cat_id = FNP_STARS_CATEGORY_ID
-            items = cfg.get('star_lots') or []
+            items = _settings_copy(cfg.get('star_lots') or [])
             known_ids = _managed_lot_ids_from_cfg(cfg)
             rep = _apply_category_state(cardinal, cat_id, False, known_lot_ids=known_ids)
             ok_ids = set(_sanitize_lot_ids(rep.get('ok') or []))
@@ -2727,11 +3887,12 @@ def _maybe_auto_deactivate(cardinal, cfg, chat_id=None):
             managed_ids = _merge_lot_ids(known_ids, _ids_from_report(rep))
             _set_cfg(owner_chat, lots_active=any((bool(x.get('active')) for x in items)), star_lots=items, managed_lot_ids=managed_ids, last_auto_deact_reason=f'Баланс {bal_usdt} USDT < порога {thr_usdt}', last_lot_toggle_report=f'auto_deactivate_usdt: {_lot_report_short(rep)}', last_lot_toggle_ts=int(time.time()))
             logger.warning(f'[AUTODEACT] USDT balance {bal_usdt} < {thr_usdt}. Выключены лоты категории {cat_id}. Managed={managed_ids}. Report={rep}')
+            _stats_event('auto_deact', cur=FTS_CURRENCY_USDT_TON)
         return
     thr = float(cfg.get('min_balance_ton') or FNP_MIN_BALANCE_TON)
     if bal_ton is not None and bal_ton < thr and cfg.get('auto_deactivate', False):
         cat_id = FNP_STARS_CATEGORY_ID
-        items = cfg.get('star_lots') or []
+        items = _settings_copy(cfg.get('star_lots') or [])
         known_ids = _managed_lot_ids_from_cfg(cfg)
         rep = _apply_category_state(cardinal, cat_id, False, known_lot_ids=known_ids)
         ok_ids = set(_sanitize_lot_ids(rep.get('ok') or []))
@@ -2741,6 +3902,7 @@ def _maybe_auto_deactivate(cardinal, cfg, chat_id=None):
         managed_ids = _merge_lot_ids(known_ids, _ids_from_report(rep))
         _set_cfg(owner_chat, lots_active=any((bool(x.get('active')) for x in items)), star_lots=items, managed_lot_ids=managed_ids, last_auto_deact_reason=f'Баланс {bal_ton} TON < порога {thr}', last_lot_toggle_report=f'auto_deactivate_ton: {_lot_report_short(rep)}', last_lot_toggle_ts=int(time.time()))
         logger.warning(f'[AUTODEACT] Баланс {bal_ton} TON < {thr}. Выключены лоты категории {cat_id}. Managed={managed_ids}. Report={rep}')
+        _stats_event('auto_deact', cur=FTS_CURRENCY_TON)
 CBT_HOME = f'{UUID}:home'
 CBT_SETTINGS = f'{UUID}:settings'
 CBT_INFO = f'{UUID}:info'
@@ -2974,7 +4136,8 @@ def _proxy_settings_text(chat_id):
     return (
         '<b>🌐 Прокси для Fragment API</b>\n\n'
         f'• Состояние: <b>{_h(state)}</b>\n'
-        f'{details}{error_line}\n\n'
+        f'{details}{error_line}\n'
+        f'• Кэш адресов API (попаданий/промахов): <code>{_endpoint_stats_text()}</code>\n\n'
         'Через этот прокси идут только запросы к Fragment API: проверка пользователя, '
         'баланс, цены и отправка звёзд. FunPay, обновление плагина и другие сервисы его не используют.\n\n'
         'При вводе логина или пароля отправьте <code>-</code>, если авторизация не нужна.'
@@ -3267,7 +4430,7 @@ def _order_tools_text(chat_id):
     watch_every = _fmt_minutes_from_sec(cfg.get('order_watch_interval_sec', ORDER_WATCH_INTERVAL_DEFAULT))
     wait_after = _fmt_minutes_from_sec(cfg.get('order_wait_reminder_sec', ORDER_WAIT_REMINDER_DEFAULT))
     review_after = _fmt_minutes_from_sec(cfg.get('order_review_reminder_sec', ORDER_REVIEW_REMINDER_DEFAULT))
-    recs = _get_order_records()
+    recs = _query_order_records()
     active = 0
     sent = 0
     try:
@@ -3366,6 +4529,7 @@ def _import_settings_payload(raw_text):
         if not isinstance(settings_obj, dict):
             return (False, 'В резервной копии нет объекта settings.')
         ts = time.strftime('%Y%m%d-%H%M%S')
+        _flush_settings()
         try:
             if os.path.exists(SETTINGS_FILE):
                 shutil.copy2(SETTINGS_FILE, SETTINGS_FILE + f'.import.{ts}.bak')
@@ -3373,7 +4537,9 @@ def _import_settings_payload(raw_text):
                 shutil.copy2(ORDERS_FILE, ORDERS_FILE + f'.import.{ts}.bak')
         except Exception:
             pass
-        _atomic_write_json(SETTINGS_FILE, settings_obj)
+        with _SETTINGS_IO_LOCK:
+            _atomic_write_json(SETTINGS_FILE, settings_obj)
+            _settings_cache_drop()
         if orders_obj is not None:
             _save_orders_db(orders_obj)
         moved, removed = _migrate_orders_storage()
@@ -3576,7 +4742,7 @@ def _msg_reset(bot, call):
     chat_id = call.message.chat.id
     key = call.data.split(':')[-1]
     cfg = _get_cfg(chat_id)
-    tpls = cfg.get('templates') or {}
+    tpls = _settings_copy(cfg.get('templates') or {})
     defaults = _default_templates()
     if key in defaults:
         tpls[key] = defaults[key]
@@ -3671,7 +4837,7 @@ def _mentions_account_login(text):
     return any((_re.search(p, t) for p in patterns))
 def _deactivate_all_star_lots(cardinal, cfg, chat_id, reason='временная ошибка/невалидный заказ'):
     try:
-        items = cfg.get('star_lots') or []
+        items = _settings_copy(cfg.get('star_lots') or [])
         known_ids = _managed_lot_ids_from_cfg(cfg)
         rep = {'ok': [], 'skip': [], 'err': []}
         if _CARDINAL_REF is not None:
@@ -3762,12 +4928,13 @@ def _fetch_fragment_prices(jwt, chat_id=None, cfg=None):
     if jwt:
         headers['Authorization'] = f'JWT {jwt}'
     proxy_cfg = cfg if isinstance(cfg, dict) else _fragment_proxy_cfg(chat_id=chat_id, jwt=jwt)
-    proxy_kwargs = _fragment_proxy_kwargs(jwt=jwt, chat_id=chat_id, cfg=proxy_cfg)
     last = ''
-    for url in FRAGMENT_PRICES_URLS:
+    cands, learned = _endpoint_candidates('prices', [(u, 'jwt') for u in FRAGMENT_PRICES_URLS])
+    for i, (url, _mode) in enumerate(cands):
         try:
-            r = _HTTP.get(url, headers=headers, timeout=20, **proxy_kwargs)
+            r = _fragment_http('GET', url, headers=headers, timeout=20, jwt=jwt, proxy_cfg=proxy_cfg, endpoint='prices')
             if r.status_code < 400:
+                _endpoint_result('prices', url, 'jwt', learned and i == 0)
                 try:
                     return (r.json(), url)
                 except Exception:
@@ -3790,12 +4957,11 @@ def _qty_from_node(d):
         if v and v > 0:
             return v
     return None
-def _fragment_unit_price(data, currency):
-    cur = _normalize_stars_currency(currency)
-    best = None
+def _fragment_price_table(data):
+    tiers = {FTS_CURRENCY_TON: {}, FTS_CURRENCY_USDT_TON: {}}
     for d in _price_nodes(data):
-        q = _qty_from_node(d)
-        vals = []
+        q = float(_qty_from_node(d) or 1.0)
+        node_cur = str(d.get('currency', '')).lower()
         for k, v in d.items():
             lk = str(k).lower()
             if 'fee' in lk or 'commission' in lk:
@@ -3803,37 +4969,114 @@ def _fragment_unit_price(data, currency):
             n = _num(v)
             if n is None or n <= 0:
                 continue
-            if cur == FTS_CURRENCY_USDT_TON and ('usdt' in lk and 'price' in lk or (str(d.get('currency', '')).lower() in ('usdt', 'usdt_ton') and lk in ('price', 'amount', 'cost', 'total'))):
-                vals.append(n)
-            if cur == FTS_CURRENCY_TON and ('ton' in lk and 'price' in lk and ('usdt' not in lk) or (str(d.get('currency', '')).lower() == 'ton' and lk in ('price', 'amount', 'cost', 'total'))):
-                vals.append(n)
-        for price in vals:
-            unit = price / q if q else price
-            if unit > 0 and (best is None or unit < best):
-                best = unit
-    return best
-def _tonapi_rates_rub():
+            generic = lk in ('price', 'amount', 'cost', 'total')
+            if 'usdt' in lk and 'price' in lk or (node_cur in ('usdt', 'usdt_ton') and generic):
+                cur = FTS_CURRENCY_USDT_TON
+            elif 'ton' in lk and 'price' in lk or (node_cur == 'ton' and generic):
+                cur = FTS_CURRENCY_TON
+            else:
+                continue
+            prev = tiers[cur].get(q)
+            if prev is None or n < prev:
+                tiers[cur][q] = float(n)
+    table = {'tiers': {}, 'units': {}, 'models': {}}
+    for cur, rows in tiers.items():
+        table['tiers'][cur] = sorted(rows.items())
+        units = [price / qty for qty, price in rows.items()]
+        table['units'][cur] = min(units) if units else None
+        table['models'][cur] = _price_model(table['tiers'][cur])
+    return table
+def _fragment_unit_price(data, currency):
+    table = data if isinstance(data, dict) and 'units' in data and 'tiers' in data else _fragment_price_table(data)
+    return table['units'].get(_normalize_stars_currency(currency))
+def _price_model(tiers, scale=1.0):
+    rows = [(float(q), float(p) * scale) for q, p in tiers if q and q > 0 and p and p > 0]
+    if not rows:
+        return None
+    return (tuple(q for q, _p in rows), tuple(p for _q, p in rows))
+def _price_model_unit(model):
+    return min(p / q for q, p in zip(*model)) if model else None
+def _price_model_cost(model, qty, i=None):
+    qs, costs = model
+    q = float(qty)
+    if i is None:
+        i = bisect.bisect_right(qs, q)
+    if i == 0:
+        return costs[0] * q / qs[0]
+    if i >= len(qs):
+        return costs[-1] * q / qs[-1]
+    lo = i - 1
+    return costs[lo] + (costs[i] - costs[lo]) * (q - qs[lo]) / (qs[i] - qs[lo])
+def _price_model_costs(model, qtys):
+    out = [None] * len(qtys)
+    if not model:
+        return out
+    qs = model[0]
+    i = 0
+    for pos in sorted(range(len(qtys)), key=lambda k: float(qtys[k] or 0)):
+        q = float(qtys[pos] or 0)
+        if q <= 0:
+            continue
+        while i < len(qs) and qs[i] <= q:
+            i += 1
+        out[pos] = _price_model_cost(model, q, i)
+    return out
+FTS_PRICE_TABLE_TTL_SEC = float(os.getenv('FTS_PRICE_TABLE_TTL_SEC', '120'))
+_PRICE_TABLES = {}
+_PRICE_TABLES_LOCK = threading.Lock()
+def _fragment_prices_table(jwt, chat_id=None, cfg=None, max_age=None):
+    proxy_cfg = cfg if isinstance(cfg, dict) else _fragment_proxy_cfg(chat_id=chat_id, jwt=jwt)
+    key = _wallet_cache_key(jwt, proxy_cfg)
+    now = time.time()
+    with _PRICE_TABLES_LOCK:
+        ent = _PRICE_TABLES.setdefault(key, {'table': None, 'src': '', 'ts': 0.0, 'fut': None, 'used_ts': now, 'jwt': jwt, 'cfg': proxy_cfg})
+        ent['used_ts'] = now
+        ttl = FTS_PRICE_TABLE_TTL_SEC if max_age is None else min(FTS_PRICE_TABLE_TTL_SEC, float(max_age))
+        fut = ent['fut']
+        if ent['table'] is not None and now - ent['ts'] < ttl:
+            return (ent['table'], ent['src'])
+        leader = fut is None
+        if leader:
+            fut = ent['fut'] = Future()
+    if not leader:
+        return fut.result()
+    result = (None, '')
+    try:
+        data, src = _fetch_fragment_prices(jwt, chat_id=chat_id, cfg=proxy_cfg)
+        result = (_fragment_price_table(data) if data is not None else None, src)
+        if result[0] is not None:
+            with _PRICE_TABLES_LOCK:
+                ent.update(table=result[0], src=src, ts=now)
+    finally:
+        with _PRICE_TABLES_LOCK:
+            ent['fut'] = None
+        fut.set_result(result)
+    return result
+def _price_table_refresh_tick():
+    now = time.time()
+    try:
+        with _PRICE_TABLES_LOCK:
+            for key in [k for k, e in _PRICE_TABLES.items() if now - e['used_ts'] > FTS_PRICE_TABLE_TTL_SEC * 10 and e['fut'] is None]:
+                _PRICE_TABLES.pop(key, None)
+            hot = [(k, e['jwt'], e['cfg']) for k, e in _PRICE_TABLES.items() if e['fut'] is None and now - e['ts'] >= FTS_PRICE_TABLE_TTL_SEC * 0.8]
+        for key, jwt, proxy_cfg in hot:
+            _schedule_maint_job(f'price_table:{key[0]}:{key[1]}', _fragment_prices_table, jwt, None, proxy_cfg, 0)
+    finally:
+        _timer_schedule('price_table', time.time() + FTS_PRICE_TABLE_TTL_SEC * 0.8, _price_table_refresh_tick)
+FTS_RATES_TTL_SEC = float(os.getenv('FTS_RATES_TTL_SEC', '300'))
+FTS_RATES_STALE_SEC = float(os.getenv('FTS_RATES_STALE_SEC', '3600'))
+FTS_RATES_DEADLINE_SEC = float(os.getenv('FTS_RATES_DEADLINE_SEC', '15'))
+_RATES_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='FTS-RATES')
+_RATES = {'value': {}, 'ts': 0.0, 'fut': None, 'latency': {}, 'fails': defaultdict(int)}
+_RATES_LOCK = threading.Lock()
+def _rate_val(x):
+    n = _num(x)
+    return float(n) if n is not None and n > 0 else None
+def _rate_src_tonapi(deadline):
     hdr = {'Accept': 'application/json'}
     if TONAPI_KEY:
         hdr['Authorization'] = f'Bearer {TONAPI_KEY}'
-    out = {'ton': None, 'usdt': None}
-    def val(x):
-        n = _num(x)
-        return float(n) if n is not None and n > 0 else None
-    def usd_rub():
-        for url, params, path in (('https://api.coingecko.com/api/v3/simple/price', {'ids': 'tether', 'vs_currencies': 'rub'}, ('tether', 'rub')), ('https://open.er-api.com/v6/latest/USD', None, ('rates', 'RUB'))):
-            try:
-                r = _HTTP.get(url, params=params, headers={'Accept': 'application/json'}, timeout=10)
-                data = r.json()
-                cur = data
-                for k in path:
-                    cur = cur.get(k) if isinstance(cur, dict) else None
-                n = val(cur)
-                if n:
-                    return n
-            except Exception:
-                pass
-        return None
+    out = {}
     def from_rates(data, aliases):
         rr = data.get('rates') if isinstance(data, dict) else None
         if isinstance(rr, dict):
@@ -3843,50 +5086,134 @@ def _tonapi_rates_rub():
                     continue
                 prices = node.get('prices') if isinstance(node, dict) else {}
                 if isinstance(prices, dict):
-                    rub = val(prices.get('RUB') or prices.get('rub') or prices.get('RUR') or prices.get('rur'))
-                    usd = val(prices.get('USD') or prices.get('usd'))
-                    if rub:
-                        return rub
-                    ur = usd_rub()
-                    if usd and ur:
-                        return usd * ur
-        return None
-    for tokens in (f'{TONAPI_TON_TOKEN},{TONAPI_USDT_TOKEN}', 'ton', TONAPI_TON_TOKEN, TONAPI_USDT_TOKEN):
-        try:
-            r = _HTTP.get(TONAPI_RATES_URL, params={'tokens': tokens, 'currencies': 'rub,usd'}, headers=hdr, timeout=15)
-            if r.status_code >= 400:
-                continue
-            data = r.json()
-            out['ton'] = out['ton'] or from_rates(data, ('ton', 'toncoin'))
-            out['usdt'] = out['usdt'] or from_rates(data, ('usdt', 'tether'))
-        except Exception as e:
-            logger.debug(f'TonAPI rates attempt failed: {e}')
-    if not out['ton'] or not out['usdt']:
-        try:
-            r = _HTTP.get('https://api.coingecko.com/api/v3/simple/price', params={'ids': 'the-open-network,tether', 'vs_currencies': 'rub'}, headers={'Accept': 'application/json'}, timeout=10)
-            data = r.json()
-            out['ton'] = out['ton'] or val((data.get('the-open-network') or {}).get('rub'))
-            out['usdt'] = out['usdt'] or val((data.get('tether') or {}).get('rub'))
-        except Exception as e:
-            logger.debug(f'CoinGecko fallback failed: {e}')
-    out['usdt'] = out['usdt'] or usd_rub()
+                    rub = _rate_val(prices.get('RUB') or prices.get('rub') or prices.get('RUR') or prices.get('rur'))
+                    usd = _rate_val(prices.get('USD') or prices.get('usd'))
+                    if rub or usd:
+                        return (rub, usd)
+        return (None, None)
+    tokens = ','.join(dict.fromkeys(('ton', TONAPI_TON_TOKEN, TONAPI_USDT_TOKEN)))
+    r = _HTTP.get(TONAPI_RATES_URL, params={'tokens': tokens, 'currencies': 'rub,usd'}, headers=hdr, timeout=_rates_timeout(deadline, 15))
+    if r.status_code >= 400:
+        return out
+    data = r.json()
+    for name, aliases in (('ton', ('ton', 'toncoin')), ('usdt', ('usdt', 'tether'))):
+        rub, usd = from_rates(data, aliases)
+        if rub: out.setdefault(name, rub)
+        if usd: out.setdefault(name + '_usd', usd)
+    return out
+def _rate_src_coingecko(deadline):
+    r = _HTTP.get('https://api.coingecko.com/api/v3/simple/price', params={'ids': 'the-open-network,tether', 'vs_currencies': 'rub'}, headers={'Accept': 'application/json'}, timeout=_rates_timeout(deadline, 10))
+    data = r.json()
+    out = {'ton': _rate_val((data.get('the-open-network') or {}).get('rub')), 'usdt': _rate_val((data.get('tether') or {}).get('rub'))}
+    if out['usdt']: out['usd_rub'] = out['usdt']
     return {k: v for k, v in out.items() if v}
-def _auto_unit_price_rub(cfg):
-    data, src = _fetch_fragment_prices(cfg.get('fragment_jwt'), cfg=cfg)
-    if data is None:
-        return (None, f'Не удалось получить Fragment Prices: {src}', None)
+def _rate_src_er_api(deadline):
+    r = _HTTP.get('https://open.er-api.com/v6/latest/USD', headers={'Accept': 'application/json'}, timeout=_rates_timeout(deadline, 10))
+    usd_rub = _rate_val(((r.json() or {}).get('rates') or {}).get('RUB'))
+    return {'usd_rub': usd_rub} if usd_rub else {}
+_RATE_SOURCES = (('tonapi', _rate_src_tonapi), ('coingecko', _rate_src_coingecko), ('er-api', _rate_src_er_api))
+def _rates_timeout(deadline, cap):
+    return max(0.5, min(float(cap), deadline - time.monotonic()))
+def _rates_timed(name, fn, deadline):
+    started = time.monotonic()
+    if started >= deadline: return {}
+    try:
+        return fn(deadline)
+    except Exception as e:
+        with _RATES_LOCK:
+            _RATES['fails'][name] += 1
+        logger.debug(f'[RATES] {name} failed: {e}')
+        return {}
+    finally:
+        ms = (time.monotonic() - started) * 1000.0
+        with _RATES_LOCK:
+            prev = _RATES['latency'].get(name)
+            _RATES['latency'][name] = ms if prev is None else prev * 0.7 + ms * 0.3
+def _rates_resolve(merged):
+    out = {k: merged[k] for k in ('ton', 'usdt') if merged.get(k)}
+    usd_rub = merged.get('usd_rub')
+    if usd_rub:
+        if 'ton' not in out and merged.get('ton_usd'): out['ton'] = merged['ton_usd'] * usd_rub
+        if 'usdt' not in out: out['usdt'] = (merged.get('usdt_usd') or 1.0) * usd_rub
+    return out
+def _rates_fetch():
+    merged = {}
+    deadline = time.monotonic() + FTS_RATES_DEADLINE_SEC
+    futs = {_RATES_EXECUTOR.submit(_rates_timed, name, fn, deadline): name for name, fn in _RATE_SOURCES}
+    pending = set(futs)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done: break
+            for f in done:
+                for k, v in (f.result() or {}).items():
+                    merged.setdefault(k, v)
+            out = _rates_resolve(merged)
+            if 'ton' in out and 'usdt' in out:
+                return out
+        return _rates_resolve(merged)
+    finally:
+        for f in pending:
+            f.cancel()
+def _rates_refresh():
+    with _RATES_LOCK:
+        fut = _RATES['fut']
+        if fut is not None: return fut
+        fut = _RATES['fut'] = Future()
+    value = {}
+    try:
+        value = _rates_fetch()
+    finally:
+        with _RATES_LOCK:
+            if value:
+                merged = dict(_RATES['value'])
+                merged.update(value)
+                _RATES.update(value=merged, ts=time.time())
+            _RATES['fut'] = None
+            latency = ', '.join(f'{k}={v:.0f}ms' for k, v in _RATES['latency'].items())
+        fut.set_result(value)
+    logger.debug(f'[RATES] refreshed {value}; latency {latency}')
+    return fut
+def _rates_rub():
+    with _RATES_LOCK:
+        value, age, fut = dict(_RATES['value']), time.time() - _RATES['ts'], _RATES['fut']
+    if value and age < FTS_RATES_TTL_SEC:
+        return value
+    if value and age < FTS_RATES_STALE_SEC:
+        if fut is None: _RATES_EXECUTOR.submit(_rates_refresh)
+        return value
+    fut = _rates_refresh()
+    try:
+        fut.result(timeout=FTS_RATES_DEADLINE_SEC + 5)
+    except Exception:
+        pass
+    with _RATES_LOCK:
+        return dict(_RATES['value'])
+def _auto_price_model_rub(cfg):
+    table, src = _fragment_prices_table(cfg.get('fragment_jwt'), cfg=cfg)
+    if table is None:
+        return (None, f'Не удалось получить Fragment Prices: {src}')
     cur = _normalize_stars_currency(cfg.get('stars_currency'))
-    unit = _fragment_unit_price(data, cur)
-    if not unit:
-        return (None, 'Не смог найти цену звёзд в ответе Fragment Prices. Проверьте FRAGMENT_PRICES_URL.', None)
-    rates = _tonapi_rates_rub()
+    tiers = table['tiers'].get(cur) or []
+    if not tiers:
+        return (None, 'Не смог найти цену звёзд в ответе Fragment Prices. Проверьте FRAGMENT_PRICES_URL.')
+    rates = _rates_rub()
     rub = rates.get('usdt' if cur == FTS_CURRENCY_USDT_TON else 'ton')
     if not rub:
-        return (None, 'Не удалось получить курс RUB через TonAPI и резервные источники. Проверьте интернет/FTS_TONAPI_KEY или задайте цену за 1⭐ вручную.', None)
-    base = float(unit) * float(rub)
+        return (None, 'Не удалось получить курс RUB через TonAPI и резервные источники. Проверьте интернет/FTS_TONAPI_KEY или задайте цену за 1⭐ вручную.')
     markup_percent = float(cfg.get('markup_percent') or 0.0)
-    final = base * (1.0 + markup_percent / 100.0)
-    return (final, f'без наценки: {base:.6f} RUB за 1⭐; с наценкой {markup_percent:g}%: {final:.6f} RUB за 1⭐ ({unit:g} {_stars_currency_label(cur)} × {rub:g} RUB)', base)
+    return ({'cur': cur, 'rub': float(rub), 'markup': markup_percent, 'coin': _price_model(tiers), 'base': _price_model(tiers, float(rub)), 'final': _price_model(tiers, float(rub) * (1.0 + markup_percent / 100.0))}, src)
+def _auto_unit_price_rub(cfg, qty=None):
+    pm, err = _auto_price_model_rub(cfg)
+    if pm is None:
+        return (None, err, None)
+    if qty:
+        unit = _price_model_cost(pm['coin'], qty) / float(qty)
+        base = _price_model_cost(pm['base'], qty) / float(qty)
+        final = _price_model_cost(pm['final'], qty) / float(qty)
+    else:
+        unit, base, final = (_price_model_unit(pm[k]) for k in ('coin', 'base', 'final'))
+    return (final, f"без наценки: {base:.6f} RUB за 1⭐; с наценкой {pm['markup']:g}%: {final:.6f} RUB за 1⭐ ({unit:g} {_stars_currency_label(pm['cur'])} × {pm['rub']:g} RUB)", base)
 def _temporary_money_round(value):
     return math.floor((float(value) + 1e-12) * 100.0 + 0.5) / 100.0
 
@@ -3941,7 +5268,7 @@ def _temporary_lot_quote(cfg, qty):
     base_unit = _as_float_cfg(cfg.get('last_auto_price_base_unit'), None, 0.0)
     auto_info = None
     if not unit:
-        unit, auto_info, base_unit = _auto_unit_price_rub(cfg)
+        unit, auto_info, base_unit = _auto_unit_price_rub(cfg, qty)
         source = 'цена Fragment, курс в RUB и текущая наценка плагина'
     if not unit or unit <= 0:
         return None, None, (
@@ -4665,6 +5992,7 @@ def _price_changes_text(rows, title):
         out.append(f'… и ещё {len(rows) - 60} лот(ов)')
     return '\n'.join(out)
 def _notify_price_changes(cardinal, chat_id, rows, title):
+    if rows: _stats_event('price_update', qty=len(rows))
     if rows and _cfg_bool(_get_cfg(chat_id), 'price_change_notifications', True):
         try:
             cardinal.telegram.bot.send_message(chat_id, _price_changes_text(rows, title), parse_mode='HTML')
@@ -4675,7 +6003,8 @@ def _apply_auto_prices(cardinal, chat_id, manual=False):
     unit, info, base_unit = _auto_unit_price_rub(cfg)
     if not unit:
         return (False, f'⚠️ Автообновление не удалось.\n{_h(info)}')
-    rows, skipped = _collect_unit_price_targets(cardinal, cfg, unit, base_unit)
+    pm, _src = _auto_price_model_rub(cfg)
+    rows, skipped = _collect_unit_price_targets(cardinal, cfg, unit, base_unit, model=pm)
     if not rows:
         return (False, f'⚠️ Лотов для обновления не найдено. Пропущено: {skipped}')
     rep = _apply_markup_prices(cardinal, rows)
@@ -4758,16 +6087,172 @@ def _html_lot_id_from_href(href):
         return int(m.group(1)) if m else None
     except Exception:
         return None
-def _extract_price_from_lot_html(chunk, plain=None):
-    plain = plain if plain is not None else _html.unescape(_re.sub('<[^>]+>', ' ', chunk or ''))
-    patterns = ('(?:data-s|data-price|data-cost|data-value)=["\\\']([^"\\\']+)["\\\']', 'class=["\\\'][^"\\\']*(?:tc-price|price)[^"\\\']*["\\\'][^>]*>(.{0,160}?)(?:</|$)', '(\\d[\\d\\s\\u00a0\\u202f.,]{0,16})\\s*(?:₽|руб\\.?|RUB)\\b')
-    for pat in patterns:
-        vals = _re.findall(pat, chunk or plain, _re.I | _re.S)
-        for val in reversed(vals):
-            v = _num(_html.unescape(_re.sub('<[^>]+>', ' ', str(val))))
-            if v is not None and v > 0:
-                return float(v)
-    return None
+FTS_COMPETITOR_REUSE_SEC = float(os.getenv('FTS_COMPETITOR_REUSE_SEC', '60'))
+FTS_COMPETITOR_SOURCE_TTL_SEC = float(os.getenv('FTS_COMPETITOR_SOURCE_TTL_SEC', '3600'))
+_FUNPAY_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='FTS-FUNPAY')
+_FUNPAY_PAGES = {}
+_COMPETITOR_SOURCE = {}
+_COMPETITOR_LOCK = threading.Lock()
+class _TcItemParser(HTMLParser):
+    VOID = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'))
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.links = []
+        self.cur = None
+        self.stack = []
+        self.field = None
+        self.field_depth = 0
+        self.buf = []
+
+    def _offer_href(self, href):
+        if not href or not _re.search('(?:lots|chips)/offer|[?&](?:id|offer)=\\d', href):
+            return None
+        return 'https://funpay.com' + href if href.startswith('/') else href
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        a = dict(attrs)
+        cls = (a.get('class') or '').split()
+        if self.cur is not None and 'tc-item' in cls and tag not in self.VOID:
+            self._end_row()
+        if self.cur is None:
+            if 'tc-item' in cls:
+                self.cur = {'href': self._offer_href(a.get('href')), 'desc': [], 'text': [], 'price': None, 'amount': None, 'seller': [], 'anchor': False}
+            elif tag == 'a' and self._offer_href(a.get('href')):
+                self.cur = {'href': self._offer_href(a.get('href')), 'desc': [], 'text': [], 'price': None, 'amount': None, 'seller': [], 'anchor': True}
+            else:
+                return
+            self.stack = []
+        if tag in self.VOID:
+            return
+        self.stack.append(tag)
+        if not self.cur['href'] and tag == 'a':
+            self.cur['href'] = self._offer_href(a.get('href'))
+        if self.field is None:
+            for key, names in (('price', ('tc-price',)), ('amount', ('tc-amount',)), ('desc', ('tc-desc-text', 'tc-desc')), ('seller', ('media-user-name',))):
+                if any(n in cls for n in names):
+                    self.field, self.field_depth = key, len(self.stack)
+                    if key in ('price', 'amount') and _num(a.get('data-s')):
+                        self.cur[key] = float(_num(a.get('data-s')))
+                    break
+
+    def handle_startendtag(self, tag, attrs):
+        if self.cur is not None or tag not in self.VOID:
+            self.handle_starttag(tag, attrs)
+            if tag not in self.VOID:
+                self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self._flush()
+        if self.cur is None or tag not in self.stack:
+            return
+        while self.stack.pop() != tag:
+            pass
+        if self.field is not None and len(self.stack) < self.field_depth:
+            self.field = None
+        if not self.stack:
+            self._end_row()
+
+    def _end_row(self):
+        self._flush()
+        self._emit(self.cur)
+        self.cur = None
+        self.stack = []
+        self.field = None
+
+    def close(self):
+        super().close()
+        if self.cur is not None:
+            self._end_row()
+
+    def handle_data(self, data):
+        if self.cur is not None:
+            self.buf.append(data)
+
+    def _flush(self):
+        data = ''.join(self.buf)
+        self.buf = []
+        if self.cur is None or not data.strip():
+            return
+        if self.field in ('price', 'amount'):
+            if self.cur[self.field] is None and _num(data):
+                self.cur[self.field] = float(_num(data))
+        elif self.field in ('desc', 'seller'):
+            self.cur[self.field].append(data)
+        if len(self.cur['text']) < 64:
+            self.cur['text'].append(data)
+
+    def _emit(self, it):
+        qty = _extract_qty_from_title(' '.join(it['desc']))
+        if not qty:
+            qty = int(it['amount']) if it['amount'] and it['amount'] >= 1 else _extract_qty_from_title(' '.join(it['text']))
+        price = it['price']
+        if price is None and it['anchor']:
+            m = _re.search('(\\d[\\d\\s\\u00a0\\u202f.,]{0,16})\\s*(?:₽|руб\\.?|RUB)', ' '.join(it['text']), _re.I)
+            price = _num(m.group(1)) if m else None
+        if not qty or not price or price <= 0:
+            return
+        row = {'id': _html_lot_id_from_href(it['href']), 'qty': int(qty), 'price': float(price), 'seller': ' '.join(' '.join(it['seller']).split()) or None, 'currency': 'RUB', 'url': it['href'], 'source': 'html'}
+        (self.links if it['anchor'] else self.rows).append(row)
+def _funpay_parse_lots_html(html, chunk=65536):
+    p = _TcItemParser()
+    parts = (html[i:i + chunk] for i in range(0, len(html), chunk)) if isinstance(html, str) else (html or ())
+    for part in parts:
+        if part: p.feed(part)
+    p.close()
+    return p.rows or p.links
+def _http_text_chunks(r, chunk=65536):
+    it = getattr(r, 'iter_content', None)
+    if not callable(it):
+        yield getattr(r, 'text', '') or ''
+        return
+    m = _re.search('charset=([\\w\\-]+)', (getattr(r, 'headers', None) or {}).get('Content-Type') or '', _re.I)
+    try:
+        dec = codecs.getincrementaldecoder(m.group(1) if m else 'utf-8')(errors='replace')
+    except LookupError:
+        dec = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for part in it(chunk_size=chunk):
+        if part: yield dec.decode(part)
+    yield dec.decode(b'', final=True)
+def _funpay_page_lots(sess, url):
+    now = time.time()
+    with _COMPETITOR_LOCK:
+        ent = _FUNPAY_PAGES.setdefault(url, {'etag': None, 'modified': None, 'lots': None, 'ts': 0.0, 'dead_until': 0.0})
+        if ent['lots'] is not None and now - ent['ts'] < FTS_COMPETITOR_REUSE_SEC:
+            return ent['lots']
+        if now < ent['dead_until']:
+            return []
+        headers = {'User-Agent': 'Mozilla/5.0', 'Accept': 'text/html', 'Accept-Language': 'ru,en;q=0.8'}
+        if ent['lots'] is not None:
+            if ent['etag']: headers['If-None-Match'] = ent['etag']
+            if ent['modified']: headers['If-Modified-Since'] = ent['modified']
+    try:
+        r = sess.get(url, headers=headers, timeout=20, stream=True)
+    except TypeError:
+        r = sess.get(url, headers=headers, timeout=20)
+    try:
+        status = int(getattr(r, 'status_code', 200) or 200)
+        if status == 304 and ent['lots'] is not None:
+            with _COMPETITOR_LOCK:
+                ent['ts'] = now
+            logger.debug(f'FunPay HTML lots not modified {url}')
+            return ent['lots']
+        if status >= 400:
+            logger.debug(f'FunPay HTML lots skipped {url}: status={status}')
+            if status == 404:
+                with _COMPETITOR_LOCK:
+                    ent['dead_until'] = now + FTS_COMPETITOR_SOURCE_TTL_SEC
+            return []
+        lots = _funpay_parse_lots_html(_http_text_chunks(r))
+    finally:
+        close = getattr(r, 'close', None)
+        if callable(close): close()
+    rh = getattr(r, 'headers', None) or {}
+    with _COMPETITOR_LOCK:
+        ent.update(etag=rh.get('ETag'), modified=rh.get('Last-Modified'), lots=lots, ts=now)
+    return lots
 def _funpay_http_lots(cardinal, category_id):
     sess = _HTTP
     acc = getattr(cardinal, 'account', None)
@@ -4776,60 +6261,74 @@ def _funpay_http_lots(cardinal, category_id):
             sess = s
     lots = []
     urls = (f'https://funpay.com/lots/{int(category_id)}/', f'https://funpay.com/chips/{int(category_id)}/')
-    for url in urls:
+    futs = [(url, _FUNPAY_EXECUTOR.submit(_funpay_page_lots, sess, url)) for url in urls]
+    for url, fut in futs:
         try:
-            r = sess.get(url, headers={'User-Agent': 'Mozilla/5.0', 'Accept': 'text/html', 'Accept-Language': 'ru,en;q=0.8'}, timeout=20)
-            html = getattr(r, 'text', '') or ''
-            status = int(getattr(r, 'status_code', 200) or 200)
-            if not html or status >= 400:
-                logger.debug(f'FunPay HTML lots skipped {url}: status={status} html_len={len(html)}')
-                continue
-            chunks = _re.split('(?=<[^>]+class=["\\\'][^"\\\']*(?:tc-item|offer|lot|tc-service)[^"\\\']*["\\\'])', html) or []
-            if len(chunks) < 2:
-                chunks = _re.findall('(?is)<a[^>]+href=["\\\'][^"\\\']*(?:lots|chips|offers|orders)[^"\\\']+["\\\'].{0,9000}?</a>', html)
-            for ch in chunks:
-                plain = _html.unescape(_re.sub('<[^>]+>', ' ', ch))
-                qty = _extract_qty_from_title(plain)
-                if not qty:
-                    continue
-                val = _extract_price_from_lot_html(ch, plain)
-                href = None
-                hm = _re.search('href=["\\\']([^"\\\']+)["\\\']', ch, _re.I)
-                if hm:
-                    href = _html.unescape(hm.group(1))
-                    if href.startswith('/'):
-                        href = 'https://funpay.com' + href
-                lid = _html_lot_id_from_href(href)
-                if val is not None and val > 0:
-                    lots.append({'title': plain, 'qty': int(qty), 'price': float(val), 'currency': 'RUB', 'id': lid, 'url': href, 'source': 'html'})
+            lots.extend(fut.result())
         except Exception as e:
             logger.debug(f'FunPay HTML lots failed {url}: {e}')
     logger.debug(f'FunPay HTML lots parsed: category={category_id} count={len(lots)}')
     return lots
-def _public_category_lots(cardinal, category_id):
+def _competitor_lots_usable(lots, my):
+    for lot in lots:
+        try:
+            lid = _lot_attr(lot, ('id', 'lot_id', 'offer_id'))
+            if lid is not None and int(lid) in my:
+                continue
+            price, qty, _cur = _lot_price_qty(lot)
+            if price is not None and qty and qty > 0:
+                return True
+        except Exception:
+            continue
+    return False
+def _public_category_lots(cardinal, category_id, my=()):
     acc = getattr(cardinal, 'account', None)
     objs = [acc, cardinal, getattr(cardinal, 'profile', None), getattr(cardinal, 'tg_profile', None)]
-    lots = []
     names = ('get_subcategory_public_lots', 'get_public_subcategory_lots', 'get_public_lots', 'get_category_lots', 'get_lots_by_subcategory', 'get_subcategory_lots', 'get_lots', 'get_offers', 'get_sorted_lots')
-    for obj in objs:
+    arg_sets = ((int(category_id),), ('lot', int(category_id)), (int(category_id), 'lot'), (int(category_id), 1), (1, int(category_id)), ())
+    with _COMPETITOR_LOCK:
+        src = _COMPETITOR_SOURCE.get(int(category_id))
+    if src and time.time() - src['ts'] < FTS_COMPETITOR_SOURCE_TTL_SEC:
+        if src['method'] is None:
+            return _funpay_http_lots(cardinal, category_id)
+        i, name, args = src['method']
+        fn = getattr(objs[i], name, None) if objs[i] else None
+        try:
+            res = fn(*args) if callable(fn) else None
+            lots = list(_iter_lot_like(res)) if res else []
+            if _competitor_lots_usable(lots, my):
+                return lots
+        except Exception as e:
+            logger.debug(f'[AUTODUMP] cached lots source {name}{args} failed: {e}')
+    found = None
+    for i, obj in enumerate(objs):
         if not obj:
             continue
         for name in names:
             fn = getattr(obj, name, None)
             if not callable(fn):
                 continue
-            for args in ((int(category_id),), ('lot', int(category_id)), (int(category_id), 'lot'), (int(category_id), 1), (1, int(category_id)), ()):
+            for args in arg_sets:
                 try:
                     res = fn(*args)
-                    if res:
-                        lots.extend(list(_iter_lot_like(res)))
+                    lots = list(_iter_lot_like(res)) if res else []
+                    if _competitor_lots_usable(lots, my):
+                        found = ((i, name, args), lots)
+                        break
                 except Exception:
                     continue
-    try:
-        lots.extend(_funpay_http_lots(cardinal, category_id))
+            if found: break
+        if found: break
+    with _COMPETITOR_LOCK:
+        _COMPETITOR_SOURCE[int(category_id)] = {'method': found[0] if found else None, 'ts': time.time()}
+    if found:
+        logger.info(f'[AUTODUMP] competitor lots source: {found[0][1]}{found[0][2]}')
+        return found[1]
+    try:
+        return _funpay_http_lots(cardinal, category_id)
     except Exception as e:
         logger.debug(f'FunPay HTML fallback unavailable: {e}')
-    return lots
+    return []
 def _competitor_star_prices(cardinal, cfg, return_debug=False):
     qtys = sorted({int(x.get('qty')) for x in cfg.get('star_lots') or [] if x.get('qty')})
     my = {int(x.get('lot_id')) for x in cfg.get('star_lots') or [] if x.get('lot_id')}
@@ -4838,7 +6337,7 @@ def _competitor_star_prices(cardinal, cfg, return_debug=False):
     dbg = {'target_qtys': qtys, 'raw_lots': 0, 'self_skipped': 0, 'bad_price_or_qty': 0, 'candidates': 0, 'matched_qtys': []}
     if not qtys:
         return (out, dbg) if return_debug else out
-    raw_lots = _public_category_lots(cardinal, int(cfg.get('category_id', FNP_STARS_CATEGORY_ID)))
+    raw_lots = _public_category_lots(cardinal, int(cfg.get('category_id', FNP_STARS_CATEGORY_ID)), my)
     dbg['raw_lots'] = len(raw_lots or [])
     seen = set()
     for lot in raw_lots:
@@ -4909,6 +6408,7 @@ def _autodump_changes_text(rows, title):
         out.append(f'… и ещё {len(rows) - 60} лот(ов)')
     return '\n'.join(out)
 def _notify_autodump_changes(cardinal, chat_id, rows, title):
+    if rows: _stats_event('autodump', qty=len(rows))
     if rows and _cfg_bool(_get_cfg(chat_id), 'autodump_notifications', True):
         try:
             cardinal.telegram.bot.send_message(chat_id, _autodump_changes_text(rows, title), parse_mode='HTML')
@@ -4922,7 +6422,7 @@ def _apply_autodump(cardinal, chat_id, manual=False):
         _set_cfg(chat_id, last_autodump_ts=int(time.time()), last_autodump_info='цены конкурентов не найдены: ' + info)
         return (False, f'⚠️ Автодемп не нашёл подходящие цены конкурентов.\nДиагностика: <code>{_h(info)}</code>\nПлагин проверил методы Cardinal/FunPayAPI и HTML-страницу FunPay. Если в категории реально есть конкуренты, проверьте доступность публичной страницы FunPay из сервера и правильность категории звёзд.')
     rows = []
-    fair_unit = fair_base = fair_info = None
+    fair_model = None
     tried_fair = False
     for it in cfg.get('star_lots') or []:
         try:
@@ -4942,10 +6442,10 @@ def _apply_autodump(cardinal, chat_id, manual=False):
                 decision = 'сработал порог демпа'
             if target > float(old) + 0.01:
                 if not tried_fair:
-                    fair_unit, fair_info, fair_base = _auto_unit_price_rub(cfg)
+                    fair_model, _fair_src = _auto_price_model_rub(cfg)
                     tried_fair = True
-                if fair_unit:
-                    fair_price = float(fair_unit) * qty
+                if fair_model:
+                    fair_price = _price_model_cost(fair_model['final'], qty)
                     cur_name = getattr(cur, 'name', str(cur)).upper()
                     fair_price = float(int(round(fair_price))) if cur_name in ('RUB', 'RUR', '₽') else round(fair_price, 2)
                     if fair_price > float(old) + 0.01:
@@ -5181,10 +6681,11 @@ def _get_lot_price_currency(cardinal, lot_id):
         return (price, getattr(currency, 'name', str(currency)) or 'RUB')
     except Exception:
         return (None, 'RUB')
-def _collect_unit_price_targets(cardinal, cfg, unit_price, base_unit_price=None):
+def _collect_unit_price_targets(cardinal, cfg, unit_price, base_unit_price=None, model=None):
     rows = []
     skipped = 0
     star_lots = cfg.get('star_lots') or []
+    costs = {}
     if star_lots:
         lot_ids = []
         qty_map = {}
@@ -5195,6 +6696,9 @@ def _collect_unit_price_targets(cardinal, cfg, unit_price, base_unit_price=None)
                 qty_map[lid] = int(it.get('qty')) if it.get('qty') else None
             except Exception:
                 continue
+        if model:
+            qtys = sorted({q for q in qty_map.values() if q and q > 0})
+            costs = dict(zip(qtys, zip(_price_model_costs(model['final'], qtys), _price_model_costs(model['base'], qtys))))
     else:
         lot_ids = list(_get_my_lots_by_category(cardinal, FNP_STARS_CATEGORY_ID).keys())
         qty_map = {}
@@ -5231,8 +6735,11 @@ def _collect_unit_price_targets(cardinal, cfg, unit_price, base_unit_price=None)
             if not qty or int(qty) <= 0:
                 skipped += 1
                 continue
-            base_price = float(base_unit_price) * float(qty) if base_unit_price is not None else None
-            new_price = float(unit_price) * float(qty)
+            if model:
+                new_price, base_price = costs.get(int(qty)) or (_price_model_cost(model['final'], qty), _price_model_cost(model['base'], qty))
+            else:
+                base_price = float(base_unit_price) * float(qty) if base_unit_price is not None else None
+                new_price = float(unit_price) * float(qty)
             curr_name = getattr(currency, 'name', str(currency)).upper()
             if curr_name in ('RUB', 'RUR', '₽'):
                 if base_price is not None:
@@ -5396,9 +6903,7 @@ def _order_record_update(chat_id, oid, **updates):
     try:
         oid_s = str(oid)
         with _ORDERS_IO_LOCK:
-            db = _load_orders_db()
-            recs = dict(db.get('records') or {})
-            rec = dict(recs.get(oid_s) or {})
+            rec = _get_order_record(oid_s)
             now = int(time.time())
             rec.setdefault('oid', oid_s)
             rec.setdefault('created_ts', now)
@@ -5414,10 +6919,10 @@ def _order_record_update(chat_id, oid, **updates):
                 rec['chat_id'] = cid
             rec.update({k: v for k, v in updates.items() if v is not None})
             rec['updated_ts'] = now
-            recs[oid_s] = rec
-            db['records'] = _merge_order_records({}, recs)
-            _save_orders_db(db)
-            return dict(db['records'].get(oid_s) or rec)
+            rec = _sanitize_order_records({oid_s: rec}).get(oid_s) or rec
+            if not (_orders_sql_enabled() and _orders_sql_upsert({oid_s: rec})):
+                _append_orders_journal(oid_s, rec)
+            return dict(rec)
     except Exception as e:
         logger.warning(f'order record update failed: {e}')
         return {}
@@ -5525,7 +7030,7 @@ def _order_health_check(cardinal, chat_id):
                 logger.debug(f'order reminder skipped: {e}')
     if review_enabled:
         review_sec = int(cfg.get('order_review_reminder_sec') or ORDER_REVIEW_REMINDER_DEFAULT)
-        for oid, rec in list(_get_order_records().items()):
+        for oid, rec in list(_query_order_records(statuses={'sent'}, sent_before=now - review_sec).items()):
             try:
                 if not _order_record_review_ready(rec) or int(rec.get('review_reminder_ts') or 0) > 0:
                     continue
@@ -5548,30 +7053,67 @@ def _order_health_check(cardinal, chat_id):
     except Exception:
         pass
     return (wait_sent, review_sent, 0)
+FTS_MAINT_MIN_GAP_SEC = float(os.getenv('FTS_MAINT_MIN_GAP_SEC', '30'))
+def _temporary_lots_next_due():
+    dues = []
+    for record in list(_temporary_lot_records().values()):
+        status = str(record.get('status') or 'active')
+        if status == 'active': dues.append(int(record.get('expires_ts') or 0))
+        elif status == 'purchased': dues.append(0)
+        elif status == 'cleanup_pending': dues.append(int(record.get('next_cleanup_ts') or 0))
+        elif status == 'deactivated': dues.append(int(record.get('updated_ts') or 0) + 86401)
+    return min(dues) if dues else None
+def _auto_maintenance_next_due(cfg):
+    now = time.time()
+    dues = [now + FTS_TIMER_SAFETY_SEC]
+    t = _temporary_lots_next_due()
+    if t is not None: dues.append(t)
+    if isinstance(cfg, dict):
+        if _cfg_bool(cfg, 'auto_price_fragment_enabled', False):
+            dues.append(int(float(cfg.get('last_auto_price_ts') or 0)) + FTS_AUTO_PRICE_INTERVAL_SEC)
+        if _cfg_bool(cfg, 'autodump_enabled', False):
+            dues.append(int(float(cfg.get('last_autodump_ts') or 0)) + max(600, min(86400, int(float(cfg.get('autodump_interval_sec') or FTS_AUTODUMP_DEFAULT_INTERVAL_SEC)))))
+        if _cfg_bool(cfg, 'order_watch_enabled', False) or _cfg_bool(cfg, 'order_review_reminder_enabled', False):
+            dues.append(int(cfg.get('last_order_watch_ts') or 0) + max(60, int(cfg.get('order_watch_interval_sec') or ORDER_WATCH_INTERVAL_DEFAULT)))
+    return max(now + FTS_MAINT_MIN_GAP_SEC, min(dues))
+def _auto_maintenance_run(cardinal):
+    cfg = None
+    try:
+        _cleanup_expired_temporary_lots(cardinal)
+        cid, cfg = _owner_cfg_entry(_load_settings())
+        if isinstance(cfg, dict):
+            if _cfg_bool(cfg, 'auto_price_fragment_enabled', False) or _cfg_bool(cfg, 'autodump_enabled', False):
+                _maybe_auto_price_update(cardinal, cid)
+                _maybe_autodump_update(cardinal, cid)
+            if _cfg_bool(cfg, 'order_watch_enabled', False) or _cfg_bool(cfg, 'order_review_reminder_enabled', False):
+                last = int(cfg.get('last_order_watch_ts') or 0)
+                interval = int(cfg.get('order_watch_interval_sec') or ORDER_WATCH_INTERVAL_DEFAULT)
+                if time.time() - last >= max(60, interval):
+                    _order_health_check(cardinal, cid)
+            cfg = _owner_cfg_entry(_load_settings())[1]
+    except Exception as e:
+        logger.debug(f'auto maintenance skipped: {e}')
+    finally:
+        try:
+            due = _auto_maintenance_next_due(cfg)
+        except Exception:
+            due = time.time() + FTS_TIMER_SAFETY_SEC
+        _timer_schedule('maint', due, _auto_maintenance_tick, cardinal)
+def _auto_maintenance_tick(cardinal):
+    if not _schedule_maint_job('auto_maint', _auto_maintenance_run, cardinal):
+        _timer_schedule('maint', time.time() + FTS_MAINT_MIN_GAP_SEC, _auto_maintenance_tick, cardinal, earliest=True)
 _AUTO_MAINT_STARTED = False
 def _start_auto_maintenance(cardinal):
     global _AUTO_MAINT_STARTED
     if _AUTO_MAINT_STARTED:
         return
     _AUTO_MAINT_STARTED = True
-    def loop():
-        while True:
-            try:
-                _cleanup_expired_temporary_lots(cardinal)
-                cid, cfg = _owner_cfg_entry(_load_settings())
-                if isinstance(cfg, dict):
-                    if _cfg_bool(cfg, 'auto_price_fragment_enabled', False) or _cfg_bool(cfg, 'autodump_enabled', False):
-                        _maybe_auto_price_update(cardinal, cid)
-                        _maybe_autodump_update(cardinal, cid)
-                    if _cfg_bool(cfg, 'order_watch_enabled', False) or _cfg_bool(cfg, 'order_review_reminder_enabled', False):
-                        last = int(cfg.get('last_order_watch_ts') or 0)
-                        interval = int(cfg.get('order_watch_interval_sec') or ORDER_WATCH_INTERVAL_DEFAULT)
-                        if time.time() - last >= max(60, interval):
-                            _order_health_check(cardinal, cid)
-            except Exception as e:
-                logger.debug(f'auto maintenance skipped: {e}')
-            time.sleep(30)
-    threading.Thread(target=loop, name='FTS-AUTO-MAINT', daemon=True).start()
+    _start_timers()
+    _timer_schedule('maint', time.time() + 5, _auto_maintenance_tick, cardinal)
+    _timer_schedule('queue', time.time() + _QUEUE_TICK_SEC, _queue_timer_tick, cardinal)
+    _timer_schedule('wallet', time.time() + 60, _wallet_reconcile_tick, cardinal)
+    _timer_schedule('wallet_cache', time.time() + FTS_WALLET_REFRESH_SEC, _wallet_cache_refresh_tick)
+    _timer_schedule('price_table', time.time() + FTS_PRICE_TABLE_TTL_SEC, _price_table_refresh_tick)
 _CARDINAL_REF = None
 def init_cardinal(cardinal):
     global _CARDINAL_REF
@@ -5584,7 +7126,7 @@ def init_cardinal(cardinal):
         moved_orders, removed_profiles = _migrate_orders_storage()
         if moved_orders or removed_profiles:
             logger.info(f'[DB] settings split complete: moved_orders={moved_orders} removed_runtime_profiles={removed_profiles}')
-        data, changed, notes = _migrate_settings_data(_load_settings())
+        data, changed, notes = _migrate_settings_data(_settings_copy(_load_settings()))
         if changed:
             _save_settings(data)
         _order_log('info', 'config_migrated', chat_id='startup', schema=SETTINGS_SCHEMA_VERSION, notes=';'.join(notes) if notes else 'ok')
@@ -5594,6 +7136,10 @@ def init_cardinal(cardinal):
         _hydrate_order_state_from_settings()
     except Exception as e:
         logger.debug(f'order state hydrate failed: {e}')
+    try:
+        _replay_queue_journal()
+    except Exception as e:
+        logger.warning(f'[QUEUE] journal restore failed: {e}')
     tg = cardinal.telegram
     bot = tg.bot
     _start_auto_maintenance(cardinal)
@@ -5602,7 +7148,6 @@ def init_cardinal(cardinal):
     except Exception:
         pass
     logger.info('🚀 Плагин по продаже звёзд запущен.')
-    threading.Thread(target=_queue_watchdog, args=(cardinal,), daemon=True, name='FTS-QUEUE-WATCHDOG').start()
     def _send_home(m):
         return bot.send_message(m.chat.id, _about_text(), parse_mode='HTML', reply_markup=_home_kb(), disable_web_page_preview=True)
     def _send_info(m):
@@ -5899,6 +7444,7 @@ def _install_local_plugin_update(payload, original_name=None):
         if current_payload == bytes(payload):
             result.update(ok=True, changed=False)
             return result
+        _flush_settings()
         if os.path.isfile(SETTINGS_FILE):
             os.makedirs(os.path.dirname(SETTINGS_BAK), exist_ok=True)
             shutil.copy2(SETTINGS_FILE, SETTINGS_BAK)
@@ -6020,6 +7566,7 @@ def _install_pending_plugin_update(remote_version=None):
         compile(source, plugin_file, 'exec')
         if UUID not in source:
             raise RuntimeError('UUID скачанного плагина не совпадает')
+        _flush_settings()
         if os.path.isfile(SETTINGS_FILE):
             os.makedirs(os.path.dirname(SETTINGS_BAK), exist_ok=True)
             shutil.copy2(SETTINGS_FILE, SETTINGS_BAK)
@@ -6234,13 +7781,15 @@ def _parse_line_ts(line):
         return time.mktime(tt)
     except Exception:
         return None
-def _stats_collect(lines, since_ts):
-    stats = {'ok': 0, 'fail': 0, 'qty_ok': 0, 'qty_fail': 0, 'pending': 0, 'per_user': defaultdict(lambda: {'qty': 0, 'cnt': 0}), 'per_day': defaultdict(lambda: {'qty': 0, 'ok': 0, 'fail': 0}), 'refunds_ok': 0, 'refunds_fail': 0, 'auto_deact': 0, 'preorder': 0, 'queue_merge': 0, 'ignore': 0, 'price_updates': 0, 'autodump_updates': 0, 'last_ok': None, 'last_fail': None, 'fail_reasons': defaultdict(int), 'currency': defaultdict(lambda: {'ok': 0, 'fail': 0, 'qty': 0})}
+def _stats_collect(lines, since_ts, until_ts=None, stats=None):
+    stats = _stats_empty() if stats is None else stats
     last = None
     for ln in lines:
         ts = _parse_line_ts(ln)
         if since_ts and ts and (ts < since_ts):
             continue
+        if until_ts and ts and ts >= until_ts:
+            break
         low = ln.lower()
         if '[ignore]' in low:
             stats['ignore'] += 1
@@ -6248,8 +7797,10 @@ def _stats_collect(lines, since_ts):
             stats['queue_merge'] += 1
         if '[autodeact]' in low:
             stats['auto_deact'] += 1
-        if '[preorder]' in low:
+        if '[preorder]' in low or 'action=preorder_captured' in low:
             stats['preorder'] += 1
+        if 'action=send_uncertain' in low:
+            stats['uncertain'] += 1
         if 'цены лотов обновлены' in low or 'автоцены применены' in low:
             stats['price_updates'] += 1
         if 'автодемп' in low and ('изменил' in low or 'применён' in low):
@@ -6301,11 +7852,212 @@ def _stats_collect(lines, since_ts):
                 stats['refunds_ok'] += 1
             else:
                 stats['refunds_fail'] += 1
+    return stats
+STATS_EVENTS_FILE = os.path.join(PLUGIN_FOLDER, 'stats_events.jsonl')
+STATS_ROLLUP_FILE = os.path.join(PLUGIN_FOLDER, 'stats_rollup.json')
+FTS_STATS_ROLLUP_SAVE_SEC = float(os.getenv('FTS_STATS_ROLLUP_SAVE_SEC', '5'))
+FTS_STATS_EVENTS_MAX_BYTES = int(os.getenv('FTS_STATS_EVENTS_MAX_BYTES', str(4 * 1024 * 1024)))
+FTS_STATS_HOURS_KEEP_SEC = float(os.getenv('FTS_STATS_HOURS_KEEP_SEC', str(32 * 86400)))
+_STATS_LOCK = threading.RLock()
+_STATS_SAVE_LOCK = threading.RLock()
+_STATS_ROLLUP = {'days': None, 'hours': None, 'hours_since': None, 'offset': 0, 'since': None, 'dirty': False, 'saved_ts': 0.0}
+def _stats_event(kind, **fields):
+    ev = {'ts': int(time.time()), 'kind': str(kind)}
+    ev.update({k: v for k, v in fields.items() if v is not None})
+    try:
+        line = json.dumps(ev, ensure_ascii=False)
+        with _STATS_LOCK:
+            _stats_rollup_days()
+            with open(STATS_EVENTS_FILE, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                offset = f.tell()
+            _stats_rollup_apply(ev)
+            _STATS_ROLLUP.update(offset=offset, dirty=True)
+        delay = 0.0 if offset >= FTS_STATS_EVENTS_MAX_BYTES else FTS_STATS_ROLLUP_SAVE_SEC
+        _timer_schedule('stats_rollup', time.time() + delay, _schedule_maint_job, 'stats_rollup', _stats_rollup_save, earliest=True)
+    except Exception as e:
+        logger.debug(f'stats event write failed: {e}')
+def _stats_day_key(ts):
+    return time.strftime('%Y-%m-%d', time.localtime(ts))
+def _stats_bucket_merge(dst, src):
+    for k, v in src.items():
+        if isinstance(v, dict): _stats_bucket_merge(dst.setdefault(k, {}), v)
+        elif k in ('last_ok', 'last_fail'): dst[k] = max(int(dst.get(k) or 0), int(v or 0))
+        else: dst[k] = dst.get(k, 0) + v
+    return dst
+def _stats_rollup_apply(ev):
+    ts = int(ev.get('ts') or 0)
+    if ts and (_STATS_ROLLUP['since'] is None or ts < _STATS_ROLLUP['since']): _STATS_ROLLUP['since'] = ts
+    _stats_bucket_apply(_STATS_ROLLUP['days'].setdefault(_stats_day_key(ts), {}), ev, ts)
+    if ts >= time.time() - FTS_STATS_HOURS_KEEP_SEC:
+        _stats_bucket_apply(_STATS_ROLLUP['hours'].setdefault(str(ts // 3600), {}), ev, ts)
+def _stats_bucket_apply(b, ev, ts):
+    kind = ev.get('kind')
+    if kind in _STATS_EVENT_COUNTERS:
+        b[kind] = b.get(kind, 0) + 1
+        return
+    if kind not in {'send_ok', 'send_fail'}:
+        other = b.setdefault('other', {})
+        other[str(kind)] = other.get(str(kind), 0) + 1
+        return
+    q = int(ev.get('qty') or 0)
+    cur = b.setdefault('cur', {}).setdefault(_normalize_stars_currency(ev.get('cur')), {'ok': 0, 'fail': 0, 'qty': 0})
+    if kind == 'send_ok':
+        b['ok'] = b.get('ok', 0) + 1
+        b['qty_ok'] = b.get('qty_ok', 0) + q
+        if ev.get('pending'): b['pending'] = b.get('pending', 0) + 1
+        cur['ok'] += 1
+        cur['qty'] += q
+        u = str(ev.get('user') or '').lower()
+        if u:
+            pu = b.setdefault('users', {}).setdefault(u, {'qty': 0, 'cnt': 0})
+            pu['qty'] += q
+            pu['cnt'] += 1
+        b['last_ok'] = max(int(b.get('last_ok') or 0), ts)
+    else:
+        b['fail'] = b.get('fail', 0) + 1
+        b['qty_fail'] = b.get('qty_fail', 0) + q
+        cur['fail'] += 1
+        reason = (str(ev.get('reason') or 'ошибка')).strip()[:120]
+        reasons = b.setdefault('reasons', {})
+        reasons[reason] = reasons.get(reason, 0) + 1
+        b['last_fail'] = max(int(b.get('last_fail') or 0), ts)
+def _stats_rollup_save():
+    with _STATS_SAVE_LOCK:
+        with _STATS_LOCK:
+            if not _STATS_ROLLUP['dirty'] or _STATS_ROLLUP['days'] is None: return
+            offset = _STATS_ROLLUP['offset']
+            _stats_prune_hours()
+            payload = {'__meta__': {'events_offset': offset, 'since': _STATS_ROLLUP['since'], 'hours_since': _STATS_ROLLUP['hours_since'], 'updated_at': int(time.time())}, 'days': json.loads(json.dumps(_STATS_ROLLUP['days'])), 'hours': json.loads(json.dumps(_STATS_ROLLUP['hours']))}
+            _STATS_ROLLUP['dirty'] = False
+        try:
+            _atomic_write_json(STATS_ROLLUP_FILE, payload)
+            _STATS_ROLLUP['saved_ts'] = time.time()
+        except Exception as e:
+            _STATS_ROLLUP['dirty'] = True
+            logger.debug(f'stats rollup save failed: {e}')
+            return
+        if offset >= FTS_STATS_EVENTS_MAX_BYTES: _stats_rotate_events(offset)
+def _stats_prune_hours():
+    cutoff = int(time.time() - FTS_STATS_HOURS_KEEP_SEC) // 3600
+    hours = _STATS_ROLLUP['hours']
+    for hk in [hk for hk in hours if int(hk) < cutoff]:
+        hours.pop(hk, None)
+    if _STATS_ROLLUP['hours_since'] is None or _STATS_ROLLUP['hours_since'] < cutoff * 3600: _STATS_ROLLUP['hours_since'] = cutoff * 3600
+def _stats_rotate_events(offset):
+    with _STATS_SAVE_LOCK:
+        with _STATS_LOCK:
+            if _STATS_ROLLUP['offset'] != offset: return
+            try:
+                os.replace(STATS_EVENTS_FILE, STATS_EVENTS_FILE + '.1')
+            except Exception as e:
+                logger.debug(f'stats events rotate failed: {e}')
+                return
+            _STATS_ROLLUP.update(offset=0, dirty=True)
+        _stats_rollup_save()
+        logger.info('[STATS] stats_events.jsonl rotated')
+def _stats_rollup_days():
+    with _STATS_LOCK:
+        if _STATS_ROLLUP['days'] is not None: return _STATS_ROLLUP['days']
+        days, hours, hours_since, offset, since = {}, {}, None, 0, None
+        try:
+            with open(STATS_ROLLUP_FILE, 'r', encoding='utf-8') as f:
+                obj = json.load(f)
+            if isinstance(obj, dict) and isinstance(obj.get('hours'), dict):
+                hours = obj['hours']
+            if isinstance(obj, dict) and isinstance(obj.get('days'), dict):
+                days = obj['days']
+            else:
+                for hk, b in hours.items():
+                    _stats_bucket_merge(days.setdefault(_stats_day_key(int(hk) * 3600), {}), b)
+            if days:
+                meta = obj.get('__meta__') or {}
+                offset = int(meta.get('events_offset') or 0)
+                since = int(meta['since']) if meta.get('since') else int(time.mktime(time.strptime(min(days), '%Y-%m-%d')))
+                hours_since = int(meta['hours_since']) if meta.get('hours_since') else (int(min(hours, key=int)) * 3600 if hours else None)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f'stats rollup load failed, rebuilding: {e}')
+        try:
+            size = os.path.getsize(STATS_EVENTS_FILE) if os.path.exists(STATS_EVENTS_FILE) else 0
+        except Exception:
+            size = 0
+        if offset > size:
+            try:
+                rotated = os.path.getsize(STATS_EVENTS_FILE + '.1') == offset
+            except Exception:
+                rotated = False
+            if rotated: offset = 0
+            else: days, hours, hours_since, offset, since = {}, {}, None, 0, None
+        if hours_since is None: hours_since = int(time.time())
+        _STATS_ROLLUP.update(days=days, hours=hours, hours_since=hours_since, offset=offset, since=since)
+        if size > offset:
+            try:
+                with open(STATS_EVENTS_FILE, 'r', encoding='utf-8') as f:
+                    f.seek(offset)
+                    for ln in f:
+                        try:
+                            ev = json.loads(ln)
+                        except Exception:
+                            continue
+                        if isinstance(ev, dict): _stats_rollup_apply(ev)
+                _STATS_ROLLUP.update(offset=size, dirty=True)
+                _timer_schedule('stats_rollup', time.time(), _schedule_maint_job, 'stats_rollup', _stats_rollup_save, earliest=True)
+            except Exception as e:
+                logger.warning(f'stats rollup replay failed: {e}')
+        return days
+def _stats_rollup_since():
+    with _STATS_LOCK:
+        _stats_rollup_days()
+        return _STATS_ROLLUP['since']
+def _stats_collect_rollup(since_ts, stats=None):
+    stats = _stats_empty() if stats is None else stats
+    since_day = _stats_day_key(since_ts) if since_ts else None
+    with _STATS_LOCK:
+        days = json.loads(json.dumps(_stats_rollup_days()))
+        hourly = since_ts is not None and since_ts >= _STATS_ROLLUP['hours_since']
+        hours = json.loads(json.dumps(_STATS_ROLLUP['hours'])) if hourly else {}
+    for day, b in days.items():
+        if since_day is not None and day < since_day: continue
+        if hourly and day == since_day: continue
+        _stats_collect_bucket(stats, day, b)
+    for hk, b in hours.items():
+        day = _stats_day_key(int(hk) * 3600)
+        if day == since_day and int(hk) >= int(since_ts) // 3600: _stats_collect_bucket(stats, day, b)
+    return stats
+def _stats_collect_bucket(stats, day, b):
+    for kind, key in _STATS_EVENT_COUNTERS.items():
+        stats[key] += int(b.get(kind) or 0)
+    for k in ('ok', 'fail', 'qty_ok', 'qty_fail', 'pending'):
+        stats[k] += int(b.get(k) or 0)
+    if b.get('ok') or b.get('fail'):
+        stats['per_day'][day]['qty'] += int(b.get('qty_ok') or 0)
+        stats['per_day'][day]['ok'] += int(b.get('ok') or 0)
+        stats['per_day'][day]['fail'] += int(b.get('fail') or 0)
+    for cur, v in (b.get('cur') or {}).items():
+        for k in ('ok', 'fail', 'qty'):
+            stats['currency'][cur][k] += int(v.get(k) or 0)
+    for u, v in (b.get('users') or {}).items():
+        stats['per_user'][u]['qty'] += int(v.get('qty') or 0)
+        stats['per_user'][u]['cnt'] += int(v.get('cnt') or 0)
+    for reason, n in (b.get('reasons') or {}).items():
+        stats['fail_reasons'][reason] += int(n or 0)
+    for kind, n in (b.get('other') or {}).items():
+        stats['other'][kind] += int(n or 0)
+    if b.get('last_ok'): stats['last_ok'] = max(stats['last_ok'] or 0, int(b['last_ok']))
+    if b.get('last_fail'): stats['last_fail'] = max(stats['last_fail'] or 0, int(b['last_fail']))
+atexit.register(_stats_rollup_save)
+def _stats_empty():
+    return {'ok': 0, 'fail': 0, 'qty_ok': 0, 'qty_fail': 0, 'pending': 0, 'per_user': defaultdict(lambda: {'qty': 0, 'cnt': 0}), 'per_day': defaultdict(lambda: {'qty': 0, 'ok': 0, 'fail': 0}), 'refunds_ok': 0, 'refunds_fail': 0, 'auto_deact': 0, 'preorder': 0, 'uncertain': 0, 'queue_merge': 0, 'ignore': 0, 'price_updates': 0, 'autodump_updates': 0, 'last_ok': None, 'last_fail': None, 'fail_reasons': defaultdict(int), 'other': defaultdict(int), 'currency': defaultdict(lambda: {'ok': 0, 'fail': 0, 'qty': 0})}
+def _stats_finish(stats):
     stats['per_user'] = dict(stats['per_user'])
     stats['per_day'] = dict(stats['per_day'])
     stats['fail_reasons'] = dict(stats['fail_reasons'])
+    stats['other'] = dict(stats['other'])
     stats['currency'] = dict(stats['currency'])
     return stats
+_STATS_EVENT_COUNTERS = {'refund_ok': 'refunds_ok', 'refund_fail': 'refunds_fail', 'auto_deact': 'auto_deact', 'preorder': 'preorder', 'send_uncertain': 'uncertain', 'queue_merge': 'queue_merge', 'ignore': 'ignore', 'price_update': 'price_updates', 'autodump': 'autodump_updates'}
 def _fmt_human_ts(ts):
     if not ts:
         return '—'
@@ -6314,7 +8066,13 @@ def _stats_text(chat_id, range_key):
     now = time.time()
     ranges = {'24h': (now - 86400, 'за 24 часа'), '7d': (now - 604800, 'за 7 дней'), '30d': (now - 2592000, 'за 30 дней'), 'all': (None, 'за всё время')}
     since_ts, label = ranges.get(range_key, ranges['7d'])
-    s = _stats_collect(_read_log_tail(), since_ts)
+    cutover = _stats_rollup_since()
+    s = _stats_empty()
+    if cutover is None or since_ts is None or since_ts < cutover:
+        _stats_collect(_read_log_tail(), since_ts, until_ts=cutover, stats=s)
+    if cutover is not None:
+        _stats_collect_rollup(since_ts, stats=s)
+    s = _stats_finish(s)
     total = s['ok'] + s['fail']
     conv = s['ok'] / total * 100.0 if total else 0.0
     avg = s['qty_ok'] / s['ok'] if s['ok'] else 0.0
@@ -6324,6 +8082,7 @@ def _stats_text(chat_id, range_key):
     day_lines = [f"{d}: {int(v.get('qty', 0))}⭐ / ✅{v.get('ok', 0)} ❌{v.get('fail', 0)}" for d, v in days] if days else ['—']
     fails = sorted(s['fail_reasons'].items(), key=lambda kv: kv[1], reverse=True)[:5]
     fail_lines = [f'• {cnt}× — {_h(reason)}' for reason, cnt in fails] if fails else ['—']
+    other_lines = [f'• {_h(kind)}: {cnt}' for kind, cnt in sorted(s['other'].items())]
     cur_lines = [f"• {_h(_stars_currency_label(cur))}: ✅{v.get('ok', 0)} / ❌{v.get('fail', 0)} / {int(v.get('qty', 0))}⭐" for cur, v in sorted(s['currency'].items())]
     cfg = _get_cfg(chat_id)
     currency = _normalize_stars_currency(cfg.get('stars_currency'))
@@ -6334,7 +8093,7 @@ def _stats_text(chat_id, range_key):
         advice.append('для USDT проверь USDT-jetton wallet и запас TON на комиссию')
     if not advice and total:
         advice.append('система работает стабильно')
-    return f"<b>📊 Умная статистика ({label})</b>\n\n<b>Продажи</b>\n• Успешно: <b>{s['ok']}</b> / Ошибок: <b>{s['fail']}</b> / Конверсия: <b>{conv:.1f}%</b>\n• Звёзд отправлено: <b>{int(s['qty_ok'])}⭐</b>; средний заказ: <b>{avg:.0f}⭐</b>\n• PENDING/BLOCKCHAIN_SENT: <b>{s['pending']}</b>\n• Последний успех: <code>{_fmt_human_ts(s['last_ok'])}</code>\n• Последняя ошибка: <code>{_fmt_human_ts(s['last_fail'])}</code>\n\n<b>Валюты и баланс</b>\n• Сейчас выбрано: <b>{_stars_currency_emoji(currency)} {_stars_currency_label(currency)}</b>\n• Баланс: <code>{_wallet_balance_text(cfg)}</code>\n" + ('\n'.join(cur_lines) if cur_lines else '—') + f"\n\n<b>Автоматика</b>\n• Автоцены: <b>{s['price_updates']}</b> срабатыв.\n• Автодемп: <b>{s['autodump_updates']}</b> срабатыв.\n• Автодеактиваций: <b>{s['auto_deact']}</b>; возвратов: ✅{s['refunds_ok']} / ❌{s['refunds_fail']}\n\n<b>Топ покупателей</b>\n" + ('\n'.join(top_lines) if top_lines else '—') + '\n\n<b>Главные ошибки</b>\n' + '\n'.join(fail_lines) + '\n\n<b>Активность по дням</b>\n' + '\n'.join(day_lines) + '\n\n<b>Вывод</b>\n• ' + '\n• '.join(advice)
+    return f"<b>📊 Умная статистика ({label})</b>\n\n<b>Продажи</b>\n• Успешно: <b>{s['ok']}</b> / Ошибок: <b>{s['fail']}</b> / Конверсия: <b>{conv:.1f}%</b>\n• Звёзд отправлено: <b>{int(s['qty_ok'])}⭐</b>; средний заказ: <b>{avg:.0f}⭐</b>\n• PENDING/BLOCKCHAIN_SENT: <b>{s['pending']}</b>\n• Статус не подтверждён: <b>{s['uncertain']}</b>\n• Последний успех: <code>{_fmt_human_ts(s['last_ok'])}</code>\n• Последняя ошибка: <code>{_fmt_human_ts(s['last_fail'])}</code>\n\n<b>Валюты и баланс</b>\n• Сейчас выбрано: <b>{_stars_currency_emoji(currency)} {_stars_currency_label(currency)}</b>\n• Баланс: <code>{_wallet_balance_text(cfg)}</code>\n" + ('\n'.join(cur_lines) if cur_lines else '—') + f"\n\n<b>Автоматика</b>\n• Автоцены: <b>{s['price_updates']}</b> срабатыв.\n• Автодемп: <b>{s['autodump_updates']}</b> срабатыв.\n• Автодеактиваций: <b>{s['auto_deact']}</b>; возвратов: ✅{s['refunds_ok']} / ❌{s['refunds_fail']}\n• Предзаказов ника: <b>{s['preorder']}</b>; объединений очереди: <b>{s['queue_merge']}</b>; пропущено сообщений: <b>{s['ignore']}</b>\n" + ('\n'.join(other_lines) + '\n' if other_lines else '') + "\n<b>Топ покупателей</b>\n" + ('\n'.join(top_lines) if top_lines else '—') + '\n\n<b>Главные ошибки</b>\n' + '\n'.join(fail_lines) + '\n\n<b>Активность по дням</b>\n' + '\n'.join(day_lines) + '\n\n<b>Вывод</b>\n• ' + '\n• '.join(advice)
 def _open_stats(bot, call, range_key=None):
     chat_id = call.message.chat.id
     rk = range_key or '7d'
@@ -6355,7 +8114,7 @@ def _star_add(bot, call):
 def _star_act_all(bot, call):
     chat_id = call.message.chat.id
     cfg = _get_cfg(chat_id)
-    items = cfg.get('star_lots') or []
+    items = _settings_copy(cfg.get('star_lots') or [])
     if not items:
         bot.answer_callback_query(call.id, 'Список пуст. Запустите «Автодобавление лотов» или добавьте LOT вручную.', show_alert=True)
         return
@@ -6378,7 +8137,7 @@ def _star_act_all(bot, call):
 def _star_deact_all(bot, call):
     chat_id = call.message.chat.id
     cfg = _get_cfg(chat_id)
-    items = cfg.get('star_lots') or []
+    items = _settings_copy(cfg.get('star_lots') or [])
     if not items:
         bot.answer_callback_query(call.id, 'Список пуст. Запустите «Автодобавление лотов» или добавьте LOT вручную.', show_alert=True)
         return
@@ -6415,7 +8174,7 @@ def _star_toggle(bot, call):
     chat_id = call.message.chat.id
     cfg = _get_cfg(chat_id)
     lot_id = int(call.data.split(':')[-1])
-    items = cfg.get('star_lots') or []
+    items = _settings_copy(cfg.get('star_lots') or [])
     found = None
     for it in items:
         if int(it.get('lot_id', 0)) == lot_id:
@@ -6466,13 +8225,13 @@ def _schedule_maint_job(key, fn, *args, **kwargs):
             return False
         fut = _MAINT_EXECUTOR.submit(fn, *args, **kwargs)
         _MAINT_JOBS[key] = fut
-        def _cleanup(_f):
-            with _MAINT_JOBS_LOCK:
-                cur = _MAINT_JOBS.get(key)
-                if cur is _f:
-                    _MAINT_JOBS.pop(key, None)
-        fut.add_done_callback(_cleanup)
-        return True
+    def _cleanup(_f):
+        with _MAINT_JOBS_LOCK:
+            cur = _MAINT_JOBS.get(key)
+            if cur is _f:
+                _MAINT_JOBS.pop(key, None)
+    fut.add_done_callback(_cleanup)
+    return True
 def _autoadd_report_text(rep):
     lines = []
     lines.append('<b>🤖 Автодобавление лотов</b>')
@@ -7085,7 +8844,7 @@ def _toggle_lots(bot, call):
     _state_text, state_bool = _lots_state_summary(cfg)
     current = state_bool is True
     desired = not current
-    star_lots = cfg.get('star_lots') or []
+    star_lots = _settings_copy(cfg.get('star_lots') or [])
     known_ids = _managed_lot_ids_from_cfg(cfg)
     rep = {'ok': [], 'skip': [], 'err': []}
     if _CARDINAL_REF is not None:
@@ -7163,7 +8922,10 @@ def _refresh(bot, call):
     chat_id = call.message.chat.id
     cfg = _get_cfg(chat_id)
     if cfg.get('fragment_jwt'):
+        read_ts = time.time()
         ver, bal, usdt, raw = _check_fragment_wallet(cfg['fragment_jwt'], chat_id=chat_id)
+        if isinstance(bal, (int, float)) or isinstance(usdt, (int, float)):
+            _wallet_reconciled(_wallet_owner(chat_id), min(read_ts, float((raw or {}).get('_fetched_ts') or read_ts)))
         if ver is not None or bal is not None or usdt is not None or (raw is not None):
             _set_cfg(chat_id, wallet_version=ver, balance_ton=round(bal, 6) if isinstance(bal, (int, float)) else None, balance_usdt=round(usdt, 6) if isinstance(usdt, (int, float)) else None, last_wallet_raw=raw)
     if _CARDINAL_REF is not None:
@@ -7358,7 +9120,7 @@ def _redeem_bridge_code(code):
 def _validate_fragment_jwt(jwt, chat_id=None):
     if not _is_jwt_like(jwt):
         return (False, 'format', None, None, None, None)
-    ver, bal_ton, bal_usdt, raw = _check_fragment_wallet(jwt, chat_id=chat_id)
+    ver, bal_ton, bal_usdt, raw = _check_fragment_wallet(jwt, chat_id=chat_id, max_age=0)
     if isinstance(raw, dict) and raw.get('_auth_error'):
         return (False, 'auth', ver, bal_ton, bal_usdt, raw)
     if isinstance(bal_ton, (int, float)) or isinstance(bal_usdt, (int, float)):
@@ -7515,7 +9277,7 @@ def _handle_fsm(message, cardinal):
             return
         key = state.get('msg_key')
         cfg = _get_cfg(chat_id)
-        tpls = cfg.get('templates') or _default_templates()
+        tpls = _settings_copy(cfg.get('templates') or _default_templates())
         tpls[key] = text
         _set_cfg(chat_id, templates=tpls)
         try:
@@ -7668,7 +9430,7 @@ def _handle_fsm(message, cardinal):
             cardinal.telegram.bot.send_message(chat_id, "⚠️ Введите число ≥ 0, 0 или '-' для удаления порога.")
             return
         cfg = _get_cfg(chat_id)
-        items = cfg.get('star_lots') or []
+        items = _settings_copy(cfg.get('star_lots') or [])
         ok = False
         for it in items:
             if int(it.get('lot_id', 0)) == lot_id:
@@ -7723,7 +9485,7 @@ def _handle_fsm(message, cardinal):
             return
         qty = int(state.get('new_qty'))
         cfg = _get_cfg(chat_id)
-        items = cfg.get('star_lots') or []
+        items = _settings_copy(cfg.get('star_lots') or [])
         updated = False
         for it in items:
             if int(it.get('lot_id', 0)) == lot_id:
@@ -7968,6 +9730,7 @@ def _handle_fsm(message, cardinal):
                 return
             jwt_val = _clean_jwt_text((bridge_payload or {}).get('token'))
         jwt_val = _clean_jwt_text(jwt_val or '')
+        read_ts = time.time()
         ok, reason, ver, bal, usdt, resp = _validate_fragment_jwt(jwt_val, chat_id=chat_id)
         if not ok:
             if reason == 'auth':
@@ -7981,6 +9744,7 @@ def _handle_fsm(message, cardinal):
                 msg = (                     '⚠️ Не удалось проверить токен через Fragment API. Данные не сохранены.\n'                     'Попробуйте ещё раз немного позже.'                 )
             cardinal.telegram.bot.send_message(                 chat_id,                 msg,                 parse_mode='HTML',                 disable_web_page_preview=True             )
             return
+        _wallet_reconciled(_wallet_owner(chat_id), min(read_ts, float((resp or {}).get('_fetched_ts') or read_ts)))
         _set_cfg(             chat_id,             fragment_jwt=jwt_val,             wallet_version=ver,             balance_ton=round(bal, 6) if isinstance(bal, (int, float)) else None,             balance_usdt=round(usdt, 6) if isinstance(usdt, (int, float)) else None,             last_wallet_raw=resp         )
         _cleanup_fsm_msgs(cardinal.telegram.bot, chat_id, state)
         _fsm.pop(chat_id, None)
@@ -8007,6 +9771,7 @@ def _open_reset_settings_confirm(bot, call):
 def _clear_settings_json_file():
     try:
         with _SETTINGS_IO_LOCK:
+            _flush_settings()
             try:
                 ts = time.strftime('%Y%m%d-%H%M%S')
                 if os.path.exists(SETTINGS_FILE):
@@ -8014,6 +9779,7 @@ def _clear_settings_json_file():
             except Exception:
                 pass
             _atomic_write_json(SETTINGS_FILE, {})
+            _settings_cache_drop()
         return (True, '✅ Настройки сброшены. База orders.json сохранена.')
     except Exception as e:
         logger.error(f'Reset settings error: {e}')
@@ -8041,25 +9807,276 @@ def _cb_reset_settings_no(bot, call):
     except Exception:
         pass
     _open_saves(bot, call)
+QUEUE_JOURNAL_FILE = os.path.join(PLUGIN_FOLDER, 'queue_journal.jsonl')
+FTS_QUEUE_JOURNAL = bool(int(os.getenv('FTS_QUEUE_JOURNAL', '1')))
+FTS_QUEUE_JOURNAL_COMPACT = int(os.getenv('FTS_QUEUE_JOURNAL_COMPACT', '500'))
+_QUEUE_JOURNAL_LOCK = threading.RLock()
+_QUEUE_JOURNAL = {'lines': 0, 'seq': 0, 'run': '%x' % int(time.time() * 1000), 'replaying': False}
+def _queue_journal_line(op, qitem, **extra):
+    return json.dumps(dict({'op': op, 'jid': qitem.jid}, **extra), ensure_ascii=False, default=str)
+def _queue_journal_write(op, qitem, **extra):
+    if not FTS_QUEUE_JOURNAL or _QUEUE_JOURNAL['replaying'] or getattr(qitem, 'queue', None) is None: return
+    try:
+        with _QUEUE_JOURNAL_LOCK:
+            with open(QUEUE_JOURNAL_FILE, 'a', encoding='utf-8') as f:
+                f.write(_queue_journal_line(op, qitem, **extra) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            _QUEUE_JOURNAL['lines'] += 1
+            if _QUEUE_JOURNAL['lines'] >= FTS_QUEUE_JOURNAL_COMPACT: _queue_journal_compact()
+    except Exception as e:
+        logger.debug(f'[QUEUE] journal write failed: {e}')
+def _preorder_journal_write(oid, data):
+    if not FTS_QUEUE_JOURNAL or _QUEUE_JOURNAL['replaying']: return
+    try:
+        with _QUEUE_JOURNAL_LOCK:
+            with open(QUEUE_JOURNAL_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'op': 'pre', 'oid': str(oid), 'p': data}, ensure_ascii=False, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            _QUEUE_JOURNAL['lines'] += 1
+    except Exception as e:
+        logger.debug(f'[QUEUE] preorder journal write failed: {e}')
+class _PreorderMap(dict):
+    def __setitem__(self, k, v):
+        super().__setitem__(str(k), v)
+        _preorder_journal_write(k, v)
+    def pop(self, k, *default):
+        had = str(k) in self
+        v = super().pop(str(k), *default)
+        if had: _preorder_journal_write(k, None)
+        return v
+def _queue_journal_compact():
+    if not FTS_QUEUE_JOURNAL: return
+    with _QUEUE_JOURNAL_LOCK:
+        try:
+            os.makedirs(PLUGIN_FOLDER, exist_ok=True)
+            tmp = QUEUE_JOURNAL_FILE + '.tmp'
+            n = 0
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for q in list(_pending_orders.values()):
+                    for it in list(q):
+                        if isinstance(it, _QueueItem) and not it.get('finalized'):
+                            f.write(_queue_journal_line('push', it, item=dict(it)) + '\n')
+                            n += 1
+                for oid, data in list(_preorders.items()):
+                    f.write(json.dumps({'op': 'pre', 'oid': oid, 'p': data}, ensure_ascii=False, default=str) + '\n')
+                    n += 1
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, QUEUE_JOURNAL_FILE)
+            _QUEUE_JOURNAL['lines'] = n
+        except Exception as e:
+            logger.debug(f'[QUEUE] journal compact failed: {e}')
+def _replay_queue_journal():
+    if not FTS_QUEUE_JOURNAL or not os.path.exists(QUEUE_JOURNAL_FILE): return 0
+    items = {}
+    pre = {}
+    try:
+        with open(QUEUE_JOURNAL_FILE, 'r', encoding='utf-8') as f:
+            for ln in f:
+                try:
+                    ent = json.loads(ln)
+                except Exception:
+                    continue
+                if isinstance(ent, dict) and ent.get('op') == 'pre' and ent.get('oid'):
+                    if isinstance(ent.get('p'), dict): pre[str(ent['oid'])] = ent['p']
+                    else: pre.pop(str(ent['oid']), None)
+                    continue
+                jid = ent.get('jid') if isinstance(ent, dict) else None
+                if not jid: continue
+                op = ent.get('op')
+                if op == 'push' and isinstance(ent.get('item'), dict):
+                    items.pop(jid, None)
+                    items[jid] = dict(ent['item'])
+                elif op == 'set' and jid in items and isinstance(ent.get('f'), dict):
+                    items[jid].update(ent['f'])
+                elif op == 'del':
+                    items.pop(jid, None)
+    except Exception as e:
+        logger.warning(f'[QUEUE] journal replay failed: {e}')
+        return 0
+    restored = 0
+    unknown = []
+    _QUEUE_JOURNAL['replaying'] = True
+    try:
+        for oid, data in pre.items():
+            if oid not in _done_oids and oid not in _blocked_oids: _preorders[oid] = data
+        for jid, data in items.items():
+            oid = data.get('order_id')
+            if data.get('finalized') or (oid and (str(oid) in _done_oids or str(oid) in _blocked_oids)): continue
+            if data.get('inflight_ts'):
+                unknown.append(data)
+                continue
+            q = _q(data.get('chat_id'))
+            if oid and q.by_oid(oid) is not None: continue
+            it = _QueueItem(data)
+            it.jid = jid
+            q.append(it)
+            if it.get('prompted') and oid: _mark_prompted(it.get('chat_id'), oid)
+            restored += 1
+    finally:
+        _QUEUE_JOURNAL['replaying'] = False
+    for data in unknown:
+        _replay_delivery_unknown(data)
+    _queue_journal_compact()
+    if restored: logger.info(f'[QUEUE] restored {restored} pending order(s) from journal')
+    return restored
+def _replay_delivery_unknown(data):
+    oid, chat_id, qty = data.get('order_id'), data.get('chat_id'), int(data.get('qty') or 0)
+    username = str(data.get('candidate') or '').lstrip('@')
+    human = 'Плагин был перезапущен во время отправки заказа. Автоматический повтор остановлен, чтобы не отправить звёзды дважды.'
+    _order_log('error', 'send_uncertain', oid=oid or 'noid', chat_id=chat_id, qty=qty, username=username, network_error='restart', reason=human)
+    _stats_event('send_uncertain', oid=oid, qty=qty, user=username, reason='restart')
+    if not oid: return
+    _finalize_order_uncertain(oid, chat_id, qty, username, reason=human)
+    if _CARDINAL_REF is not None and chat_id:
+        _safe_send(_CARDINAL_REF, chat_id, f'⚠️ <b>Статус отправки заказа #{oid} не подтверждён.</b>\n\nПлагин перезапустился, пока шла отправка {qty}⭐ на @{username}. Повторная отправка отключена.\nПроверьте операцию вручную в Fragment, изменение баланса и получение звёзд пользователем.')
+_QUEUE_TIMER_KEYS = frozenset({'turn_ts', 'stage', 'finalized', 'prompted', 'confirmed'})
+class _QueueItem(dict):
+    jid = None
+    queue = None
+    def __setitem__(self, k, v):
+        super().__setitem__(k, v)
+        _queue_journal_write('set', self, f={k: v})
+        if k in _QUEUE_TIMER_KEYS and self.queue is not None: _timer_kick('queue')
+        if k in ('stage', 'qty'): _wallet_track(self)
+    def update(self, *args, **kwargs):
+        f = dict(*args, **kwargs)
+        super().update(f)
+        _queue_journal_write('set', self, f=f)
+        if self.queue is not None and not _QUEUE_TIMER_KEYS.isdisjoint(f): _timer_kick('queue')
+        if 'stage' in f or 'qty' in f: _wallet_track(self)
+    def setdefault(self, k, v=None):
+        if k in self: return self[k]
+        self[k] = v
+        return v
+class _OrderQueue(list):
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.reindex()
+    def reindex(self, item=None):
+        if item is not None and any(x is item for x in self._chat.get(str(item.get('chat_id')), ())) and self._oid.get(str(item.get('order_id'))) is item:
+            return
+        self._oid, self._chat, self._seq_of, self._seqs = {}, {}, {}, []
+        for i, it in enumerate(self):
+            self._index(it, i)
+    def _index(self, it, seq):
+        oid = it.get('order_id')
+        if oid: self._oid.setdefault(str(oid), it)
+        self._chat.setdefault(str(it.get('chat_id')), []).append(it)
+        self._seq_of[id(it)] = seq
+        bisect.insort(self._seqs, seq)
+    def _unindex(self, it):
+        oid = it.get('order_id')
+        if oid and self._oid.get(str(oid)) is it: self._oid.pop(str(oid), None)
+        key = str(it.get('chat_id'))
+        keys = [key] if any(x is it for x in self._chat.get(key, ())) else list(self._chat)
+        for key in keys:
+            lst = self._chat.get(key) or []
+            for i, x in enumerate(lst):
+                if x is it:
+                    del lst[i]
+                    break
+            if not lst: self._chat.pop(key, None)
+        seq = self._seq_of.pop(id(it), None)
+        if seq is not None:
+            i = bisect.bisect_left(self._seqs, seq)
+            if i < len(self._seqs) and self._seqs[i] == seq: del self._seqs[i]
+    def _attach(self, it):
+        if not isinstance(it, _QueueItem): return
+        if it.jid is None:
+            _QUEUE_JOURNAL['seq'] += 1
+            it.jid = f"{_QUEUE_JOURNAL['run']}-{_QUEUE_JOURNAL['seq']}"
+        it.queue = self
+        _queue_journal_write('push', it, item=dict(it))
+        _timer_kick('queue')
+        _wallet_track(it)
+    def _detach(self, it):
+        if not isinstance(it, _QueueItem) or it.queue is not self: return
+        _queue_journal_write('del', it)
+        it.queue = None
+        _timer_kick('queue')
+        _wallet_settle(it.get('order_id'), False)
+    def append(self, it):
+        super().append(it)
+        self._index(it, (self._seqs[-1] + 1) if self._seqs else 0)
+        self._attach(it)
+    def extend(self, items):
+        for it in items:
+            self.append(it)
+    def insert(self, i, it):
+        super().insert(i, it)
+        if i <= 0 and self._seqs and len(self) > 1:
+            self._index(it, self._seqs[0] - 1)
+            self._chat[str(it.get('chat_id'))].sort(key=lambda x: self._seq_of.get(id(x), 0))
+        else:
+            self.reindex()
+        self._attach(it)
+        _queue_journal_compact()
+    def pop(self, i=-1):
+        it = super().pop(i)
+        self._unindex(it)
+        self._detach(it)
+        return it
+    def remove(self, it):
+        for i, x in enumerate(self):
+            if x is it:
+                self.pop(i)
+                return
+        super().remove(it)
+        self.reindex()
+        _queue_journal_compact()
+    def clear(self):
+        for it in list(self):
+            self._detach(it)
+        super().clear()
+        self.reindex()
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self.reindex()
+        _queue_journal_compact()
+    def __setitem__(self, i, v):
+        super().__setitem__(i, v)
+        self.reindex()
+        _queue_journal_compact()
+    def by_oid(self, oid):
+        if not oid: return None
+        it = self._oid.get(str(oid))
+        if it is not None and str(it.get('order_id')) != str(oid):
+            self.reindex()
+            it = self._oid.get(str(oid))
+        return it
+    def by_chat(self, chat_id):
+        cid = str(chat_id)
+        for it in self._chat.get(cid, ()):
+            if str(it.get('chat_id')) == cid and not it.get('finalized'):
+                return it
+        return None
+    def position(self, item):
+        seq = self._seq_of.get(id(item))
+        if seq is None: return None
+        return bisect.bisect_left(self._seqs, seq) + 1
 _pending_orders = {}
 FTS_GLOBAL_QUEUE = bool(int(os.getenv('FTS_GLOBAL_QUEUE', '1')))
 _GLOBAL_QKEY = '__global_orders__'
 _prompted_orders = {}
 _prompted_oids = set()
-_preorders = {}
+_preorders = _PreorderMap()
 _done_oids = set()
 def _remove_order_everywhere(oid):
     if not oid:
         return
     s = str(oid)
     for key, q in list(_pending_orders.items()):
-        for it in list(q):
-            if str(it.get('order_id')) == s:
-                it['finalized'] = True
-                try:
-                    q.remove(it)
-                except ValueError:
-                    pass
+        it = q.by_oid(s)
+        while it is not None:
+            it['finalized'] = True
+            try:
+                q.remove(it)
+            except ValueError:
+                break
+            it = q.by_oid(s)
         if not q:
             try:
                 del _pending_orders[key]
@@ -8074,32 +10091,40 @@ def _mark_done(chat_id, oid):
     _remove_order_everywhere(s)
 _blocked_oids = set()
 _failed_orders = {}
-_recent_msg_events = {}
-_recent_order_events = {}
+FTS_DEDUP_CACHE_SIZE = int(os.getenv('FTS_DEDUP_CACHE_SIZE', '4096'))
+_recent_msg_events = OrderedDict()
+_recent_order_events = OrderedDict()
+_RECENT_LOCK = threading.Lock()
+def _recent_touch(cache, key, now):
+    cache[key] = now
+    cache.move_to_end(key)
 def _recent_once(cache, key, ttl=3.0):
     now = time.time()
-    try:
-        for k, ts in list(cache.items()):
-            if now - float(ts or 0) > ttl * 4:
-                cache.pop(k, None)
-    except Exception:
-        pass
-    last = float(cache.get(key) or 0)
-    if now - last < ttl:
-        return True
-    cache[key] = now
-    return False
+    with _RECENT_LOCK:
+        while cache:
+            k, ts = next(iter(cache.items()))
+            if now - ts <= ttl * 4 and len(cache) < FTS_DEDUP_CACHE_SIZE:
+                break
+            cache.popitem(last=False)
+        if now - cache.get(key, 0.0) < ttl:
+            return True
+        _recent_touch(cache, key, now)
+        return False
+def _dedup_text_key(text):
+    return hashlib.blake2b((text or '').encode('utf-8', 'ignore'), digest_size=8).hexdigest()
 def _seen_message_event(event, chat_id, author, text):
     try:
         msg = getattr(event, 'message', None)
         mid = getattr(msg, 'message_id', None) or getattr(msg, 'id', None)
-        keys = ['msgtxt:%s:%s:%s' % (chat_id, author or '', (text or '')[:500])]
+        keys = ['msgtxt:%s:%s:%s' % (chat_id, author or '', _dedup_text_key(text))]
         if mid:
             keys.append(f'msgid:{chat_id}:{mid}')
         if any(_recent_once(_recent_msg_events, k, 2.5) for k in keys):
             return True
-        for k in keys:
-            _recent_msg_events[k] = time.time()
+        now = time.time()
+        with _RECENT_LOCK:
+            for k in keys:
+                _recent_touch(_recent_msg_events, k, now)
         return False
     except Exception:
         return False
@@ -8111,7 +10136,7 @@ def _seen_order_event(order_id, chat_id, qty):
         return False
 def _hydrate_order_state_from_settings():
     try:
-        for oid, rec in _get_order_records().items():
+        for oid, rec in _query_order_records(statuses={'sent', 'sent_pending', 'failed', 'refunded', 'cancelled', 'canceled'}).items():
             if not oid or not isinstance(rec, dict):
                 continue
             st = str(rec.get('status') or '').lower()
@@ -8151,13 +10176,12 @@ def _set_order_qty(chat_id, order_id, qty):
     if not order_id or not qty or qty < 50:
         return
     try:
-        for it in _q(chat_id):
-            if str(it.get('order_id')) == str(order_id):
-                it['qty'] = int(qty)
-                it['qty_pending'] = False
-                break
+        it = _q(chat_id).by_oid(order_id)
+        if it is not None:
+            it['qty'] = int(qty)
+            it['qty_pending'] = False
         if str(order_id) in _preorders:
-            _preorders[str(order_id)]['qty'] = int(qty)
+            _preorders[str(order_id)] = dict(_preorders[str(order_id)], qty=int(qty))
     except Exception:
         pass
 
@@ -8185,6 +10209,7 @@ def _adopt_foreign_queue_for(chat_id):
             _pending_orders[key] = items
             del _pending_orders[other_key]
             logger.warning(f'[QUEUE] merged {other_key} -> {key}')
+            _stats_event('queue_merge')
             return True
     return False
 def _mark_prompted(chat_id, order_id):
@@ -8211,7 +10236,7 @@ def _unmark_prompted(chat_id, order_id, *, everywhere=False):
         _prompted_oids.discard(oid)
 def _q(chat_id):
     key = _GLOBAL_QKEY if FTS_GLOBAL_QUEUE else str(chat_id)
-    return _pending_orders.setdefault(key, [])
+    return _pending_orders.setdefault(key, _OrderQueue())
 def _current(chat_id):
     q = _q(chat_id)
     return q[0] if q else None
@@ -8221,15 +10246,14 @@ def _push(chat_id, item):
         logger.debug(f'[QUEUE] skip push for done/blocked order #{oid}')
         return
     q = _q(chat_id)
-    if oid and any((str(x.get('order_id')) == str(oid) for x in q)):
+    x = q.by_oid(oid)
+    if x is not None:
         _order_log('debug', 'queue_merge_existing', oid=oid, chat_id=item.get('chat_id'), qty=item.get('qty'))
-        for x in q:
-            if str(x.get('order_id')) == str(oid):
-                for k, v in item.items():
-                    if v is not None:
-                        x[k] = v
-                x.setdefault('prompted', False)
-                break
+        for k, v in item.items():
+            if v is not None:
+                x[k] = v
+        x.setdefault('prompted', False)
+        q.reindex(x)
         return
     item.setdefault('prompted', False)
     q.append(item)
@@ -8244,54 +10268,47 @@ def _ensure_pending(chat_id, order_id, qty):
         return {'qty': safe_qty, 'qty_pending': not qty_known, 'order_id': order_id, 'chat_id': chat_id, 'stage': 'finalized', 'candidate': None, 'finalized': True, 'confirmed': True, 'prompted': False, 'preconfirmed': False, 'auto_attempted_for': None, 'queue_notified': False, 'turn_ts': None, 'created_ts': time.time(), 'stage_ts': time.time(), 'last_reminder_ts': 0.0}
     q = _q(chat_id)
     if order_id:
-        for x in q:
-            if str(x.get('order_id')) == str(order_id):
-                if qty_known:
-                    x['qty'] = safe_qty
-                    x['qty_pending'] = False
-                else:
-                    x.setdefault('qty_pending', True)
-                x.setdefault('chat_id', chat_id)
-                x.setdefault('stage', 'await_username')
-                x.setdefault('candidate', None)
-                x.setdefault('finalized', False)
-                x.setdefault('confirmed', False)
-                x.setdefault('prompted', False)
-                x.setdefault('preconfirmed', False)
-                x.setdefault('auto_attempted_for', None)
-                x.setdefault('queue_notified', False)
-                x.setdefault('turn_ts', None)
-                x.setdefault('created_ts', time.time())
-                x.setdefault('stage_ts', time.time())
-                x.setdefault('last_reminder_ts', 0.0)
-                return x
-    item = {'qty': safe_qty, 'qty_pending': not qty_known, 'order_id': order_id, 'chat_id': chat_id, 'stage': 'await_username', 'candidate': None, 'finalized': False, 'confirmed': False, 'prompted': False, 'preconfirmed': False, 'auto_attempted_for': None, 'queue_notified': False, 'turn_ts': None, 'created_ts': time.time(), 'stage_ts': time.time(), 'last_reminder_ts': 0.0}
+        x = q.by_oid(order_id)
+        if x is not None:
+            if qty_known:
+                x['qty'] = safe_qty
+                x['qty_pending'] = False
+            else:
+                x.setdefault('qty_pending', True)
+            x.setdefault('chat_id', chat_id)
+            x.setdefault('stage', 'await_username')
+            x.setdefault('candidate', None)
+            x.setdefault('finalized', False)
+            x.setdefault('confirmed', False)
+            x.setdefault('prompted', False)
+            x.setdefault('preconfirmed', False)
+            x.setdefault('auto_attempted_for', None)
+            x.setdefault('queue_notified', False)
+            x.setdefault('turn_ts', None)
+            x.setdefault('created_ts', time.time())
+            x.setdefault('stage_ts', time.time())
+            x.setdefault('last_reminder_ts', 0.0)
+            q.reindex(x)
+            return x
+    item = _QueueItem({'qty': safe_qty, 'qty_pending': not qty_known, 'order_id': order_id, 'chat_id': chat_id, 'stage': 'await_username', 'candidate': None, 'finalized': False, 'confirmed': False, 'prompted': False, 'preconfirmed': False, 'auto_attempted_for': None, 'queue_notified': False, 'turn_ts': None, 'created_ts': time.time(), 'stage_ts': time.time(), 'last_reminder_ts': 0.0})
     _push(chat_id, item)
     if order_id:
-        for x in q:
-            if str(x.get('order_id')) == str(order_id):
-                return x
+        x = q.by_oid(order_id)
+        if x is not None:
+            return x
     return item
 def _find_item_by_chat(chat_id):
-    cid = str(chat_id)
-    for it in _q(chat_id):
-        if str(it.get('chat_id')) == cid and (not it.get('finalized')):
-            return it
-    return None
+    return _q(chat_id).by_chat(chat_id)
 def _active_item_for_chat(chat_id):
     if FTS_GLOBAL_QUEUE:
         return _find_item_by_chat(chat_id)
     return _current(chat_id)
 def _queue_pos_of(item):
     q = _q(item.get('chat_id'))
-    for i, it in enumerate(q, 1):
-        if it is item:
-            return i
-    oid = str(item.get('order_id') or '')
-    for i, it in enumerate(q, 1):
-        if str(it.get('order_id') or '') == oid:
-            return i
-    return 9999
+    pos = q.position(item)
+    if pos is None:
+        pos = q.position(q.by_oid(item.get('order_id')) or {})
+    return pos or 9999
 def _notify_queued_once(cardinal, item):
     if item.get('queue_notified'):
         return
@@ -8412,20 +10429,38 @@ def _is_auto_reply(msg):
         pass
     return False
 _QUEUE_TICK_SEC = float(os.getenv('FTS_QUEUE_TICK_SEC', '5'))
-def _queue_watchdog(cardinal):
-    while True:
-        time.sleep(_QUEUE_TICK_SEC)
-        try:
+def _queue_next_deadline():
+    now = time.time()
+    dues = []
+    for key, q in list(_pending_orders.items()):
+        if not q or _queue_mode(key) != 3: continue
+        head = q[0]
+        if head.get('finalized') or not _allowed_stages(head) or str(head.get('stage')) not in {'await_username', 'await_confirm'}: continue
+        ts = head.get('turn_ts')
+        if ts: dues.append(float(ts) + float(_queue_timeout_sec(key)))
+        elif head.get('prompted') or _was_prompted(head.get('chat_id'), head.get('order_id')): dues.append(now)
+    return min(dues) if dues else None
+_QUEUE_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('FTS_QUEUE_WORKERS', '1')), thread_name_prefix='FTS-QUEUE')
+def _queue_rotate_heads(cardinal):
+    due = None
+    try:
+        _send_gate_redrive(cardinal)
+        for key in list(_pending_orders):
             for _ in range(5):
-                if not _maybe_rotate_queue_head(cardinal, '__orders__'):
+                if not _maybe_rotate_queue_head(cardinal, key):
                     break
-        except Exception as e:
-            logger.debug(f'queue_watchdog failed: {e}')
+        due = _queue_next_deadline()
+    except Exception as e:
+        logger.debug(f'queue timer failed: {e}')
+    finally:
+        now = time.time()
+        due = now + FTS_TIMER_SAFETY_SEC if due is None else max(now + 1.0, min(due, now + FTS_TIMER_SAFETY_SEC))
+        _timer_schedule('queue', due, _queue_timer_tick, cardinal, earliest=True)
+def _queue_timer_tick(cardinal):
+    if not _submit_job(_QUEUE_EXECUTOR, 'queue_rotate', _queue_rotate_heads, (cardinal,), {}):
+        _timer_schedule('queue', time.time() + 1.0, _queue_timer_tick, cardinal, earliest=True)
 def new_order_handler(cardinal, event):
     chat_id = _event_chat_id(event)
-    for _ in range(3):
-        if not _maybe_rotate_queue_head(cardinal, chat_id if chat_id is not None else '__orders__'):
-            break
     try:
         chat_id = _event_chat_id(event)
         cfg = _get_cfg_for_orders(chat_id if chat_id is not None else '__orders__')
@@ -8448,6 +10483,7 @@ def new_order_handler(cardinal, event):
         text_blob = ' '.join((str(x) for x in [title, _order_field(order, 'description'), _order_field(order, 'buyer_message')] if x))
         if _is_gift_like_text(text_blob) or _mentions_account_login(text_blob):
             _log('info', f'[IGNORE] gift/account-login order ignored (#{order_id})')
+            _stats_event('ignore', oid=order_id)
             return
         if qty is not None and qty < FTS_MIN_STARS:
             _order_log('warn', 'min_qty_rejected', oid=order_id, chat_id=chat_id, qty=qty, min_qty=FTS_MIN_STARS)
@@ -8483,6 +10519,7 @@ def new_order_handler(cardinal, event):
         use_pre = bool(cfg.get('preorder_username', False))
         if use_pre and username and order_id:
             _order_log('info', 'preorder_captured', oid=order_id, chat_id=chat_id, qty=qty, username=username)
+            _stats_event('preorder', oid=order_id, qty=qty, user=username)
             item.update(stage='await_paid', candidate=username.lstrip('@'), prompted=False, finalized=False, confirmed=False)
             _preorders[str(order_id)] = {'username': username.lstrip('@'), 'qty': qty}
             return
@@ -8734,12 +10771,10 @@ def _load_tamper_restart_state():
         }
 def _save_tamper_restart_state(restart_count, reason=''):
     with _TAMPER_RESTART_LOCK:
-        settings = _load_settings()
+        settings = _settings_copy(_load_settings())
         meta = settings.get(SETTINGS_META_KEY)
         if not isinstance(meta, dict):
             meta = {}
-        else:
-            meta = dict(meta)
         meta['tamper_restart'] = {
             'restart_count': max(0, int(restart_count)),
             'reason': str(reason or ''),
@@ -8755,6 +10790,7 @@ def _reset_tamper_restart_state_if_clean():
     except Exception as e:
         logger.warning(f'[ANTI-TAMPER] Could not reset restart state: {e}')
 def _restart_cardinal_for_tamper(cardinal):
+    _flush_settings()
     restart = getattr(cardinal, 'restart', None)
     if callable(restart):
         try:
@@ -8827,40 +10863,86 @@ def _start_tamper_restart_cycle(cardinal, immediate=False):
     thread.start()
 def _send_pending_item(cardinal, chat_id, item):
     oid = item.get('order_id')
-    if oid and str(oid) in _done_oids:
-        _remove_order_everywhere(oid)
-        return
-    qty = int(item.get('qty') or 50)
-    username = (item.get('candidate') or '').lstrip('@').strip()
-    cfg = _get_cfg_for_orders(chat_id)
-    jwt = cfg.get('fragment_jwt')
-    _order_log('info', 'confirm_start', oid=oid or 'noid', chat_id=chat_id, qty=qty, username=username or None, stage=item.get('stage'))
-    if not jwt:
-        _safe_send(cardinal, chat_id, '⚠️ Токен Fragment не привязан. Покупка невозможна.')
-        _order_log('warn', 'confirm_abort_no_jwt', oid=oid or 'noid', chat_id=chat_id, qty=qty, username=username or None)
-        return
-    if not username or not _validate_username(username):
-        item.update(stage='await_username', candidate=None)
-        _safe_send(cardinal, chat_id, _tpl(chat_id, 'username_invalid', order_id=oid))
-        return
-    if qty < 50:
-        _safe_send(cardinal, chat_id, f'Минимум 50⭐. Заказ #{oid or "—"}.')
-        return
-    if not _skip_username_check(chat_id) and not _check_username_exists_throttled(username, jwt, chat_id):
-        item.update(stage='await_username', finalized=False, candidate=None)
-        _safe_send(cardinal, chat_id, _tpl(chat_id, 'username_invalid', order_id=oid))
-        return
+    gated = False
+    try:
+        if oid and str(oid) in _done_oids:
+            _remove_order_everywhere(oid)
+            return
+        qty = int(item.get('qty') or 50)
+        username = (item.get('candidate') or '').lstrip('@').strip()
+        cfg = _get_cfg_for_orders(chat_id)
+        jwt = cfg.get('fragment_jwt')
+        _order_log('info', 'confirm_start', oid=oid or 'noid', chat_id=chat_id, qty=qty, username=username or None, stage=item.get('stage'))
+        if not jwt:
+            _safe_send(cardinal, chat_id, '⚠️ Токен Fragment не привязан. Покупка невозможна.')
+            _order_log('warn', 'confirm_abort_no_jwt', oid=oid or 'noid', chat_id=chat_id, qty=qty, username=username or None)
+            return
+        if not username or not _validate_username(username):
+            item.update(stage='await_username', candidate=None)
+            _safe_send(cardinal, chat_id, _tpl(chat_id, 'username_invalid', order_id=oid))
+            return
+        if qty < 50:
+            _safe_send(cardinal, chat_id, f'Минимум 50⭐. Заказ #{oid or "—"}.')
+            return
+        if not _skip_username_check(chat_id) and not _check_username_exists_throttled(username, jwt, chat_id):
+            item.update(stage='await_username', finalized=False, candidate=None)
+            _safe_send(cardinal, chat_id, _tpl(chat_id, 'username_invalid', order_id=oid))
+            return
+        if _breaker_is_open('order'):
+            _order_breaker_hold(cardinal, chat_id, item)
+            return
+        ticket = _send_gate_try(chat_id, qty)
+        if ticket is None:
+            gated = True
+            item['preconfirmed'] = True
+            _send_gate_defer(cardinal, chat_id, oid)
+            return
+    finally:
+        if not gated: _send_gate_undefer(chat_id, oid)
     _safe_send(cardinal, chat_id, _tpl(chat_id, 'sending', qty=qty, username=username))
     was_head = item is _current(chat_id)
     _set_sending(chat_id, True)
+    started = time.monotonic()
+    done = Future()
+    def _released(f):
+        resp = None
+        try:
+            resp = f.result()
+        except Exception as e:
+            logger.exception(f'background send failed: {e}')
+        finally:
+            _send_gate_observe(time.monotonic() - started, resp if resp is not None else {'uncertain': True})
+            _send_gate_release(chat_id, ticket)
+            _set_sending(chat_id, False)
+        _SEND_RESULT_EXECUTOR.submit(_finish, resp)
+    def _finish(resp):
+        try:
+            if resp is not None:
+                _send_pending_result(cardinal, chat_id, item, cfg, jwt, oid, qty, username, resp, was_head)
+        except Exception as e:
+            logger.exception(f'background send failed: {e}')
+        finally:
+            if item.get('inflight_ts'): item['inflight_ts'] = None
+            done.set_result(None)
     try:
         anonymous_send = _cfg_bool(cfg, 'anonymous_stars_send', True)
-        resp = _send_stars_with_currency_fallback(
+        item['inflight_ts'] = time.time()
+        fut = _send_stars_deferred(
             cardinal, chat_id, cfg, jwt, username=username, quantity=qty,
             show_sender=not anonymous_send
         )
-    finally:
+    except Exception:
+        item['inflight_ts'] = None
+        _send_gate_release(chat_id, ticket)
         _set_sending(chat_id, False)
+        raise
+    fut.add_done_callback(_released)
+    return done
+def _send_pending_result(cardinal, chat_id, item, cfg, jwt, oid, qty, username, resp, was_head):
+    if resp.get('network_error') == 'circuit_open' or (resp.get('safe_to_retry') and _breaker_is_open('order')):
+        _order_breaker_hold(cardinal, chat_id, item)
+        return
+    _wallet_settle(oid, bool((resp or {}).get('uncertain')) or _resp_indicates_delivery(resp))
     if (resp or {}).get('uncertain'):
         net_error = str((resp or {}).get('network_error') or 'network_error')
         human = (             f'Fragment API не подтвердил результат отправки ({net_error}). '             'Автоматический повтор остановлен, чтобы не отправить звёзды дважды.'         )
@@ -8880,6 +10962,7 @@ def _send_pending_item(cardinal, chat_id, item):
             'Проверьте операцию вручную в Fragment, изменение баланса и получение звёзд пользователем.'
         )
         _order_log(             'error',             'send_uncertain',             oid=oid or 'noid',             chat_id=chat_id,             qty=qty,             username=username,             status=(resp or {}).get('status'),             network_error=net_error,             reason=human         )
+        _stats_event('send_uncertain', oid=oid, qty=qty, user=username, reason=net_error)
         _log('error', f'SEND UNCERTAIN {qty}⭐ -> @{username}: {human}')
         if oid:
             _finalize_order_uncertain(oid, chat_id, qty, username, reason=human)
@@ -8893,6 +10976,7 @@ def _send_pending_item(cardinal, chat_id, item):
         _send_order_result_message(cardinal, chat_id, qty, username, order_url, resp)
         _order_log('info', 'send_ok', oid=oid or 'noid', chat_id=chat_id, qty=qty, username=username, status=(resp or {}).get('status'), currency=(resp or {}).get('currency'), fragment_id=(resp or {}).get('fragment_order_id'))
         _mark_order_sent_record(chat_id, oid, qty, username, resp)
+        _stats_event('send_ok', oid=oid, qty=qty, user=username, cur=(resp or {}).get('currency'), pending=_is_pending_delivery(resp) or None)
         _log('info', f'SEND OK {qty}⭐ -> @{username}')
         if oid:
             _finalize_order(oid, chat_id, ok=True)
@@ -8909,6 +10993,7 @@ def _send_pending_item(cardinal, chat_id, item):
     item.update(finalized=True)
     _safe_send(cardinal, chat_id, _tpl(chat_id, 'failed', reason=human))
     _order_log('error', 'send_fail', oid=oid or 'noid', chat_id=chat_id, qty=qty, username=username, status=(resp or {}).get('status'), reason=human)
+    _stats_event('send_fail', oid=oid, qty=qty, user=username, cur=(resp or {}).get('currency'), reason=human)
     _log('error', f"SEND FAIL {qty}⭐ -> @{username}: {human} | status={(resp or {}).get('status')}")
     if oid:
         _finalize_order(oid, chat_id, ok=False, reason=human)
@@ -8916,22 +11001,19 @@ def _send_pending_item(cardinal, chat_id, item):
         _safe_send(cardinal, chat_id, '🔁 Пытаюсь оформить возврат…')
         ok_ref = _auto_refund_order(cardinal, oid, chat_id, reason=human)
         _log('info' if ok_ref else 'error', f"REFUND #{oid} -> {('OK' if ok_ref else 'FAIL')}")
-    _maybe_auto_deactivate(cardinal, cfg, chat_id)
+    _maybe_auto_deactivate(cardinal, cfg, chat_id, refresh=False)
     if was_head and _has_queue(chat_id):
         _notify_next_turn(cardinal, chat_id)
 def _do_confirm_send(cardinal, chat_id):
-    for _ in range(3):
-        if not _maybe_rotate_queue_head(cardinal, chat_id):
-            break
     item = _active_item_for_chat(chat_id)
     if not item:
         _safe_send(cardinal, chat_id, 'Нет активного заказа. Если нужно — дождитесь нового сообщения о заказе.')
         return
-    if FTS_GLOBAL_QUEUE and _queue_mode(chat_id) in (1, 3) and item is not _current(chat_id):
+    if not _send_window_allows(chat_id, item):
         item['preconfirmed'] = True
         _safe_send(cardinal, chat_id, f'✅ Подтверждение принято. Сейчас ещё не ваша очередь (позиция {_queue_pos_of(item)}). Когда очередь дойдёт — отправлю автоматически.')
         return
-    _send_pending_item(cardinal, chat_id, item)
+    return _send_pending_item(cardinal, chat_id, item)
 def _cb_confirm_send(cardinal, call):
     try:
         cardinal.telegram.bot.answer_callback_query(call.id)
@@ -8971,10 +11053,8 @@ def _allowed_stages(item):
 def _pending_by_oid(chat_id, oid):
     if not oid:
         return None
-    for x in _q(chat_id):
-        if str(x.get('order_id')) == str(oid) and _allowed_stages(x):
-            return x
-    return None
+    x = _q(chat_id).by_oid(oid)
+    return x if x is not None and _allowed_stages(x) else None
 def _apply_username_for_item(cardinal, chat_id, item, uname):
     cfg = _get_cfg_for_orders(chat_id)
     jwt = cfg.get('fragment_jwt')
@@ -8986,11 +11066,11 @@ def _apply_username_for_item(cardinal, chat_id, item, uname):
     item.update(candidate=uname, stage='await_confirm', confirmed=False, stage_ts=time.time())
     _safe_send(cardinal, chat_id, _tpl(chat_id, 'username_valid', qty=qty, username=uname, order_id=item.get('order_id')))
     if item.get('preconfirmed'):
-        if not FTS_GLOBAL_QUEUE or _current(chat_id) is item:
+        if _send_window_allows(chat_id, item):
             _schedule_confirm_send(cardinal, chat_id)
         return
     if _auto_send_without_plus(chat_id):
-        if FTS_GLOBAL_QUEUE and _current(chat_id) is not item and (_queue_mode(chat_id) != 2):
+        if not _send_window_allows(chat_id, item):
             return
         if FTS_GLOBAL_QUEUE and _current(chat_id) is not item and item.get('order_id'):
             _schedule_confirm_send(cardinal, chat_id, str(item.get('order_id')))
@@ -9007,11 +11087,11 @@ def _do_confirm_send_for_oid(cardinal, chat_id, oid):
     if not item:
         _safe_send(cardinal, chat_id, f'Не нашёл активный заказ #{oid} для подтверждения.')
         return
-    if FTS_GLOBAL_QUEUE and _queue_mode(chat_id) in (1, 3) and item is not _current(chat_id):
+    if not _send_window_allows(chat_id, item):
         item['preconfirmed'] = True
         _safe_send(cardinal, chat_id, f'✅ Подтверждение принято. Сейчас ещё не ваша очередь (позиция {_queue_pos_of(item)}). Когда очередь дойдёт — отправлю автоматически.')
         return
-    _send_pending_item(cardinal, chat_id, item)
+    return _send_pending_item(cardinal, chat_id, item)
 def _list_pending_oids(chat_id):
     return [str(x.get('order_id')) for x in _q(chat_id) if _allowed_stages(x) and x.get('order_id')]
 _INVIS_RE = _re.compile('[\\u200B-\\u200F\\u202A-\\u202E\\u2060-\\u206F\\uFEFF\\u00AD\\u034F\\u061C\\u180E\\uFE00-\\uFE0F]', _re.UNICODE)
@@ -9026,9 +11106,6 @@ def _strip_invisible(s):
 def new_message_handler(cardinal, event):
     chat_id = _event_chat_id(event)
     allowed_oids = set()
-    for _ in range(3):
-        if not _maybe_rotate_queue_head(cardinal, chat_id if chat_id is not None else '__orders__'):
-            break
     try:
         my_user = (getattr(cardinal.account, 'username', None) or '').lower()
         author = (getattr(event.message, 'author', '') or '').lower()
@@ -9059,9 +11136,11 @@ def new_message_handler(cardinal, event):
                 suffix.append(f'OID:{oid}')
             extra = ' (' + ' '.join(suffix) + ')' if suffix else ''
             _log('info', f'[IGNORE] auto-reply skipped{extra}')
+            _stats_event('ignore', oid=oid)
             return
         if author == 'funpay' and (_is_gift_like_text(text) or _mentions_account_login(text)):
             _log('info', '[IGNORE] gift/account-login system note')
+            _stats_event('ignore')
             return
         if _is_sending(chat_id) and author != 'funpay':
             return
@@ -9097,25 +11176,22 @@ def new_message_handler(cardinal, event):
             _set_order_qty(chat_id, oid, qty)
             if qty is not None and qty < 50:
                 return
-            known_here = any((str(x.get('order_id')) == str(oid) for x in _q(chat_id)))
-            known_any = known_here or (oid and any((str(x.get('order_id')) == str(oid) for q in _pending_orders.values() for x in q))) or (oid and str(oid) in _preorders)
+            known_here = _q(chat_id).by_oid(oid) is not None
+            known_any = known_here or (oid and any((q.by_oid(oid) is not None for q in _pending_orders.values()))) or (oid and str(oid) in _preorders)
             if not known_any:
                 _ensure_pending(chat_id, oid, qty)
                 if _should_prompt_once(chat_id, oid, qty or 0):
                     _safe_send(cardinal, chat_id, _tpl(chat_id, 'purchase_created', qty=qty or 50))
                     _mark_prompted(chat_id, oid)
                 return
-            pending = None
-            for x in _q(chat_id):
-                if str(x.get('order_id')) == str(oid):
-                    pending = x
-                    break
+            pending = _q(chat_id).by_oid(oid)
             if pending is None:
                 pending = _ensure_pending(chat_id, oid, qty)
             else:
                 old_chat = pending.get('chat_id')
                 if str(old_chat) != str(chat_id):
                     pending['chat_id'] = chat_id
+                    _q(chat_id).reindex(pending)
                     logger.warning(f'[QUEUE] bind order #{oid}: chat_id {old_chat} -> {chat_id}')
             use_pre = _cfg_bool(cfg, 'preorder_username', False)
             jwt = cfg.get('fragment_jwt')